@@ -1,6 +1,11 @@
+import copy
 import json
+from Entangleware import ew_link as ew
+from Entangleware.ew_asyncwriter import writer
+from Base.timing import record_effect
 
-seq_info = dict(JeanFreq=89,
+# seq_info of a new build context (ew_link.BuildContext), copied into it on first use
+default_seq_info = dict(JeanFreq=89,
                 FrancesFreq=71,
                 commands=
                 ["runfit(PixisRb,'gauss', 'fix', {'offset'}, 'ROI', [130 1; 1020 450], 'AutoROI', [400,400])",
@@ -19,8 +24,47 @@ seq_info = dict(JeanFreq=89,
                 evap_final=8)
 
 
+def __getattr__(name):
+    # seq_info follows the active build context, shots built concurrently each have their own
+    if name == 'seq_info':
+        return _info()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+def _info():
+    return ew.current_context().local('MatlabCommunication.seq_info', lambda: copy.deepcopy(default_seq_info))
+
+
+def set_info(key, value):
+    """Sets seq_info[key] from within a step, so that steps reused from the previous shot set it again
+
+    :param key: entry of seq_info
+    :type key: str
+    :param value: new value
+    """
+    record_effect(_assign_info, key, value)
+
+
+def update_info(info):
+    """Sets several entries of seq_info from within a step, see set_info
+
+    :param info: entries and their values
+    :type info: dict
+    """
+    for key, value in info.items():
+        set_info(key, value)
+
+
+def _assign_info(key, value):
+    _info()[key] = value
+
+
 def write():
-    file = json.dumps(seq_info)
-    f = open("Z:/Code/fitter/seq-Rb.json", "w")
-    f.write(file)
-    f.close()
+    # called from steps: journaled so that reused steps write again
+    record_effect(_write)
+
+
+def _write():
+    # serialized now, written in the background: a slow share must not stall building the sequence
+    file = json.dumps(_info())
+    writer.write("Z:/Code/fitter/seq-Rb.json", file)
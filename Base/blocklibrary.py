@@ -0,0 +1,219 @@
+import hashlib
+import os
+import pathlib
+import pickle
+import sys
+import types
+import numpy as np
+from Base.timing import _state_key
+
+# modules below this directory are part of the sequence code, their source goes into block keys
+_project_root = pathlib.Path(__file__).resolve().parent.parent
+
+
+def _stable(value, functions=()):
+    # text form of a state key (see timing._state_key) that is the same in every process, TypeError if there is none
+    if isinstance(value, types.FunctionType):
+        if value in functions:
+            # a closure capturing itself (or one capturing it)
+            return 'function{}'.format(functions.index(value))
+        functions = functions + (value,)
+        # closures and lambdas of one scope share their qualname: their code, defaults and captured values differ
+        cells = []
+        for cell in value.__closure__ or ():
+            try:
+                cells.append(_state_key(cell.cell_contents))
+            except ValueError:
+                cells.append('empty')
+        return '{}.{}[{}]'.format(value.__module__, value.__qualname__, _stable(
+            (_code_key(value.__code__), _state_key(value.__defaults__), _state_key(value.__kwdefaults__),
+             tuple(cells)), functions))
+    if isinstance(value, (types.BuiltinFunctionType, type)):
+        return '{}.{}'.format(getattr(value, '__module__', None), getattr(value, '__qualname__', repr(value)))
+    if isinstance(value, float):
+        return value.hex()
+    if isinstance(value, bytes):
+        return 'b' + hashlib.sha1(value).hexdigest()
+    if isinstance(value, tuple):
+        return '(' + ','.join(_stable(item, functions) for item in value) + ')'
+    if isinstance(value, frozenset):
+        return '{' + ','.join(sorted(_stable(item, functions) for item in value)) + '}'
+    if type(value).__repr__ is object.__repr__:
+        # the default repr holds the address of the object
+        raise TypeError('no stable key for {}'.format(type(value)))
+    return repr(value)
+
+
+def _code_key(code):
+    # what tells code objects with the same qualname apart (line, bytecode, names, constants)
+    consts = tuple(_code_key(const) if isinstance(const, types.CodeType) else const for const in code.co_consts)
+    return code.co_firstlineno, code.co_code, code.co_names, consts
+
+
+class BlockLibrary:
+    def __init__(self, root='BlockLibrary', max_bytes=2**30):
+        """On-disk library of relocatable blocks (see Sequence._relocatable), shared by all processes using root.
+        Install it with
+
+            timing.block_library = BlockLibrary('D:/blocks')
+
+        and relocatable methods load their blocks from it before executing, and store newly recorded ones.
+
+        A block is keyed by its method, the state of the instance and the source of the sequence modules reachable
+        from the instance's class, so editing any of them makes the old blocks unreachable; those age out under the
+        size cap. Blocks are .npy files loaded memory-mapped with their metadata (elapsed time, side effects) pickled
+        next to them. When the library is larger than max_bytes the least recently used blocks are deleted; the size is
+        tracked from the blocks stored, the library is only scanned again when that exceeds max_bytes.
+
+        :param root: directory of the library, created if missing
+        :type root: str or pathlib.Path
+        :param max_bytes: size cap of the library
+        :type max_bytes: int
+        """
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._source_hashes = {}
+        # size of the library as of the last scan plus the blocks stored since, None before the first scan
+        self._size = None
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+    @staticmethod
+    def _modules(cls):
+        # sequence modules reachable from cls through module globals
+        todo = [sys.modules[base.__module__] for base in cls.__mro__ if base.__module__ in sys.modules]
+        found = {}
+        while todo:
+            module = todo.pop()
+            path = getattr(module, '__file__', None)
+            if path is None or module.__name__ in found:
+                continue
+            path = pathlib.Path(path).resolve()
+            if _project_root not in path.parents:
+                continue
+            found[module.__name__] = path
+            for value in vars(module).values():
+                if isinstance(value, types.ModuleType):
+                    todo.append(value)
+                elif getattr(value, '__module__', None) in sys.modules:
+                    todo.append(sys.modules[value.__module__])
+        return found
+
+    def source_hash(self, cls):
+        """Hash of the source of the sequence modules reachable from cls (computed once per process: the code
+        running is the code that was imported)
+
+        :param cls: class of a sequence
+        :type cls: type
+        :rtype: str
+        """
+        if cls not in self._source_hashes:
+            digest = hashlib.sha1()
+            for name, path in sorted(self._modules(cls).items()):
+                digest.update(name.encode())
+                digest.update(path.read_bytes())
+            self._source_hashes[cls] = digest.hexdigest()
+        return self._source_hashes[cls]
+
+    def key(self, func, instance, state):
+        """Name of the block of func called on instance
+
+        :param func: undecorated method
+        :type func: function
+        :param instance: sequence the method is called on
+        :param state: state key of instance (timing._state_key)
+        :rtype: str or None
+        :return: None if the state can't be keyed the same way in every process (e.g. a function capturing an object
+            without a state key), such blocks are not stored
+        """
+        digest = hashlib.sha1()
+        try:
+            digest.update(_stable(func).encode())
+            digest.update(_stable(state).encode())
+        except TypeError:
+            return None
+        digest.update(self.source_hash(type(instance)).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Block stored under key
+
+        :param key: see key()
+        :type key: str
+        :rtype: tuple or None
+        :return: (transitions relative to the start time, elapsed time, side effects), None if not in the library
+        """
+        block_path = self.root / (key + '.npy')
+        try:
+            with open(self.root / (key + '.pkl'), 'rb') as in_file:
+                meta = pickle.load(in_file)
+            records = np.load(block_path, mmap_mode='r') if meta['length'] else np.load(block_path)
+            os.utime(block_path)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return records, meta['elapsed'], meta['effects']
+
+    def store(self, key, records, elapsed, effects, name=''):
+        """Adds a block, unless its side effects can't be pickled
+
+        :param key: see key()
+        :type key: str
+        :param records: transitions relative to the start time (ew_link.wire_dtype)
+        :type records: numpy.ndarray
+        :param elapsed: elapsed time of the block
+        :type elapsed: float
+        :param effects: side effects [(function, args)]
+        :type effects: list
+        :param name: readable name of the method, kept for inspection
+        :type name: str
+        """
+        try:
+            meta = pickle.dumps({'elapsed': elapsed, 'effects': effects, 'length': len(records), 'name': name})
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        # written under temporary names and renamed, other processes never see half a block
+        for suffix, write in (('.npy', lambda f: np.save(f, records)), ('.pkl', lambda f: f.write(meta))):
+            temp_path = self.root / (key + suffix + '.tmp{}'.format(os.getpid()))
+            with open(temp_path, 'wb') as out_file:
+                write(out_file)
+            os.replace(temp_path, self.root / (key + suffix))
+        self.stats['stored'] += 1
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += records.nbytes + len(meta)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        """Total size of the library in bytes
+
+        :rtype: int
+        """
+        return sum(path.stat().st_size for path in self.root.iterdir() if path.suffix in ('.npy', '.pkl'))
+
+    def evict(self):
+        """Deletes least recently used blocks until the library fits in max_bytes"""
+        blocks = []
+        for path in self.root.glob('*.npy'):
+            meta_path = path.with_suffix('.pkl')
+            try:
+                stat = path.stat()
+                size = stat.st_size + (meta_path.stat().st_size if meta_path.exists() else 0)
+            except OSError:
+                continue
+            blocks.append((stat.st_mtime, size, path, meta_path))
+        total = sum(block[1] for block in blocks)
+        for _, size, path, meta_path in sorted(blocks, key=lambda block: block[0]):
+            if total <= self.max_bytes:
+                break
+            for remove in (meta_path, path):
+                try:
+                    remove.unlink()
+                except OSError:
+                    pass
+            total -= size
+            self.stats['evicted'] += 1
+        self._size = total
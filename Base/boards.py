@@ -1,11 +1,243 @@
 from Entangleware import ew_link as ew
+from Entangleware import ew_profile
+import bisect
+import math
 import struct
 import warnings
+from functools import partial
+import numpy as np
 from Base.constants import *
 from Base.outputwrappers import digital_time_step
+from Base import spibus
+from Base import timing
+
+
+def _spi_bit_states(bytes_to_write, io_pin, serial_clock_pin):
+    """Digital states for clocking bytes_to_write out MSB first, in chronological order. Each bit takes two states:
+    data with the clock low, then data with the clock high. Same edges as PeripheralBoard._spi.
+
+    :param bytes_to_write: bytes to be clocked out, first byte first
+    :type bytes_to_write: bytes or bytearray
+    :param io_pin: serial data pin
+    :type io_pin: int
+    :param serial_clock_pin: serial clock pin
+    :type serial_clock_pin: int
+    :rtype: numpy.ndarray
+    :return: output states (2 per bit)
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(bytes_to_write), dtype=np.uint8)).astype(np.uint32)
+    data = np.repeat(bits, 2) << np.uint32(io_pin)
+    clock = np.tile(np.array([0, 1], dtype=np.uint32), len(bits)) << np.uint32(serial_clock_pin)
+    return data | clock
+
+
+class RegisterShadow:
+    def __init__(self):
+        """Time-aware copy of the register contents of one peripheral chip. Writes are recorded at the time they take
+        effect, so a value can be looked up at any time of the sequence regardless of the order the sequence is built in.
+        Skipped (elided) writes are kept together with a callable that emits them, and are emitted after all if a later
+        call changes the register between the write the skip relied on and the skipped write.
+
+        Values carry over to the next shot only if the shot they were written in was the last message run through the
+        connection (see ew_link.foreign_uploads).
+        """
+        self._times = {}
+        self._entries = {}
+        self._resets = []
+        self._buffered = []
+        self._updates = []
+        self._baseline = {}
+        self._generation = ew.msgseq.generation
+        self._mark = ew.upload_mark()
+
+    def _sync(self):
+        # what is written next depends on the register history, so it can't be replayed from a relocatable block
+        timing.not_relocatable()
+        foreign = ew.foreign_uploads(self._mark)
+        generation = ew.msgseq.generation
+        if generation == self._generation and not foreign:
+            return
+        # start a new history when the sequence buffer has been cleared since the last access
+        if generation != self._generation:
+            if self._generation == ew.msgseq.sent_generation and not foreign:
+                keys = set(self._baseline) | set(self._times)
+                final = {key: self._value_at(key, float('inf')) for key in keys}
+                self._baseline = {key: value for key, value in final.items() if value is not None}
+            self._times = {}
+            self._entries = {}
+            self._resets = []
+            self._buffered = []
+            self._updates = []
+            self._generation = generation
+        self._mark = ew.upload_mark()
+        if foreign:
+            # another message ran on the chip since (a replayed shot, another build context's), its registers are
+            # unknown
+            self._baseline = {}
+            for key in self._entries:
+                self._replay_after(key, -1, None)
+
+    def _value_at(self, key, shadow_time):
+        times = self._times.get(key, [])
+        i = bisect.bisect_right(times, shadow_time) - 1
+        if i >= 0:
+            entry_time = times[i]
+            value = self._entries[key][i][0]
+        else:
+            entry_time = float('-inf')
+            value = self._baseline.get(key)
+        r = bisect.bisect_right(self._resets, shadow_time) - 1
+        if r >= 0 and self._resets[r] >= entry_time:
+            return None
+        return value
+
+    def _replay_after(self, key, index, value):
+        # elided entries following index relied on the previous value of the register
+        entries = self._entries[key]
+        j = index + 1
+        while j < len(entries) and entries[j][1] is not None:
+            if entries[j][0] != value:
+                replay = entries[j][1]
+                entries[j][1] = None
+                replay()
+            j += 1
+
+    def value_at(self, key, shadow_time):
+        """Register contents at shadow_time, None if unknown
+
+        :param key: register (and channel) identifier
+        :type key: hashable
+        :param shadow_time: sequence time
+        :type shadow_time: float
+        :rtype: bytes or None
+        :return: last value written at or before shadow_time
+        """
+        self._sync()
+        return self._value_at(key, shadow_time)
+
+    def holds(self, keys, shadow_time, value):
+        """Checks whether all registers in keys already hold value at shadow_time. Always False outside of a locally
+        built sequence, where there is no timeline to check against.
+
+        :param keys: register (and channel) identifiers
+        :type keys: list
+        :param shadow_time: sequence time the write would take effect
+        :type shadow_time: float
+        :param value: register payload
+        :type value: bytes
+        :rtype: bool
+        """
+        if not (ew.msgseq.local and ew.msgseq.building):
+            return False
+        self._sync()
+        return all(self._value_at(key, shadow_time) == bytes(value) for key in keys)
+
+    def write(self, keys, shadow_time, value):
+        """Records a write that was sent to the board
+
+        :param keys: register (and channel) identifiers
+        :type keys: list
+        :param shadow_time: sequence time the write takes effect
+        :type shadow_time: float
+        :param value: register payload
+        :type value: bytes
+        """
+        self._sync()
+        value = bytes(value)
+        for key in keys:
+            if not ew.msgseq.building:
+                # written immediately, outside of any sequence
+                self._baseline[key] = value
+                continue
+            times = self._times.setdefault(key, [])
+            entries = self._entries.setdefault(key, [])
+            i = bisect.bisect_right(times, shadow_time)
+            times.insert(i, shadow_time)
+            entries.insert(i, [value, None])
+            self._replay_after(key, i, value)
+
+    def elide(self, keys, shadow_time, value, replay):
+        """Records a write that was skipped because the registers already held value
+
+        :param keys: register (and channel) identifiers
+        :type keys: list
+        :param shadow_time: sequence time the write would have taken effect
+        :type shadow_time: float
+        :param value: register payload
+        :type value: bytes
+        :param replay: emits the skipped write if it turns out to be needed
+        :type replay: callable
+        """
+        self._sync()
+        value = bytes(value)
+        for key in keys:
+            times = self._times.setdefault(key, [])
+            entries = self._entries.setdefault(key, [])
+            i = bisect.bisect_right(times, shadow_time)
+            times.insert(i, shadow_time)
+            entries.insert(i, [value, replay])
+
+    def buffered(self, shadow_time):
+        """Records a write left in the on-chip buffer without an update pulse (no_ud)
+
+        :param shadow_time: sequence time of the write
+        :type shadow_time: float
+        """
+        self._sync()
+        bisect.insort(self._buffered, shadow_time)
+
+    def updated(self, shadow_time):
+        """Records an update pulse
+
+        :param shadow_time: sequence time of the pulse
+        :type shadow_time: float
+        """
+        self._sync()
+        bisect.insort(self._updates, shadow_time)
+
+    def update_pending(self, shadow_time):
+        """Checks for a buffered write that no update pulse has enacted by shadow_time
+
+        :param shadow_time: sequence time
+        :type shadow_time: float
+        :rtype: bool
+        """
+        self._sync()
+        b = bisect.bisect_right(self._buffered, shadow_time) - 1
+        if b < 0:
+            return False
+        u = bisect.bisect_right(self._updates, shadow_time) - 1
+        return u < 0 or self._updates[u] < self._buffered[b]
+
+    def invalidate(self, shadow_time):
+        """Forgets all register contents from shadow_time on (reset/initialization of the board)
+
+        :param shadow_time: sequence time of the reset
+        :type shadow_time: float
+        """
+        self._sync()
+        if not ew.msgseq.building:
+            self._baseline = {}
+            return
+        bisect.insort(self._resets, shadow_time)
+        for key, times in self._times.items():
+            i = bisect.bisect_left(times, shadow_time) - 1
+            self._replay_after(key, i, None)
+
+
+def _shadow_for(connector, io_pin, serial_clock_pin):
+    # shadows are shared by all board objects driving the same chip, within one build context (ew_link.BuildContext)
+    register_shadows = ew.current_context().local('boards.shadows', dict)
+    key = (connector, io_pin, serial_clock_pin)
+    if key not in register_shadows:
+        register_shadows[key] = RegisterShadow()
+    return register_shadows[key]
 
 
 class PeripheralBoard:
+    # frames may be moved earlier by an active spibus.SpiBus
+    _spi_schedulable = True
+
     def __init__(self, connector, io_pin, serial_clock_pin, **kwargs):
         """Parent class for communication with peripheral hardware. Uses serial communication to write instructions and
         tells the board to execute the instructions at a deterministic time in the sequence.
@@ -30,6 +262,15 @@ class PeripheralBoard:
             self.io_update_pin = kwargs.get('io_update_pin')
         self.spi_min_time = digital_time_step
 
+    @property
+    def shadow(self):
+        """Register shadow of the chip in the current build context
+
+        :rtype: RegisterShadow
+        """
+        return _shadow_for(self.connector, self.io_pin, self.serial_clock_pin)
+
+    @ew_profile.profiled
     def _spi(self, spi_time, bytes_to_write, register):
         """Transmits data to eval board. Pulses serial clock pin on/off while sending information
         in bytes_to_write. First writes the 1 byte control register number.
@@ -44,6 +285,9 @@ class PeripheralBoard:
         :return: 0 (effective elapsed time)
         """
 
+        if spibus.active_bus() is not None:
+            return self._spi_submit(spi_time, bytes_to_write, register)
+
         # Write data to the IO pin while cycling the clock pin
         current_time = spi_time
         channel_select = ((1 << self.io_pin) | (1 << self.serial_clock_pin))
@@ -69,6 +313,48 @@ class PeripheralBoard:
             ew.set_digital_state(current_time, self.connector, channel_select, out_enable, state)
         return 0
 
+    @ew_profile.profiled
+    def _spi_bulk(self, spi_time, bytes_to_write, register):
+        """Vectorized equivalent of _spi. All clock and data transitions of the frame are built with numpy and queued
+        with a single call to set_digital_states. Use for long writes (e.g. AD9910 RAM) where one set_digital_state
+        call per clock edge is too slow.
+
+        :param spi_time: time at which to finish writing information to board
+        :type spi_time: float
+        :param bytes_to_write: control bytes to be sent to board
+        :type bytes_to_write: bytes or bytearray
+        :param register: control register being addressed
+        :type register: int
+        :rtype: int
+        :return: 0 (effective elapsed time)
+        """
+        if spibus.active_bus() is not None:
+            return self._spi_submit(spi_time, bytes_to_write, register)
+
+        states = _spi_bit_states(bytes([register]) + bytes(bytes_to_write), self.io_pin, self.serial_clock_pin)
+        times = spi_time - self.spi_min_time * np.arange(len(states), 0, -1)
+        channel_select = ((1 << self.io_pin) | (1 << self.serial_clock_pin))
+        ew.set_digital_states(times, self.connector, channel_select, channel_select, states)
+        return 0
+
+    @ew_profile.profiled
+    def _spi_submit(self, spi_time, bytes_to_write, register):
+        """Hands a frame to the active SPI bus scheduler instead of writing it. Same arguments as _spi.
+
+        :rtype: int
+        :return: 0 (effective elapsed time)
+        """
+        bus = spibus.active_bus()
+        chip = (self.connector, self.io_pin, self.serial_clock_pin)
+        states = _spi_bit_states(bytes([register]) + bytes(bytes_to_write), self.io_pin, self.serial_clock_pin)
+        channel_select = ((1 << self.io_pin) | (1 << self.serial_clock_pin))
+        if self._spi_schedulable:
+            bus.submit(chip, self.connector, channel_select, states, spi_time, self.spi_min_time)
+        else:
+            times = spi_time - self.spi_min_time * np.arange(len(states), 0, -1)
+            bus.submit_fixed(chip, self.connector, times, channel_select, states, self.spi_min_time)
+        return 0
+
     def _update_output(self, spi_time):
         """Pulse the update pin to instruct DDS to enact commands contained in on-chip memory buffer
 
@@ -78,6 +364,9 @@ class PeripheralBoard:
         :return: time to pulse pin (2 x digital transition time)
         """
         this_time = spi_time
+        self.shadow.updated(this_time)
+        if spibus.active_bus() is not None:
+            spibus.active_bus().note_update((self.connector, self.io_pin, self.serial_clock_pin), this_time)
         ew.set_digital_state(this_time, self.connector, 1 << self.io_update_pin, 1 << self.io_update_pin,
                              1 << self.io_update_pin)
         this_time += self.spi_min_time
@@ -85,6 +374,58 @@ class PeripheralBoard:
                              0 << self.io_update_pin)
         return 2 * self.spi_min_time
 
+    def _replay_frame(self, frame_time, bytes_to_write, register, update_time, select=None):
+        """Emits a register write that was skipped by the register shadow, in the slot it was planned for
+
+        :param frame_time: time at which to finish writing the frame
+        :type frame_time: float
+        :param bytes_to_write: register payload
+        :type bytes_to_write: bytes
+        :param register: register being addressed
+        :type register: int
+        :param update_time: time of the update pulse, None for no pulse
+        :type update_time: float or None
+        :param select: (time, payload) of a channel select frame to write first
+        :type select: tuple or None
+        """
+        if select is not None:
+            self._spi(select[0], select[1], 0x00)
+        self._spi(frame_time, bytes_to_write, register)
+        if update_time is not None:
+            self._update_output(update_time)
+
+    def _shadowed_write(self, keys, shadow_time, frame_time, bytes_to_write, register, force=False, select=None,
+                        update_time=None):
+        """Writes a register unless the register shadow shows it already holds bytes_to_write at shadow_time. A skipped
+        write is recorded so that it can be emitted later on, should an out of order write make it necessary.
+
+        :param keys: register (and channel) identifiers in the shadow
+        :type keys: list
+        :param shadow_time: time the write takes effect (update pulse)
+        :type shadow_time: float
+        :param frame_time: time at which to finish writing the frame
+        :type frame_time: float
+        :param bytes_to_write: register payload
+        :type bytes_to_write: bytes
+        :param register: register being addressed
+        :type register: int
+        :param force: if true always writes the frame
+        :type force: bool
+        :param select: (time, payload) of the channel select frame needed to replay a skipped write
+        :type select: tuple or None
+        :param update_time: time of the update pulse needed to replay a skipped write, None for no pulse
+        :type update_time: float or None
+        :rtype: bool
+        :return: True if the frame was written
+        """
+        if not force and self.shadow.holds(keys, shadow_time, bytes_to_write):
+            replay = partial(self._replay_frame, frame_time, bytes_to_write, register, update_time, select)
+            self.shadow.elide(keys, shadow_time, bytes_to_write, replay)
+            return False
+        self._spi(frame_time, bytes_to_write, register)
+        self.shadow.write(keys, shadow_time, bytes_to_write)
+        return True
+
 
 class AD9959(PeripheralBoard):
     def __init__(self, connector, io_pin, serial_clock_pin, reset_pin, io_update_pin, ref_clock, ref_clk_multiplier):
@@ -124,15 +465,27 @@ class AD9959(PeripheralBoard):
         """
         # FR1 register
         register = 0x01
+        data_to_send = self._fr1_payload(ramp_pins=False)
+        self.shadow.invalidate(dds_time - 64 * self.spi_min_time)
+        self._spi(dds_time, data_to_send, register)
+        self.shadow.write([register], dds_time, data_to_send)
+        self._update_output(dds_time)
+        return 0
+
+    def _fr1_payload(self, ramp_pins):
+        """Function register 1 (0x01) contents
+
+        :param ramp_pins: if true profile pins P2 and P3 start the amplitude ramps (RU/RD) of channels 0 and 1
+        :type ramp_pins: bool
+        :rtype: bytes
+        """
         # FR1 [22:18] is the PLL divider ratio
         # FR1 [23] is the VCO gain control
+        # FR1 [11:10] is the RU/RD pin selection, 01: profile pins P2 and P3
         payload1 = (self._AD9959_ref_clk_multiplier << 2) | (1 << 7)
-        payload2 = 0
+        payload2 = (1 << 2) if ramp_pins else 0
         payload3 = 0
-        data_to_send = bytearray([payload1, payload2, payload3])
-        self._spi(dds_time, data_to_send, register)
-        self._update_output(dds_time)
-        return 0
+        return bytes([payload1, payload2, payload3])
 
     def reset(self, dds_time):
         """ Reset DDS by pulsing reset pin, then reinitialize by calling initialize method.
@@ -148,6 +501,7 @@ class AD9959(PeripheralBoard):
         out_enable = channel_select
         state = (1 << self.reset_pin)
         # change reset pin to high
+        self.shadow.invalidate(this_time)
         ew.set_digital_state(this_time, self.connector, channel_select, out_enable, state)
         this_time += .010
         state = (0 << self.reset_pin)
@@ -157,9 +511,10 @@ class AD9959(PeripheralBoard):
         tt = .020
         return tt
 
-    def arbitrary_output(self, dds_time, channel_mask, freq_list, power_list, tt, no_ud=False):
+    def arbitrary_output(self, dds_time, channel_mask, freq_list, power_list, tt, no_ud=False, force=False):
         """Generic output function for the AD9959. Calls for the DDS to output each frequency in freq_list with
-        corresponding power in power_list over time tt on given channel(s).
+        corresponding power in power_list over time tt on given channel(s). Registers that already hold the requested
+        value (according to the register shadow) are not rewritten.
 
         :param dds_time: time to output first frequency and power in list
         :type dds_time: float
@@ -173,6 +528,8 @@ class AD9959(PeripheralBoard):
         :type tt: float
         :param no_ud: if true doesn't pulse update pin after writing. Allows multiple instructions to enact at once
         :type no_ud: bool
+        :param force: if true writes every register, even if the register shadow shows it already holds the value
+        :type force: bool
         :rtype: float
         :return: elapsed time, minimum 2*spi_min_time
         """
@@ -183,9 +540,6 @@ class AD9959(PeripheralBoard):
         if n_steps == 0:
             raise ValueError('AD9959arb: No frequency/power')
 
-        last_freq = float('-inf')
-        last_mult = float('-inf')
-        send_ud = False
         minimum_step_time = 200 * self.spi_min_time
 
         # make sure the total time is at least the minimum time needed to complete 1 full step
@@ -201,44 +555,206 @@ class AD9959(PeripheralBoard):
             if dt < minimum_step_time:
                 raise ValueError("AD9959arb: time step too small")
 
-        # write the channel select register, option for a list of multiple channels
-        temp_time = dds_time - 144 * self.spi_min_time
+        # channel select register, option for a list of multiple channels
         if type(channel_mask) is list:
-            chan_list = 0
-            for chan in channel_mask:
-                chan_list |= (1 << chan)
-            payload0 = bytearray([chan_list << 4])
+            channels = channel_mask
         else:
-            payload0 = bytearray([(1 << channel_mask) << 4])
-        self._spi(temp_time, payload0, 0x00)
+            channels = [channel_mask]
+        chan_list = 0
+        for chan in channels:
+            chan_list |= (1 << chan)
+        payload0 = bytearray([chan_list << 4])
+        select_written = False
 
         # each step occurs at a time interval determined by the total time and number of steps
         # the step itself is done in negative time, so that it finishes at the appropriate step time
+        # frames have fixed slots: FTW ends at the step time, ACR before it, channel select before that
         for i in range(n_steps):
             step_time = i * dt + dds_time
-            temp_time = step_time
-            freq = freq_list[i]
-            if freq != last_freq:
-                payload4 = struct.pack('>L', round((1 << 32) * freq / self._AD9959_sys_clock))
-                self._spi(temp_time, payload4, 0x04)
-                last_freq = freq
-                send_ud = True
-                temp_time -= 80 * self.spi_min_time
-
-            mult1 = 10 ** (power_list[i] / 10 - 3)
-            mult = 1023 * (100 * mult1) ** 0.5 / 0.149
-            mult = min(mult, 1023)
-            if mult != last_mult:
-                payload6 = struct.pack('>BH', 0, ((1 << 12) | int(mult)))
-                self._spi(temp_time, payload6, 0x06)
-                last_mult = mult
-                send_ud = True
-                temp_time -= 64 * self.spi_min_time
-            if send_ud and not no_ud:
+            select_time = step_time - 144 * self.spi_min_time
+            update_time = None if no_ud else step_time
+
+            payload4 = self._ftw_payload(freq_list[i])
+            payload6 = self._acr_payload(power_list[i])
+
+            send_ud = False
+            for register, payload, frame_time in ((0x04, payload4, step_time),
+                                                  (0x06, payload6, step_time - 80 * self.spi_min_time)):
+                keys = [(register, chan) for chan in channels]
+                if self._shadowed_write(keys, step_time, frame_time, payload, register, force=force,
+                                        select=(select_time, payload0), update_time=update_time):
+                    send_ud = True
+
+            if send_ud and not select_written:
+                self._spi(select_time, payload0, 0x00)
+                select_written = True
+            if no_ud:
+                if send_ud:
+                    self.shadow.buffered(step_time)
+            elif send_ud or self.shadow.update_pending(step_time):
+                # a buffered (no_ud) write may rely on this update even if nothing new was written
                 self._update_output(step_time)
-                send_ud = False
         return tt
 
+    def _ftw_payload(self, freq):
+        """Frequency tuning word (register 0x04) for freq
+
+        :param freq: output frequency (Hz)
+        :type freq: float
+        :rtype: bytes
+        """
+        return struct.pack('>L', round((1 << 32) * freq / self._AD9959_sys_clock))
+
+    def _acr_payload(self, power):
+        """Amplitude control register (0x06) contents for power, with the amplitude multiplier enabled
+
+        :param power: output power (dBm)
+        :type power: float
+        :rtype: bytes
+        """
+        return struct.pack('>BH', 0, ((1 << 12) | self._amplitude_scale(power)))
+
+    @staticmethod
+    def _amplitude_scale(power):
+        """Amplitude scale factor (10 bits) for power
+
+        :param power: output power (dBm)
+        :type power: float
+        :rtype: int
+        """
+        mult1 = 10 ** (power / 10 - 3)
+        mult = 1023 * (100 * mult1) ** 0.5 / 0.149
+        return int(min(mult, 1023))
+
+    def multi_channel_output(self, dds_time, outputs, force=False):
+        """Sets the frequency and power of several channels at once. The channel select, frequency and amplitude frames
+        of all channels are written in one contiguous burst that ends at dds_time, followed by a single update pulse, so
+        all channels change together. Registers that already hold the requested value are skipped.
+
+        :param dds_time: time at which all channels change (update pulse)
+        :type dds_time: float
+        :param outputs: frequency (Hz) and power (dBm) for each channel (0-3)
+        :type outputs: dict {int: (float, float)}
+        :param force: if true writes every register, even if the register shadow shows it already holds the value
+        :type force: bool
+        :rtype: float
+        :return: elapsed time (2us update pulse)
+        """
+        if len(outputs) == 0:
+            raise ValueError('AD9959multi: No channels')
+
+        # (channel, register, payload, frame length) in chronological order
+        frames = []
+        for chan in sorted(outputs):
+            if chan not in range(4):
+                raise ValueError('AD9959multi: channel must be 0-3')
+            freq, power = outputs[chan]
+            frames.append((chan, 0x04, self._ftw_payload(freq), 80))
+            frames.append((chan, 0x06, self._acr_payload(power), 64))
+
+        if force:
+            needed = frames
+            elided = []
+        else:
+            needed = [f for f in frames if not self.shadow.holds([(f[1], f[0])], dds_time, f[2])]
+            elided = [f for f in frames if f not in needed]
+
+        # burst runs backwards from dds_time, channel select written whenever the channel changes
+        this_time = dds_time
+        last_chan = None
+        for chan, register, payload, length in reversed(needed):
+            if last_chan is not None and chan != last_chan:
+                self._spi(this_time, bytearray([(1 << last_chan) << 4]), 0x00)
+                this_time -= 32 * self.spi_min_time
+            self._spi(this_time, payload, register)
+            self.shadow.write([(register, chan)], dds_time, payload)
+            this_time -= length * self.spi_min_time
+            last_chan = chan
+        if last_chan is not None:
+            self._spi(this_time, bytearray([(1 << last_chan) << 4]), 0x00)
+            this_time -= 32 * self.spi_min_time
+
+        # skipped frames get their own slots before the burst, in case they have to be replayed
+        for chan, register, payload, length in elided:
+            select = (this_time - length * self.spi_min_time, bytearray([(1 << chan) << 4]))
+            replay = partial(self._replay_frame, this_time, payload, register, dds_time, select)
+            self.shadow.elide([(register, chan)], dds_time, payload, replay)
+            this_time -= (length + 32) * self.spi_min_time
+
+        if len(needed) == 0 and not self.shadow.update_pending(dds_time):
+            return 2 * self.spi_min_time
+        return self._update_output(dds_time)
+
+    def amplitude_ramp(self, dds_time, channel, a0, a1, duration, profile_connector=None, profile_pin=None):
+        """Turns a channel on or off with the on-chip amplitude ramp instead of one amplitude frame per step. The ramp
+        runs between zero and the amplitude scale factor, so one of a0 and a1 has to be off (-inf dBm). Sets the ramp
+        rate and step size in the amplitude control register (0x06) so the ramp takes duration, with a setup burst that
+        finishes before dds_time. The ramp is started by a profile pin: with FR1[11:10] = 01 (set here, if the register
+        shadow doesn't show it set already) and the default profile pin configuration, P2 ramps channel 0 and P3 ramps
+        channel 1, rising for a turn on, falling for a turn off. Channels 2 and 3 have no ramp pin in this mode. If
+        profile_connector and profile_pin are given the pin is switched at dds_time, otherwise it has to be switched
+        elsewhere.
+
+        :param dds_time: time the ramp starts
+        :type dds_time: float
+        :param channel: output channel (0 or 1)
+        :type channel: int
+        :raise: ValueError if channel isn't 0 or 1
+        :param a0: amplitude at start of ramp (dBm)
+        :type a0: float
+        :param a1: amplitude at end of ramp (dBm)
+        :type a1: float
+        :param duration: ramp time (seconds), programmed as closely as the ramp rate (1-255 sync clock cycles per step)
+            and step size (1, 2, 4 or 8) allow
+        :type duration: float
+        :param profile_connector: FPGA connector of the profile pin
+        :type profile_connector: int
+        :param profile_pin: digital line driving the ramp pin of channel (P2 for channel 0, P3 for channel 1)
+        :type profile_pin: int
+        :rtype: float
+        :return: elapsed time: duration of the ramp as programmed
+        """
+        if channel not in (0, 1):
+            raise ValueError('AD9959 amplitude_ramp: only channels 0 and 1 have a ramp pin (P2, P3)')
+        if a0 == a1 or (a0 != float('-inf') and a1 != float('-inf')):
+            raise ValueError('AD9959 amplitude_ramp: ramp runs between off and on, one of a0 and a1 must be -inf')
+        ramp_up = a0 == float('-inf')
+        power = a1 if ramp_up else a0
+
+        asf = self._amplitude_scale(power)
+        if asf == 0:
+            raise ValueError('AD9959 amplitude_ramp: amplitude too small')
+
+        # each step is ramp_rate sync clock cycles (sys clock / 4) long, step size is 1, 2, 4 or 8: the finest step
+        # that is not too fast, larger steps only when even rate 1 is too slow
+        sync_cycles = duration * self._AD9959_sys_clock / 4
+        for step_code in range(4):
+            ramp_rate = round(sync_cycles * (1 << step_code) / asf)
+            if ramp_rate >= 1:
+                break
+        if ramp_rate > 255 or ramp_rate < 1:
+            warnings.warn("AD9959 amplitude_ramp: ramp time out of range. Using closest possible")
+            ramp_rate = min(max(ramp_rate, 1), 255)
+        programmed = math.ceil(asf / (1 << step_code)) * ramp_rate * 4 / self._AD9959_sys_clock
+
+        # ACR [23:16] ramp rate, [15:14] step size, [12] multiplier enable, [11] ramp enable, [9:0] scale factor
+        payload6 = struct.pack('>BH', ramp_rate, (step_code << 14) | (1 << 12) | (1 << 11) | asf)
+
+        # setup burst: ramp pins, channel select, no modulation, amplitude control register, update just before dds_time
+        update_time = dds_time - 2 * self.spi_min_time
+        self._shadowed_write([0x01], update_time, update_time - 160 * self.spi_min_time, self._fr1_payload(True), 0x01,
+                             update_time=update_time)
+        self._spi(update_time, payload6, 0x06)
+        self.shadow.write([(0x06, channel)], update_time, payload6)
+        self._disable_modulation(update_time - 64 * self.spi_min_time)
+        self._spi(update_time - 128 * self.spi_min_time, bytearray([(1 << channel) << 4]), 0x00)
+        self._update_output(update_time)
+
+        if profile_connector is not None and profile_pin is not None:
+            state = (1 << profile_pin) if ramp_up else 0
+            ew.set_digital_state(dds_time, profile_connector, 1 << profile_pin, 1 << profile_pin, state)
+        return programmed
+
     def _disable_modulation(self, dds_time):
         payload1 = 0
         payload2 = 1 | (1 << 1)
@@ -303,6 +819,8 @@ class AD9959(PeripheralBoard):
                 mult = 1023
             payload5 = struct.pack('>BH', 0, ((1 << 12) | int(mult)))
             self._spi(dds_time, payload5, 0x06)
+            channels = channel_mask if type(channel_mask) is list else [channel_mask]
+            self.shadow.write([(0x06, chan) for chan in channels], dds_time, payload5)
 
         t = self._update_output(dds_time)
 
@@ -345,6 +863,7 @@ class AD9959(PeripheralBoard):
             # write f0 to frequency tuning word register (0x04)
             payload5 = struct.pack('>L', round((1 << 32) * freq0 / self._AD9959_sys_clock))
             self._spi(this_time, payload5, 0x04)
+            self.shadow.write([(0x04, channel_mask)], dds_time, payload5)
             this_time -= 80 * self.spi_min_time
 
             if ramp_time != 0:
@@ -452,6 +971,9 @@ class AD9854(PeripheralBoard):
         payload6 = 0
         payload_combined2 = bytearray([payload5, payload6])
         self._spi(this_time, payload_combined2, 0x08)
+        self.shadow.invalidate(this_time - 48 * self.spi_min_time)
+        self.shadow.write([register], dds_time, payload_combined)
+        self.shadow.write([0x08], dds_time, payload_combined2)
         return 0
 
     def chirp_initialize(self, dds_time):
@@ -509,6 +1031,11 @@ class AD9854(PeripheralBoard):
         self._spi(this_time, payload9, 0x04)
         this_time -= 112 * self.spi_min_time
 
+        self.shadow.invalidate(this_time)
+        self.shadow.write([0x07], dds_time, payload_combined)
+        self.shadow.write([0x02], dds_time, payload5)
+        self.shadow.write([0x06], dds_time, payload6)
+        self.shadow.write([0x04], dds_time, payload9)
         return 0
 
     def reset(self, dds_time):
@@ -520,6 +1047,7 @@ class AD9854(PeripheralBoard):
         :return: 20 ms (effective elapsed time)
         """
         this_time = dds_time
+        self.shadow.invalidate(this_time)
         ew.set_digital_state(this_time, self.connector, 1 << self.reset_pin, 1 << self.reset_pin, 1 << self.reset_pin)
         this_time += 0.010
         ew.set_digital_state(this_time, self.connector, 1 << self.reset_pin, 1 << self.reset_pin, 0 << self.reset_pin)
@@ -536,6 +1064,7 @@ class AD9854(PeripheralBoard):
         :return: 2ms (effective elapsed time)
         """
         this_time = dds_time
+        self.shadow.invalidate(this_time)
         ew.set_digital_state(this_time, self.connector, 1 << self.reset_pin, 1 << self.reset_pin, 1 << self.reset_pin)
         this_time += 0.001
         ew.set_digital_state(this_time, self.connector, 1 << self.reset_pin, 1 << self.reset_pin, 0 << self.reset_pin)
@@ -543,8 +1072,9 @@ class AD9854(PeripheralBoard):
         self.initialize(this_time)
         return 0.002
 
-    def arbitrary_output(self, dds_time, chirp, total_time, freq_list, power_list):
+    def arbitrary_output(self, dds_time, chirp, total_time, freq_list, power_list, force=False):
         """Outputs the frequencies in freq_list (at the corresponding powers in power_list) over time total_time.
+        Registers that already hold the requested value (according to the register shadow) are not rewritten.
 
         :param dds_time: execution time
         :type dds_time: float
@@ -556,6 +1086,8 @@ class AD9854(PeripheralBoard):
         :type freq_list: list [float]
         :param power_list: powers to output
         :type power_list: list [float]
+        :param force: if true writes every register, even if the register shadow shows it already holds the value
+        :type force: bool
         :return: total_time (elapsed time)
         """
         # in chirp mode there should be one more frequency in freq_list than there are powers in power_list
@@ -568,9 +1100,6 @@ class AD9854(PeripheralBoard):
         n_steps = len(power_list)
         min_time_step = 200 * self.spi_min_time
         delta_t = (self._AD9854_ramp_rate_clk + 1) / self._AD9854_sys_clock
-        last_freq = float('inf')
-        last_mult = float('inf')
-        send_update = False
 
         # check step size
         if total_time < min_time_step:
@@ -584,50 +1113,48 @@ class AD9854(PeripheralBoard):
                 warnings.warn("AD9854arb:time step too small. Using minimum time step.")
 
         # loop through num_steps, write each step backwards in time from i * dt
+        # frames have fixed slots: amplitude ends at the step time, frequency before it
         for i in range(n_steps):
             this_time = i * dt + dds_time
-            temp_time = this_time
 
             # calculate amplitude tuning word
             mult1 = 10 ** (power_list[i] / 10 - 3)
             mult = 4095 * (100 * mult1)**0.5 / 0.134
             mult = min(mult, 4095)
-            # write amplitude tuning word if new amplitude
-            if mult != last_mult:
-                payload_mult = struct.pack('>H', int(mult) & 4095)
-                self._spi(temp_time, payload_mult, 0x08)
-                last_mult = mult
-                send_update = True
-                temp_time -= 48 * self.spi_min_time
-
-            # write frequency tuning word if new frequency
+            payload_mult = struct.pack('>H', int(mult) & 4095)
+
+            # frequency tuning word, or delta frequency word in chirp mode
             if not chirp:
-                if freq_list[i] != last_freq:
-                    freq_data = round((1 << 48) * freq_list[i] / self._AD9854_sys_clock)
-                    payload5 = struct.pack('>LH', freq_data >> 16, freq_data & 65535)
-                    self._spi(temp_time, payload5, 0x02)
-                    last_freq = freq_list
-                    send_update = True
-                    temp_time -= 112 * self.spi_min_time
+                freq_data = round((1 << 48) * freq_list[i] / self._AD9854_sys_clock)
+                payload5 = struct.pack('>LH', freq_data >> 16, freq_data & 65535)
+                freq_register = 0x02
             else:
                 dfdt = (freq_list[i + 1] - freq_list[i]) / dt
-                if dfdt != last_freq:
-                    freq_data = round((1 << 48) * delta_t * dfdt / self._AD9854_sys_clock)
-                    payload5 = struct.pack('>LH', (freq_data >> 16) & ((1 << 32) - 1), freq_data & 65535)
-                    self._spi(temp_time, payload5, 0x04)
-                    last_freq = dfdt
+                freq_data = round((1 << 48) * delta_t * dfdt / self._AD9854_sys_clock)
+                payload5 = struct.pack('>LH', (freq_data >> 16) & ((1 << 32) - 1), freq_data & 65535)
+                freq_register = 0x04
+
+            send_update = False
+            for register, payload, frame_time in ((0x08, payload_mult, this_time),
+                                                  (freq_register, payload5, this_time - 48 * self.spi_min_time)):
+                if self._shadowed_write([register], this_time, frame_time, payload, register, force=force,
+                                        update_time=this_time):
                     send_update = True
-                    temp_time -= 112 * self.spi_min_time
             # update clock if new word has been written
             if send_update:
                 self._update_output(this_time)
-                send_update = False
         return total_time
 
 
 class AD9910(PeripheralBoard):
+    # CFR1 [30:29] RAM playback destination
+    _AD9910_ram_destinations = {'frequency': 0, 'phase': 1, 'amplitude': 2, 'polar': 3}
+    # RAM profile [2:0] RAM profile mode control
+    _AD9910_ram_modes = {'direct': 0, 'ramp_up': 1, 'bidirectional': 2, 'continuous_bidirectional': 3,
+                         'continuous_recirculate': 4}
+
     def __init__(self, connector1, connector2, io_pin, serial_clock_pin, reset_pin, io_update_pin, dr_ctl_pin,
-                 ref_clock, ref_clk_multiplier, input_divider):
+                 ref_clock, ref_clk_multiplier, input_divider, profile_pins=None):
         ''' Serial communication with an AD9910 DDS eval board.
 
         :param connector1: Output connector for serial communication channels
@@ -650,6 +1177,8 @@ class AD9910(PeripheralBoard):
         :type ref_clk_multiplier: int
         :param input_divider: reference clock divider enable
         :type input_divider: bool
+        :param profile_pins: digital lines for profile pins P0, P1, P2 (on connector2). Needed for select_profile
+        :type profile_pins: list [int]
         '''
         super().__init__(connector=connector1, io_pin=io_pin, serial_clock_pin=serial_clock_pin, reset_pin=reset_pin,
                          io_update_pin=io_update_pin)
@@ -660,6 +1189,7 @@ class AD9910(PeripheralBoard):
         self.AD9910_DRCTLpin = dr_ctl_pin
         self.AD9910_connector2 = connector2
         self._AD9910_ref_clk_multiplier = ref_clk_multiplier
+        self.AD9910_profile_pins = profile_pins
 
         # if input divider is bypassed see CFR3[14]
         if self._AD9910_ref_clk_multiplier == 0 and self._AD9910_input_div is False:
@@ -847,15 +1377,218 @@ class AD9910(PeripheralBoard):
             :return: 0
             """
         this_time = dds_time
+        payload0 = self._profile_payload(freq)
+        self._spi(this_time, payload0, 0x0E)
+        self._update_output(this_time)
+        return 0
+
+    def _profile_payload(self, freq, amplitude=None, phase=0):
+        """ Packs a single tone profile register: [61:48] amplitude scale factor, [47:32] phase offset word,
+        [31:0] frequency tuning word.
+
+            :param freq: frequency (Hz)
+            :type freq: float
+            :param amplitude: fraction of full scale (0 to 1). Default keeps the chip default scale factor 0x08B5.
+                Only used if amplitude scaling from profiles is enabled in CFR2.
+            :type amplitude: float
+            :param phase: phase offset (rad)
+            :type phase: float
+            :rtype: bytes
+            :return: profile register payload
+            """
         ftw = round((1 << 32) * (freq / self._AD9910_sys_clock))
+        if amplitude is None:
+            asf = 0x08B5
+        elif 0 <= amplitude <= 1:
+            asf = round(amplitude * 0x3FFF)
+        else:
+            raise ValueError("AD9910 profile: amplitude must be between 0 and 1")
+        pow_word = round(phase / (2 * math.pi) * (1 << 16)) & 0xFFFF
+        return struct.pack('>HHL', asf, pow_word, ftw)
 
-        payload0 = struct.pack('>BB', 0x08, 0xB5) + struct.pack(">h", 0) + struct.pack(">I",ftw)  # first 4 bytes are set to default values
-        self._spi(this_time, payload0, 0x0E)
+    def load_profiles(self, dds_time, freq_list, amp_list=None, phase_list=None):
+        """ Preloads up to eight single tone profile registers (0x0E-0x15) followed by one update pulse. Afterwards the
+        output is switched between the tones with select_profile, one digital transition per switch. Load before the
+        time-critical part of the sequence: the writes take 144*spi_min_time per profile before dds_time.
+
+            :param dds_time: time at which the profiles are loaded (update pulse)
+            :type dds_time: float
+            :param freq_list: frequency of profile 0, 1, ... (Hz)
+            :type freq_list: list [float]
+            :param amp_list: amplitude of each profile (fraction of full scale), optional
+            :type amp_list: list [float]
+            :param phase_list: phase offset of each profile (rad), optional
+            :type phase_list: list [float]
+            :rtype: int
+            :return: 0
+            """
+        n_profiles = len(freq_list)
+        if n_profiles == 0 or n_profiles > 8:
+            raise ValueError("AD9910 load_profiles: between 1 and 8 profiles can be loaded")
+        if amp_list is None:
+            amp_list = [None] * n_profiles
+        if phase_list is None:
+            phase_list = [0] * n_profiles
+        if len(amp_list) != n_profiles or len(phase_list) != n_profiles:
+            raise ValueError("AD9910 load_profiles: unequal number of frequencies, amplitudes and phases")
+
+        # sequence proceeds backwards from the update pulse
+        this_time = dds_time
+        self._update_output(this_time)
+        for profile in reversed(range(n_profiles)):
+            payload = self._profile_payload(freq_list[profile], amp_list[profile], phase_list[profile])
+            self._spi(this_time, payload, 0x0E + profile)
+            this_time -= 144 * self.spi_min_time
+        return 0
+
+    def select_profile(self, seq_time, profile):
+        """ Switches the output to a preloaded profile by setting the three profile pins in one transition.
+
+            :param seq_time: time at which the profile is selected
+            :type seq_time: float
+            :param profile: profile number (0-7)
+            :type profile: int
+            :rtype: float
+            :return: elapsed time (1 digital transition)
+            """
+        if self.AD9910_profile_pins is None:
+            raise ValueError("AD9910 select_profile: no profile pins given")
+        if not 0 <= profile <= 7:
+            raise ValueError("AD9910 select_profile: profile must be between 0 and 7")
+        channel_select = 0
+        state = 0
+        for bit, pin in enumerate(self.AD9910_profile_pins):
+            channel_select |= (1 << pin)
+            state |= ((profile >> bit) & 1) << pin
+        ew.set_digital_state(seq_time, self.AD9910_connector2, channel_select, channel_select, state)
+        return self.spi_min_time
+
+    def ram_words(self, values, destination):
+        """ Packs a waveform into 32 bit RAM words for the given playback destination. Vectorized over values.
+
+            :param values: frequencies (Hz), phases (rad) or amplitudes (fraction of full scale, 0 to 1). For polar
+                destination, an (N, 2) array of (phase, amplitude) pairs.
+            :type values: list [float] or numpy.ndarray
+            :param destination: RAM playback destination ('frequency', 'phase', 'amplitude' or 'polar')
+            :type destination: str
+            :rtype: numpy.ndarray
+            :return: RAM words (uint32)
+            """
+        values = np.asarray(values, dtype=float)
+        if destination == 'frequency':
+            words = np.round((1 << 32) * values / self._AD9910_sys_clock)
+            if np.any(words < 0) or np.any(words > 0xFFFFFFFF):
+                raise ValueError("AD9910 ram_words: frequency out of range")
+            return words.astype(np.uint32)
+        if destination == 'phase':
+            pow_words = np.round(values / (2 * np.pi) * (1 << 16)).astype(np.int64) & 0xFFFF
+            return (pow_words << 16).astype(np.uint32)
+        if destination == 'amplitude':
+            if np.any(values < 0) or np.any(values > 1):
+                raise ValueError("AD9910 ram_words: amplitude must be between 0 and 1")
+            asf_words = np.round(values * 0x3FFF).astype(np.int64)
+            return (asf_words << 18).astype(np.uint32)
+        if destination == 'polar':
+            if values.ndim != 2 or values.shape[1] != 2:
+                raise ValueError("AD9910 ram_words: polar values must be (phase, amplitude) pairs")
+            if np.any(values[:, 1] < 0) or np.any(values[:, 1] > 1):
+                raise ValueError("AD9910 ram_words: amplitude must be between 0 and 1")
+            pow_words = np.round(values[:, 0] / (2 * np.pi) * (1 << 16)).astype(np.int64) & 0xFFFF
+            asf_words = np.round(values[:, 1] * 0x3FFF).astype(np.int64)
+            return ((pow_words << 16) | (asf_words << 2)).astype(np.uint32)
+        raise ValueError("AD9910 ram_words: unknown destination " + str(destination))
+
+    def ram_upload(self, dds_time, words, destination, step_time, profile=0, start_address=0, mode='ramp_up'):
+        """ Writes a waveform into the on-chip RAM and arms RAM playback. Writes the RAM profile register, the RAM
+        words and the RAM enable bit in CFR1. The RAM enable is left in the buffer, so the next IO update (see
+        ram_playback) starts playback. The profile pins must select the given profile during the upload and playback
+        (see select_profile).
+
+        Every word is a serial write, so upload long waveforms during idle time: the write finishes at dds_time and
+        starts 16*(4*len(words)+1)*spi_min_time earlier (about 66 ms for the full 1024 words).
+
+            :param dds_time: time at which the upload is finished
+            :type dds_time: float
+            :param words: RAM words, e.g. from ram_words
+            :type words: numpy.ndarray
+            :param destination: RAM playback destination ('frequency', 'phase', 'amplitude' or 'polar')
+            :type destination: str
+            :param step_time: time spent on each RAM address during playback (s)
+            :type step_time: float
+            :param profile: RAM profile (0-7) holding the address range
+            :type profile: int
+            :param start_address: first RAM address of the waveform
+            :type start_address: int
+            :param mode: RAM profile mode ('direct', 'ramp_up', 'bidirectional', 'continuous_bidirectional' or
+                'continuous_recirculate')
+            :type mode: str
+            :rtype: int
+            :return: 0 (effective elapsed time)
+            """
+        words = np.asarray(words, dtype=np.uint32)
+        n_words = len(words)
+        end_address = start_address + n_words - 1
+        if n_words == 0 or start_address < 0 or end_address > 1023:
+            raise ValueError("AD9910 ram_upload: waveform does not fit in the 1024 word RAM")
+        if not 0 <= profile <= 7:
+            raise ValueError("AD9910 ram_upload: profile must be between 0 and 7")
+        if destination not in self._AD9910_ram_destinations:
+            raise ValueError("AD9910 ram_upload: unknown destination " + str(destination))
+        if mode not in self._AD9910_ram_modes:
+            raise ValueError("AD9910 ram_upload: unknown mode " + str(mode))
+        # address step rate: each address lasts 4 * step_rate system clock cycles
+        step_rate = round(step_time * self._AD9910_sys_clock / 4)
+        if step_rate < 1 or step_rate > 0xFFFF:
+            raise ValueError("AD9910 ram_upload: step time out of range")
+
+        # RAM profile: [55:40] step rate, [39:30] end address, [23:14] start address, [2:0] mode
+        profile_word = (step_rate << 40) | (end_address << 30) | (start_address << 14) | \
+            self._AD9910_ram_modes[mode]
+        payload0 = struct.pack('>Q', profile_word)
+        # CFR1: [31] RAM enable, [30:29] playback destination
+        payload1 = struct.pack('>L', (1 << 31) | (self._AD9910_ram_destinations[destination] << 29))
+        payload2 = words.astype('>u4').tobytes()
+
+        # sequence proceeds backwards from dds_time: RAM enable, RAM words, update, RAM profile
+        this_time = dds_time
+        self._spi(this_time, payload1, 0x00)
+        this_time -= 80 * self.spi_min_time
+        self._spi_bulk(this_time, payload2, 0x16)
+        this_time -= 16 * (len(payload2) + 1) * self.spi_min_time
+        this_time -= 2 * self.spi_min_time
+        self._update_output(this_time)
+        self._spi(this_time, payload0, 0x0E + profile)
+        return 0
+
+    def ram_playback(self, dds_time):
+        """ Starts playback of the waveform armed by ram_upload with a single IO update.
+
+            :param dds_time: time at which playback starts
+            :type dds_time: float
+            :rtype: float
+            :return: elapsed time (update pulse)
+            """
+        t = self._update_output(dds_time)
+        return t
+
+    def ram_disable(self, dds_time):
+        """ Clears the RAM enable bit in CFR1, returning the DDS to single tone output.
+
+            :param dds_time: time at which RAM playback stops
+            :type dds_time: float
+            :rtype: int
+            :return: 0
+            """
+        this_time = dds_time
+        self._spi(this_time, struct.pack('>L', 0), 0x00)
         self._update_output(this_time)
         return 0
 
 
 class AD5372(PeripheralBoard):
+    # frames are framed by the sync pin, which is written directly
+    _spi_schedulable = False
+
     def __init__(self, connector, io_pin, serial_clock_pin, sync_pin, ldac_pin):
         """Serial communication with an AD5372 DAC eval board.
 
@@ -879,6 +1612,7 @@ class AD5372(PeripheralBoard):
         self.v_offset = 4
         self.v_ref = 3
 
+    @ew_profile.profiled
     def _spi_sync(self, spi_time, bytes_to_write, register):
         """Write information in bytes_to_write to command register. Parent _spi method, but sets sync_pin low before
         writing.
@@ -966,6 +1700,74 @@ class AD5372(PeripheralBoard):
         ew.set_digital_state(this_time, self.connector, channel_select, out_enable, state)
         return 2 * self.spi_min_time
 
+    def _volts_to_codes(self, volts):
+        """Vectorized _volts_to_code
+
+        :param volts: desired voltages
+        :type volts: numpy.ndarray
+        :rtype: numpy.ndarray
+        :return: DAC_CODEs (uint16)
+        """
+        codes = np.trunc(0.5 + 65536.0 * (np.asarray(volts, dtype=float) + self.v_offset) / (4 * self.v_ref))
+        if np.any(codes > 0xFFFF) or np.any(codes < 0):
+            warnings.warn("AD5372 voltage out of range, using max voltage")
+            codes = np.clip(codes, 0, 0xFFFF)
+        return codes.astype(np.uint16)
+
+    def load_many(self, spi_time, voltages):
+        """Loads voltages for several channels and applies them together with a single LDAC pulse. The frames (each
+        with its own SYNC pulse) are written back-to-back, finishing at spi_time, and queued with one call to
+        set_digital_states. LDAC is held high during the burst and pulsed low right after it.
+
+        :param spi_time: Time to finish writing
+        :type spi_time: float
+        :param voltages: output voltage for each channel
+        :type voltages: dict {int: float}
+        :rtype: float
+        :return: effective elapsed time (3*min time)
+        """
+        if len(voltages) == 0:
+            raise ValueError("AD5372 load_many: no channels")
+        channels = np.array(sorted(voltages), dtype=np.uint8)
+        if np.any(channels > 31):
+            raise ValueError("AD5372 load_many: channel out of range")
+        codes = self._volts_to_codes([voltages[chan] for chan in channels])
+
+        # 0xC0 selects X1 register, 0x08 + chan addresses channel; 16 bits of data
+        frame_bytes = np.empty((len(channels), 3), dtype=np.uint8)
+        frame_bytes[:, 0] = 0xC0 + 0x08 + channels
+        frame_bytes[:, 1] = codes >> 8
+        frame_bytes[:, 2] = codes & 0xFF
+        n_frames = len(channels)
+
+        # each frame: SYNC low, 48 data/clock states, SYNC high. The SYNC high ending one frame also precedes the next
+        data_mask = (1 << self.io_pin) | (1 << self.serial_clock_pin)
+        sync_mask = 1 << self.sync_pin
+        frame_length = 50
+        data_states = _spi_bit_states(frame_bytes.tobytes(), self.io_pin, self.serial_clock_pin).reshape(n_frames, 48)
+        states = np.zeros((n_frames, frame_length), dtype=np.uint32)
+        masks = np.full((n_frames, frame_length), data_mask, dtype=np.uint32)
+        states[:, 1:49] = data_states
+        masks[:, 0] = sync_mask
+        masks[:, 49] = sync_mask
+        states[:, 49] = sync_mask
+
+        n_states = n_frames * frame_length
+        times = spi_time - self.spi_min_time * np.arange(n_states, 0, -1)
+        # leading SYNC high and LDAC held high before the burst
+        times = np.concatenate(([times[0] - self.spi_min_time, times[0] - self.spi_min_time], times))
+        masks = np.concatenate(([sync_mask, 1 << self.ldac_pin], masks.ravel()))
+        states = np.concatenate(([sync_mask, 1 << self.ldac_pin], states.ravel()))
+        ew.set_digital_states(times, self.connector, masks, masks, states)
+
+        # single LDAC pulse updates all channels at once
+        channel_select = (1 << self.ldac_pin)
+        ew.set_digital_state(spi_time + self.spi_min_time, self.connector, channel_select, channel_select,
+                             0 << self.ldac_pin)
+        ew.set_digital_state(spi_time + 2 * self.spi_min_time, self.connector, channel_select, channel_select,
+                             1 << self.ldac_pin)
+        return 3 * self.spi_min_time
+
     def set(self, spi_time, channel, voltage):
         """Updates output of channel to be voltage immediately.
 
@@ -1000,6 +1802,46 @@ def reverse_bits(num, bit_size):
     return int(reverse, 2)
 
 
+# y (3 bit) and x (4 bit) addresses are sent LSB first
+_reversed_y_address = [reverse_bits(num, 3) for num in range(8)]
+_reversed_x_address = [reverse_bits(num, 4) for num in range(16)]
+
+# command waveforms shared by all XPSwitch objects on the same lines
+_xp_waveforms = {}
+
+
+def _xp_command_waveforms(serial_data, serial_clock, serial_strobe, crosspoint_strobe):
+    """Digital transitions of every 10 bit cross-point switch command, relative to the command time in units of the
+    clock increment. Edges at the same time are merged into one transition.
+
+    :rtype: tuple
+    :return: offsets (23,), masks (23,) and states (1024, 23)
+    """
+    key = (serial_data, serial_clock, serial_strobe, crosspoint_strobe)
+    if key in _xp_waveforms:
+        return _xp_waveforms[key]
+
+    data = 1 << serial_data
+    clock = 1 << serial_clock
+    strobes = (1 << serial_strobe) | (1 << crosspoint_strobe)
+    commands = np.arange(1024, dtype=np.uint32)
+
+    # each bit (LSB first): data with clock low, then clock high
+    offsets = np.concatenate((np.arange(-21, -1), [-1, 0, 1])).astype(float)
+    masks = np.concatenate((np.tile([data | clock, clock], 10), [1 << serial_strobe, 1 << crosspoint_strobe,
+                                                                   strobes | data | clock])).astype(np.uint32)
+    states = np.zeros((1024, 23), dtype=np.uint32)
+    for bit in range(10):
+        states[:, 2 * bit] = ((commands >> bit) & 1) << serial_data
+        states[:, 2 * bit + 1] = clock
+    # serial strobe high, cross-point strobe high, then everything low
+    states[:, 20] = 1 << serial_strobe
+    states[:, 21] = 1 << crosspoint_strobe
+
+    _xp_waveforms[key] = (offsets, masks, states)
+    return _xp_waveforms[key]
+
+
 class XPSwitch:
     def __init__(self, channel_dictionary):
         """Control cross-point switch used as master feed-forward
@@ -1013,39 +1855,55 @@ class XPSwitch:
         self.serial_clock = channel_dictionary["clock"]
         self.serial_data = channel_dictionary["io"]
         self.crosspoint_strobe = channel_dictionary["crosspoint_strobe"]
+        self._offsets, self._masks, self._states = _xp_command_waveforms(self.serial_data, self.serial_clock,
+                                                                         self.serial_strobe, self.crosspoint_strobe)
 
-    def _write_command(self, spi_time, command):
-        this_time = spi_time - 21 * self.clock_inc
-        for bit in range(10):
-            state = (command >> bit) & 1
-            ew.set_digital_state(this_time, self.connector, 1 << self.serial_data, 1 << self.serial_data,
-                                 state << self.serial_data)
-            ew.set_digital_state(this_time, self.connector, 1 << self.serial_clock, 1 << self.serial_clock,
-                                 0 << self.serial_clock)
-            this_time += self.clock_inc
-            ew.set_digital_state(this_time, self.connector, 1 << self.serial_clock, 1 << self.serial_clock,
-                                 1 << self.serial_clock)
-            this_time += self.clock_inc
-
-        ew.set_digital_state(this_time, self.connector, 1 << self.serial_strobe, 1 << self.serial_strobe,
-                             1 << self.serial_strobe)
-        this_time += self.clock_inc
-
-        ew.set_digital_state(this_time, self.connector, 1 << self.crosspoint_strobe, 1 << self.crosspoint_strobe,
-                             1 << self.crosspoint_strobe)
-        this_time += self.clock_inc
-
-        ew.set_digital_state(this_time, self.connector, 1 << self.serial_strobe, 1 << self.serial_strobe,
-                             0 << self.serial_strobe)
-        ew.set_digital_state(this_time, self.connector, 1 << self.crosspoint_strobe, 1 << self.crosspoint_strobe,
-                             0 << self.crosspoint_strobe)
-        ew.set_digital_state(this_time, self.connector, 1 << self.serial_clock, 1 << self.serial_clock,
-                             0 << self.serial_clock)
-        ew.set_digital_state(this_time, self.connector, 1 << self.serial_data, 1 << self.serial_data,
-                             0 << self.serial_data)
+    def _emit_commands(self, times, commands):
+        """Writes several commands with a single call to set_digital_states, using the cached command waveforms.
 
+        :param times: command times (cross-point strobe)
+        :type times: list [float]
+        :param commands: 10 bit commands
+        :type commands: list [int]
+        :rtype: int
+        :return: 0
+        """
+        times = np.asarray(times, dtype=float)
+        seq_times = (times[:, np.newaxis] + self._offsets[np.newaxis, :] * self.clock_inc).ravel()
+        states = self._states[np.asarray(commands, dtype=np.intp)].ravel()
+        masks = np.tile(self._masks, len(times))
+        bus = spibus.active_bus()
+        if bus is not None:
+            # commands are not movable, but are checked for overlaps and merged with other frames
+            chip = (self.connector, self.serial_data, self.serial_clock)
+            for i in range(len(times)):
+                rows = slice(i * len(self._offsets), (i + 1) * len(self._offsets))
+                bus.submit_fixed(chip, self.connector, seq_times[rows], masks[rows], states[rows], self.clock_inc)
+            return 0
+        ew.set_digital_states(seq_times, self.connector, masks, masks, states)
         return 0
 
+    def _write_command(self, spi_time, command):
+        return self._emit_commands([spi_time], [command])
+
+    def _switch_commands(self, spi_time, y_address, old_x_address, new_x_address):
+        # command times and commands of a single switch
+        if (y_address < 0) or (y_address > 7):
+            raise ValueError("XPSwitch y_address out of range")
+        if new_x_address < 0 or new_x_address > 15:
+            raise ValueError("XPSwitch new x_address out of range")
+
+        times = []
+        commands = []
+        if (old_x_address >= 0) and (old_x_address <= 15):
+            times.append(spi_time - 23 * self.clock_inc)
+            commands.append((_reversed_y_address[y_address] << 7) | (_reversed_x_address[old_x_address] << 3) |
+                            (0 << 2) | (1 << 1) | 0)
+        times.append(spi_time)
+        commands.append((_reversed_y_address[y_address] << 7) | (_reversed_x_address[new_x_address] << 3) |
+                        (1 << 2) | (1 << 1) | 0)
+        return times, commands
+
     def switch(self, spi_time, y_address, old_x_address, new_x_address):
         """Switches output at y_address from old x to new x.
 
@@ -1062,23 +1920,29 @@ class XPSwitch:
         :raise: ValueError if y_address not between 0 and 7
         :raise: ValueError if new_x_address not between 0 and 15
         """
+        times, commands = self._switch_commands(spi_time, y_address, old_x_address, new_x_address)
+        self._emit_commands(times, commands)
+        return 46 * self.clock_inc
 
-        if (y_address < 0) or (y_address > 7):
-            raise ValueError("XPSwitch y_address out of range")
-        if new_x_address < 0 or new_x_address > 15:
-            raise ValueError("XPSwitch new x_address out of range")
-
-        this_time = spi_time - 23 * self.clock_inc
-
-        if (old_x_address >= 0) and (old_x_address <= 15):
-            command = (reverse_bits(y_address, 3) << 7) | (reverse_bits(old_x_address, 4) << 3) | (0 << 2) | (1 << 1) | 0
-            self._write_command(this_time, command)
-
-        this_time = spi_time
-        command = (reverse_bits(y_address, 3) << 7) | (reverse_bits(new_x_address, 4) << 3) | (1 << 2) | (1 << 1) | 0
-        self._write_command(this_time, command)
+    def switch_many(self, spi_time, switches):
+        """Makes several output reassignments in one burst. The commands are written back-to-back in the order given
+        (each disconnect before its connect), the last one finishing at spi_time.
 
-        return 46 * self.clock_inc
+        :param spi_time: Execution time of the last command (sec)
+        :type spi_time: float
+        :param switches: (y_address, old_x_address, new_x_address) for each output
+        :type switches: list [tuple]
+        :rtype: float
+        :return: effective elapsed time (s), 46 clock increments per switch as for switch
+        :raise: ValueError if a y_address is not between 0 and 7
+        :raise: ValueError if a new_x_address is not between 0 and 15
+        """
+        commands = []
+        for y_address, old_x_address, new_x_address in switches:
+            commands += self._switch_commands(0, y_address, old_x_address, new_x_address)[1]
+        times = spi_time - 23 * self.clock_inc * np.arange(len(commands) - 1, -1, -1)
+        self._emit_commands(times, commands)
+        return 46 * self.clock_inc * len(switches)
 
     def initialize(self, spi_time):
         """Initializes crosspoint switch for use. Sets all outputs to use X address 15
@@ -1089,14 +1953,13 @@ class XPSwitch:
         :return: elapsed time
         """
         time = spi_time
-        self._write_command(time, 3)
+        times = [time]
+        commands = [3]
         time += 0.00023
-        time += self.switch(time, 0, -1, 15)
-        time += self.switch(time, 1, -1, 15)
-        time += self.switch(time, 2, -1, 15)
-        time += self.switch(time, 3, -1, 15)
-        time += self.switch(time, 4, -1, 15)
-        time += self.switch(time, 5, -1, 15)
-        time += self.switch(time, 6, -1, 15)
-        time += self.switch(time, 7, -1, 15)
+        for y_address in range(8):
+            switch_times, switch_commands = self._switch_commands(time, y_address, -1, 15)
+            times += switch_times
+            commands += switch_commands
+            time += 46 * self.clock_inc
+        self._emit_commands(times, commands)
         return time
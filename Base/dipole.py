@@ -1,4 +1,5 @@
 from Base.timing import Sequence
+from Base.scan import scan_points
 from functools import partial
 from Base.constants import *
 import Base.outputwrappers as out
@@ -68,6 +69,22 @@ class DipoleBeam(Sequence):
         self.comp_ramp = out.AnalogRamp(board=ch.dipole_servo["connector"], channel=ch.dipole_servo["channel"],
                                         val_start=pow1, val_end=pow2, total_time=compress_time, a=10)
 
+    @classmethod
+    def scan(cls, **parameters):
+        """One DipoleBeam per point of a scan, with the ramp tables of all points computed together (see
+        outputwrappers.RampBatch) rather than once per shot. Parameters given as sequences are scanned, see
+        scan.scan_points:
+
+            beams = DipoleBeam.scan(depth_low=np.linspace(1500, 1900, 50)*mW, tau=5*sec)
+
+        :rtype: list
+        :return: DipoleBeam for each point, in order
+        """
+        beams = [cls(**point) for point in scan_points(**parameters)]
+        for name in ('ramp', 'on_ramp', 'comp_ramp'):
+            out.RampBatch([getattr(beam, name) for beam in beams])
+        return beams
+
     @Sequence._update_time
     def on(self, seq_time):
         """Sets laser on to zero power. Start AD9959 outputting 80MHz and gets servo loop ready to turn on.
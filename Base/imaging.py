@@ -32,7 +32,7 @@ class ImageRepeat(Sequence):
     # probe time 0.044ms
     @Sequence._update_time
     def norm(self, seq_time):
-        Comm.seq_info["rawmode"] = 'normal'
+        Comm.set_info("rawmode", 'normal')
         img = DoImage(self.repump_time, self.detune)
         self.abs(-1.5*ms, self.ag.off)
         self.abs(5*ms, self.img_coil.off)
@@ -50,7 +50,7 @@ class ImageRepeat(Sequence):
         :rtype: float
         :return: elapsed time
         """
-        Comm.seq_info["rawmode"] = 'normal'
+        Comm.set_info("rawmode", 'normal')
         img = DoImage(self.repump_time, self.detune)
         self.abs(-1.5 * ms, self.ag.off)
         self.abs(5 * ms, self.img_coil.off)
@@ -69,8 +69,8 @@ class DoImage(Sequence):
         self.detune = detune_repump
         self.tuning = Repump()
         self.image = ImageF1(self.probe_time, self.repump_time)
-        Comm.seq_info["repump_time"] = repump_time/us
-        Comm.seq_info["detune_repump"] = detune_repump
+        Comm.set_info("repump_time", repump_time/us)
+        Comm.set_info("detune_repump", detune_repump)
         # self.test_on = partial(out.digital_out, connector=2, channel=16, state=1)
         # self.test_off = partial(out.digital_out, connector=2, channel=16, state=0)
 
@@ -141,7 +141,7 @@ class ImageF1(Sequence):
         self.test_on = partial(out.digital_out, connector=3, channel=7, state=1)
         self.test_off = partial(out.digital_out, connector=3, channel=7, state=0)
 
-    @Sequence._update_time
+    @Sequence._relocatable
     def pulse(self, seq_time):
         # self.abs(-3*ms, self.test_on)
         # self.abs(0.00, self.test_off)
@@ -156,7 +156,7 @@ class ImageF1(Sequence):
         self.abs(self.probe_time, laser.ProbeAOM.off)
         self.abs(self.probe_time)
 
-    @Sequence._update_time
+    @Sequence._relocatable
     def background(self, seq_time):
         self.abs(-3.00 * ms, out.trigger_camera)
         if self.repump_time > 0:
@@ -1,5 +1,6 @@
 from functools import partial
-from Base.timing import Sequence
+from Base.timing import Sequence, TimedEffect, record_effect, timed_lookup
+from Base.statetracker import StateTracker
 from Base.constants import *
 import Entangleware.ew_link as ew
 import Base.outputwrappers as out
@@ -12,12 +13,57 @@ import MidLevelSeq.DipoleTrap as Trap
 r_bias = 0.0100
 r_pinch = 0.0061
 
-# variables to keep track of which coils are on, passed to the release sequences for appropriate handling
-img_on = False
-bias_on = False
-pinch_on = False
-ag_on = False
- 
+# which coils are on, as a function of sequence time, so release sequences can handle each coil appropriately at their
+# own time. Kept per build context (ew_link.BuildContext), see coil_state. The module attributes (mag.pinch_on) give the
+# state after the last change recorded, see __getattr__
+_coil_flags = ('img_on', 'bias_on', 'pinch_on', 'ag_on')
+
+
+def _coils():
+    return ew.current_context().local('magnetics.coils', lambda: StateTracker(dict.fromkeys(_coil_flags, False)))
+
+
+def _coil_state_at(seq_time):
+    return _coils().state_at(seq_time)
+
+
+def coil_state(seq_time):
+    """Which coils are on at seq_time of the sequence being built, e.g. coil_state(seq_time)['pinch_on']. Goes through
+    timed_lookup so incremental builds know the steps reading it.
+
+    :param seq_time: sequence time
+    :type seq_time: float
+    :rtype: dict
+    :return: {'img_on': bool, 'bias_on': bool, 'pinch_on': bool, 'ag_on': bool}
+    """
+    return timed_lookup(_coil_state_at, seq_time)
+
+
+def __getattr__(name):
+    if name in _coil_flags:
+        return coil_state(float('inf'))[name]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+def _assign_coil(flag_time, name, value):
+    _coils().set(name, flag_time, value)
+
+
+_set_coil = TimedEffect(_assign_coil)
+
+
+def _set_flag(name, flag_time, value):
+    """Records that a coil turns on or off. Goes through record_effect so relocatable sequences replay it.
+
+    :param name: 'img_on', 'bias_on', 'pinch_on' or 'ag_on'
+    :type name: str
+    :param flag_time: sequence time the coil turns on or off
+    :type flag_time: float
+    :param value: new state
+    :type value: bool
+    """
+    record_effect(_set_coil, flag_time, name, value)
+
 
 def pinch_setpoint(i):
     """ Converts pinch current to servo loop setpoint voltage (calibrated to hall probe monitor)
@@ -378,7 +424,7 @@ class CartQP(Sequence):
         self.servo_ramp = out.AnalogRamp(board=ch.cart_servo["connector"], channel=ch.cart_servo["channel"],
                                          val_start=servo0, val_end=servo1, total_time=ramp_time)
 
-    @Sequence._update_time
+    @Sequence._relocatable
     def on(self, seq_time):
         """ Turns Cart QP on high to trap atoms (set point 7)
 
@@ -517,7 +563,6 @@ class AGCoil(Sequence):
         :rtype: float
         :return: elapsed time
         """
-        global ag_on
         if self.change:
             if self.volt_ramp:
                 if self.increasing:
@@ -529,10 +574,11 @@ class AGCoil(Sequence):
         else:
             self.abs(self.tt)
 
+        # off once the ramp has ended, on from its start
         if self.final_off:
-            ag_on = False
+            _set_flag('ag_on', seq_time + self.tt, False)
         else:
-            ag_on = True
+            _set_flag('ag_on', seq_time, True)
 
     @Sequence._update_time
     def snap_on(self, seq_time):
@@ -549,8 +595,7 @@ class AGCoil(Sequence):
         self.abs(-1*ms, self.switch_on)
         self.abs(0.00, self.servo0)
 
-        global ag_on
-        ag_on = True
+        _set_flag('ag_on', seq_time, True)
 
     @Sequence._update_time
     def pulse1(self, seq_time):
@@ -606,8 +651,7 @@ class AGCoil(Sequence):
         self.abs(1*ms, self.servo_off)
         self.abs(1*ms, self.supply_off)
         self.abs(5*ms, polarity_normal)
-        global ag_on
-        ag_on = False
+        _set_flag('ag_on', seq_time, False)
 
 
 # sequences to ramp the pinch, bias, or both. The pinch servo oscillates under 4A, and the bias servo oscillates
@@ -727,8 +771,8 @@ class PinchBiasSet(Sequence):
 
     @Sequence._update_time
     def snap_on(self, seq_time):
-        """Snaps Pinch and/or Bias on to currents ip0 and ib0. Checks which coils are turning on, and updates global
-        flags appropriately.
+        """Snaps Pinch and/or Bias on to currents ip0 and ib0. Checks which coils are turning on, and updates coil
+        states appropriately.
 
         :param seq_time: execution time
         :type seq_time: float
@@ -736,27 +780,25 @@ class PinchBiasSet(Sequence):
         :return: elapsed time (2us analog out)
         """
 
-        global bias_on
-        global pinch_on
         # set the supply voltage
         self.abs(-100 * ms, self.v_out0)
         if self.pinch_start_on:
             # set the servo to analog control and set servo voltage
             self.abs(-1 * ms, self.pinch_dig_on)
             self.abs(0.00, self.pinch_out0)
-            pinch_on = True
+            _set_flag('pinch_on', seq_time, True)
         else:
             # make sure servo is off
             self.abs(0.00, self.pinch_dig_off)
-            pinch_on = False
+            _set_flag('pinch_on', seq_time, False)
         if self.bias_start_on:
             # set servo to analog control and set servo voltage
             self.abs(-1*ms, self.bias_dig_on)
             self.abs(0.00, self.bias_out0)
-            bias_on = True
+            _set_flag('bias_on', seq_time, True)
         else:
             self.abs(0.00, self.bias_dig_off)
-            bias_on = False
+            _set_flag('bias_on', seq_time, False)
 
         # update current supply voltage and setpoints
         self.current_values = self.values0
@@ -771,11 +813,9 @@ class PinchBiasSet(Sequence):
         :return: Elapsed time (total_time)
         """
 
-        # update on/off flags based on final currents
-        global pinch_on
-        global bias_on
-        pinch_on = False if self.pinch1_off else True
-        bias_on = False if self.bias1_off else True
+        # update on/off flags based on final currents: off once the ramp has ended, on from its start
+        _set_flag('pinch_on', seq_time + self.total_time if self.pinch1_off else seq_time, not self.pinch1_off)
+        _set_flag('bias_on', seq_time + self.total_time if self.bias1_off else seq_time, not self.bias1_off)
 
         # update current supply voltage and setpoints
         self.current_values = self.values1
@@ -815,10 +855,8 @@ class PinchBiasSet(Sequence):
         :rtype: float
         :return: elapsed time (1us)
         """
-        global bias_on
-        global pinch_on
-        pinch_on = False if self.pinch1_off else True
-        bias_on = False if self.bias1_off else True
+        _set_flag('pinch_on', seq_time, not self.pinch1_off)
+        _set_flag('bias_on', seq_time, not self.bias1_off)
 
         # update current supply voltage and setpoints
         self.current_values = self.values1
@@ -886,6 +924,7 @@ class PinchBiasSet(Sequence):
             self.abs(0.1*ms, bias_servo_ramp.linear)
             self.rel(0.00, bias_servo_negative)
         self.rel(0.00, [self.pinch_dig_off, self.bias_dig_off])
+        servos_off = self.current_time
         self.abs(10.1 * ms, supply_ramp.linear)
 
         # clean up
@@ -893,10 +932,8 @@ class PinchBiasSet(Sequence):
         self.abs(19.7 * ms, self.bias_servo_zero)
         self.abs(19.7 * ms, self.supply_off)
 
-        global pinch_on
-        pinch_on = False
-        global bias_on
-        bias_on = False
+        _set_flag('pinch_on', servos_off, False)
+        _set_flag('bias_on', servos_off, False)
 
     @Sequence._update_time
     def off_qp(self, seq_time):
@@ -923,10 +960,8 @@ class PinchBiasSet(Sequence):
         self.abs(19.7*ms, self.bias_servo_zero)
         self.abs(19.7*ms, self.supply_off)
 
-        global pinch_on
-        pinch_on = False
-        global bias_on
-        bias_on = False
+        _set_flag('pinch_on', seq_time + 10*ms, False)
+        _set_flag('bias_on', seq_time + 1*ms, False)
 
     @Sequence._update_time
     def clean_up(self, seq_time):
@@ -943,10 +978,8 @@ class PinchBiasSet(Sequence):
         self.abs(10*ms, self.bias_servo_zero)
         self.abs(10*ms, self.supply_off)
 
-        global pinch_on
-        pinch_on = False
-        global bias_on
-        bias_on = False
+        _set_flag('pinch_on', seq_time, False)
+        _set_flag('bias_on', seq_time, False)
 
     @Sequence._update_time
     def clean_up_fast(self, seq_time):
@@ -963,18 +996,15 @@ class PinchBiasSet(Sequence):
         self.abs(1*ms, self.bias_servo_zero)
         self.abs(1*ms, self.supply_off)
 
-        global pinch_on
-        pinch_on = False
-        global bias_on
-        bias_on = False
+        _set_flag('pinch_on', seq_time, False)
+        _set_flag('bias_on', seq_time, False)
 
 
 # Sequences to change just bias coil (assumes pinch is off). Same as PinchBiasSet, just without Pinch
 class BiasSet(Sequence):
     def __init__(self, total_time, ib0, ib1=0, sig_a=1, exp_tau=1.5*ms):
         super().__init__()
-        global pinch_on
-        if pinch_on:
+        if coil_state(float('inf'))['pinch_on']:
             raise ValueError('Pinch is on. Use PinchBiasSet')
         # check current values
         if ib0 < 0 or ib1 < 0:
@@ -1039,8 +1069,7 @@ class BiasSet(Sequence):
         self.abs(10*ms, self.supply_off_ramp.linear)
         self.abs(self.tt)
 
-        global bias_on
-        bias_on = False
+        _set_flag('bias_on', seq_time + self.tt, False)
 
     # ramps from current ib0 to ib1
     @Sequence._update_time
@@ -1111,8 +1140,7 @@ class BiasSet(Sequence):
         self.abs(10 * ms, self.supply_off_ramp.linear)
         self.abs(self.tt)
 
-        global bias_on
-        bias_on = False
+        _set_flag('bias_on', seq_time + self.tt, False)
 
     # snaps on to current ib1
     @Sequence._update_time
@@ -1120,8 +1148,7 @@ class BiasSet(Sequence):
         self.abs(-50 * ms, self.v_snap)
         self.abs(-1 * ms, self.dig_ctl)
         self.abs(0.00, self.ang1)
-        global bias_on
-        bias_on = True
+        _set_flag('bias_on', seq_time, True)
 
     # snaps off
     @Sequence._update_time
@@ -1129,8 +1156,7 @@ class BiasSet(Sequence):
         self.abs(-1 * ms, self.dig_ctl)
         self.abs(0.00, self.ang_off)
         self.abs(10 * ms, self.v_off)
-        global bias_on
-        bias_on = False
+        _set_flag('bias_on', seq_time, False)
 
 
 class ImagingCoil(Sequence):
@@ -1172,8 +1198,7 @@ class ImagingCoil(Sequence):
         """
         self.abs(-5 * ms, self.servo_on)
         self.abs(0.00, self.trigger_on)
-        global img_on
-        img_on = True
+        _set_flag('img_on', seq_time, True)
 
     @Sequence._update_time
     def off(self, seq_time):
@@ -1186,8 +1211,7 @@ class ImagingCoil(Sequence):
         """
         self.abs(0.00, self.trigger_off)
         self.abs(5*ms, self.servo_off)
-        global img_on
-        img_on = False
+        _set_flag('img_on', seq_time, False)
 
     @Sequence._update_time
     def on_low(self, seq_time):
@@ -1200,8 +1224,7 @@ class ImagingCoil(Sequence):
         """
         self.abs(-5 * ms, self.servo_on_low)
         self.abs(0.00, self.trigger_on)
-        global img_on
-        img_on = True
+        _set_flag('img_on', seq_time, True)
 
     @Sequence._update_time
     def low(self, seq_time):
@@ -1213,8 +1236,7 @@ class ImagingCoil(Sequence):
         :return: elapsed time (2us)
         """
         self.abs(0.00, self.servo_on_low)
-        global img_on
-        img_on = True
+        _set_flag('img_on', seq_time, True)
 
     # imaging coil already on, just needs to be turned up high (Imaging_Coil_On2 in old sequencer)
     @Sequence._update_time
@@ -1227,8 +1249,7 @@ class ImagingCoil(Sequence):
         :return: elapsed time (2us)
         """
         self.abs(0.00, self.servo_on)
-        global img_on
-        img_on = True
+        _set_flag('img_on', seq_time, True)
 
     @Sequence._update_time
     def ramp(self, seq_time):
@@ -1241,5 +1262,4 @@ class ImagingCoil(Sequence):
         """
         self.abs(0, self.trigger_on)
         self.abs(0, self.analog_ramp.linear)
-        global img_on
-        img_on = True
+        _set_flag('img_on', seq_time, True)
@@ -357,8 +357,9 @@ def init_laser_locks(seq_time, fmaster, frepump):
 
 def jumpECDLs(seq_time, fmaster, frepump):
     t = 1 * ms
-    lock_dds.arbitrary_output(seq_time, master_channel, [fmaster], [-9 * dBm], t)
-    lock_dds.arbitrary_output(seq_time - 2 * ms, repump_channel, [frepump], [-15 * dBm], t, no_ud=True)
+    # both lock offsets change on the same update pulse
+    lock_dds.multi_channel_output(seq_time, {master_channel: (fmaster, -9 * dBm),
+                                             repump_channel: (frepump, -15 * dBm)})
     return t - 2*ms
 
 
@@ -3,6 +3,7 @@ import Base.channels as ch
 from Entangleware import ew_link as ew
 from Base.constants import *
 import matplotlib.pyplot as plt
+import numpy as np
 
 digital_time_step = 1 * us
 analog_time_step = 2 * us
@@ -120,6 +121,9 @@ def arduino_low(seq_time):
 
 
 class AnalogRamp:
+    # step tables are derived from the parameters and rewritten by every ramp (see timing._state_key)
+    _transient_attributes = ('output_steps', 'time_steps', 'analog_steps', 'batch')
+
     def __init__(self, board, channel, val_start, val_end, total_time, a=0, tau=0):
         """Outputs a series of analog values to create ramps with different trajectories.
         For a given ramp trajectory, calculates when each bit flip in the analog register should occur, and calls
@@ -170,6 +174,16 @@ class AnalogRamp:
         # generate blank lists for the actual analog steps and their corresponding times
         self.time_steps = [None] * self.length
         self.analog_steps = [None] * self.length
+        # RampBatch computing the step tables of this ramp together with others, None to compute them here
+        self.batch = None
+
+    def _output_table(self, kind, t_start):
+        """ outputs the step table of kind computed by self.batch, in one append
+        :return: time duration of ramp (total_time)
+        """
+        base, offsets, values = self.batch.table(self, kind)
+        ew.set_analog_states((t_start + base) + offsets, self.board, self.channel, values)
+        return self.total_time
 
     def _output(self):
         """ iterates through self.time_steps and self.analog_steps, outputting each voltage in self.analog_steps at
@@ -188,6 +202,8 @@ class AnalogRamp:
         :rtype: float
         :return:time duration of ramp (total_time)
         """
+        if self.batch is not None:
+            return self._output_table('linear', t_start)
         # slope of linear ramp
         slope = (self.q_val_end - self.q_val_start) / self.total_time
         # calculate the times and convert the outputs back into voltages
@@ -207,6 +223,8 @@ class AnalogRamp:
         :rtype: float
         :return: time duration of ramp (total_time)
         """
+        if self.batch is not None:
+            return self._output_table('exponential', t_start)
         # find the actual range of the exponential decay and scale things  appropriately
         delta = math.exp(self.total_time / self.tau)
         if delta == 1:
@@ -230,6 +248,8 @@ class AnalogRamp:
         :rtype: float
         :return: time duration of ramp (total_time)
         """
+        if self.batch is not None:
+            return self._output_table('exponential_down', t_start)
         delta = math.exp(self.total_time / self.tau)
         if delta == 1:
             raise ValueError('decay_rate or the time interval is too small')
@@ -251,6 +271,8 @@ class AnalogRamp:
         :rtype: float
         :return: time duration of ramp (total_time)
         """
+        if self.batch is not None:
+            return self._output_table('sigmoidal', t_start)
         stretch = 2 / (1 - math.exp(self.a / 2))
         for index in range(self.length):
             temp1 = ((self.output_steps[index] - self.q_val_start) / (self.q_val_end - self.q_val_start) - stretch / 2)
@@ -264,6 +286,106 @@ class AnalogRamp:
         return self.total_time
 
 
+class RampBatch:
+    def __init__(self, ramps):
+        """Computes the step tables of several AnalogRamps (e.g. the same ramp in every shot of a scan) at once, with
+        one 2-D numpy computation over all ramps and DAC steps instead of a Python loop per ramp, and hands each ramp its
+        row. Each kind of ramp (linear, exponential, ...) is computed for all ramps the first time one of them needs it.
+        Times may differ from those computed by the ramp itself in the last bit.
+
+        :param ramps: ramps sharing the batch (their batch attribute is set)
+        :type ramps: list
+        """
+        self.ramps = list(ramps)
+        self._index = {id(ramp): index for index, ramp in enumerate(self.ramps)}
+        self._tables = {}
+        for ramp in self.ramps:
+            ramp.batch = self
+
+    def table(self, ramp, kind):
+        """Step table of one ramp
+
+        :param ramp: ramp of the batch
+        :type ramp: AnalogRamp
+        :param kind: 'linear', 'exponential', 'exponential_down' or 'sigmoidal'
+        :type kind: str
+        :rtype: tuple
+        :return: (base, offsets, values): the step times are (t_start + base) + offsets, values in volts
+        :raise: ZeroDivisionError or ValueError where the ramp method would (e.g. zero slope or total_time), ValueError
+            if a step time isn't finite
+        """
+        if kind not in self._tables:
+            self._tables[kind] = self._compute(kind)
+        return self._tables[kind][self._index[id(ramp)]]
+
+    def _compute(self, kind):
+        q_start = np.array([ramp.q_val_start for ramp in self.ramps], dtype=float)[:, None]
+        q_end = np.array([ramp.q_val_end for ramp in self.ramps], dtype=float)[:, None]
+        total_time = np.array([ramp.total_time for ramp in self.ramps], dtype=float)[:, None]
+        descending = q_start > q_end + 1
+        first = np.where(descending, q_end + 1, q_start)
+        lengths = np.maximum(np.where(descending, q_start, q_end + 1) - first, 0).astype(int)[:, 0]
+        # DAC steps of every ramp, padded to the longest one (the padding is cut off below)
+        steps = first + np.arange(lengths.max(initial=0))[None, :]
+        valid = np.arange(steps.shape[1])[None, :] < lengths[:, None]
+
+        def check_log(argument):
+            # math.log raises on these in the ramp methods; np.log returns nan or -inf
+            bad = valid & ~(argument > 0)
+            if np.any(bad):
+                raise ValueError('RampBatch: {} ramp {} takes the log of {}'.format(
+                    kind, int(np.argmax(bad.any(axis=1))), argument[bad][0]))
+            return argument
+
+        def check_nonzero(divisor, what):
+            # the ramp methods raise ZeroDivisionError for these, whatever their number of steps
+            zero = np.broadcast_to(divisor == 0, total_time.shape)[:, 0]
+            if np.any(zero):
+                raise ZeroDivisionError('RampBatch: {} ramp {} has zero {}'.format(kind, int(np.argmax(zero)), what))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            base = np.zeros_like(total_time)
+            if kind == 'linear':
+                check_nonzero(total_time, 'total_time')
+                check_nonzero(q_end - q_start, 'slope')
+                slope = (q_end - q_start) / total_time
+                offsets = (steps - q_start) / slope
+            elif kind in ('exponential', 'exponential_down'):
+                tau = np.array([ramp.tau for ramp in self.ramps], dtype=float)[:, None]
+                # per ramp coefficients the same way the ramp computes them
+                delta = np.array([math.exp(ramp.total_time / ramp.tau) for ramp in self.ramps])[:, None]
+                if np.any(delta == 1):
+                    raise ValueError('decay_rate or the time interval is too small')
+                if kind == 'exponential':
+                    alpha = (q_start - q_end) / (1 - delta)
+                    offsets = np.log(check_log((steps - (q_start - alpha)) / alpha)) * tau
+                else:
+                    check_nonzero(q_start - q_end, 'voltage change')
+                    alpha = (delta - 1) / (q_start - q_end)
+                    base = total_time
+                    offsets = -(tau * np.log(check_log(1 + (steps - q_end) * alpha)))
+            elif kind == 'sigmoidal':
+                a = np.array([ramp.a for ramp in self.ramps], dtype=float)[:, None]
+                stretch = np.array([2 / (1 - math.exp(ramp.a / 2)) for ramp in self.ramps])[:, None]
+                check_nonzero(q_end - q_start, 'voltage change')
+                temp1 = (steps - q_start) / (q_end - q_start) - stretch / 2
+                temp2 = (1 - stretch) / temp1 - 1
+                offsets = total_time * (-np.log(check_log(temp2)) / a + 1 / 2)
+            else:
+                raise ValueError('RampBatch: unknown ramp kind {}'.format(kind))
+        bad = valid & ~np.isfinite(offsets)
+        if np.any(bad):
+            raise ValueError('RampBatch: {} ramp {} has non-finite step times'.format(
+                kind, int(np.argmax(bad.any(axis=1)))))
+        values = 20 * steps / (2 ** 16)
+
+        # split per ramp, reversed like the ramp methods do for descending ramps
+        tables = []
+        for index, length in enumerate(lengths):
+            order = slice(length - 1, None, -1) if descending[index, 0] else slice(0, length)
+            tables.append((float(base[index, 0]), offsets[index, :length][order], values[index, :length][order]))
+        return tables
+
 class AnalogOscillate:
     def __init__(self, board, channel, amplitude, offset, frequency, total_time):
         """Outputs a series of analog values on given board and channel to create oscillations centered around offset
@@ -0,0 +1,98 @@
+from Entangleware import ew_link as ew
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy as np
+
+
+def partitions(root, workers):
+    """Splits what the steps below root queued into at most workers partitions: consecutive runs of it in execution
+    order, with about the same number of appends each. Each partition can be emitted and sorted by time on its own;
+    merging the sorted partitions (merge_runs) gives the same result as sorting all transitions, since the order of
+    the partitions decides between equal times.
+
+    :param root: root of the tree, e.g. Timeline.root
+    :type root: ew_link.Segment
+    :param workers: number of partitions at most
+    :type workers: int
+    :rtype: list
+    :return: queued bytes of each partition, in execution order
+    """
+    # walk the tree without nested generators, the same order as root.chunks()
+    chunks = []
+    stack = [iter(root.items)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, ew.Segment):
+                stack.append(iter(item.items))
+                break
+            chunks.append(item)
+        else:
+            stack.pop()
+    bounds = [len(chunks) * k // workers for k in range(workers + 1)]
+    return [chunks[start:stop] for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+def _emit(chunks):
+    # transitions of a partition in their own buffer, sorted by time (stable), and their times as native floats
+    records = np.frombuffer(b''.join(chunks), dtype=ew.wire_dtype)
+    times = records['time'].astype(np.float64)
+    order = np.argsort(times, kind='stable')
+    return records[order], times[order]
+
+
+def _positions(keys, i):
+    # place of each transition of run i in the merged output: its index in the run, plus the transitions of earlier
+    # runs at the same time or before, plus those of later runs strictly before
+    positions = np.arange(len(keys[i]))
+    for j, other in enumerate(keys):
+        if j != i:
+            positions += np.searchsorted(other, keys[i], side='right' if j < i else 'left')
+    return positions
+
+
+def merge_runs(runs, keys, pool=None):
+    """Merges runs of transitions sorted by time (k-way merge). Equal times keep the order of the runs, so runs that
+    follow each other in execution order merge into a stable sort of all of them. Each transition's place is found by
+    binary search (numpy.searchsorted) in the other runs, nothing is sorted again.
+
+    :param runs: transitions of each run, sorted by time (ew_link.wire_dtype)
+    :type runs: list [numpy.ndarray]
+    :param keys: times of each run as native floats
+    :type keys: list [numpy.ndarray]
+    :param pool: executor placing the runs in parallel, in this thread if None
+    :type pool: concurrent.futures.Executor
+    :rtype: numpy.ndarray (ew_link.wire_dtype)
+    """
+    if pool is None:
+        positions = [_positions(keys, i) for i in range(len(runs))]
+    else:
+        positions = list(pool.map(lambda i: _positions(keys, i), range(len(runs))))
+    merged = np.empty(sum(len(run) for run in runs), dtype=ew.wire_dtype)
+    for run, places in zip(runs, positions):
+        merged[places] = run
+    return merged
+
+
+def time_order(root, workers=None):
+    """Transitions below root sorted by time, equal times in execution order (same as a stable sort of
+    root.records() by time). The tree is split into partitions (see partitions), each emitted into its own buffer and
+    sorted in a pool of worker threads, and the sorted runs are merged (see merge_runs).
+
+    Walking the tree holds the GIL and stays serial; joining, sorting and merging run in parallel. The steps
+    themselves executed, in order, while the tree was recorded.
+
+    :param root: root of the tree, e.g. Timeline.root
+    :type root: ew_link.Segment
+    :param workers: worker threads, os.cpu_count() if None
+    :type workers: int
+    :rtype: numpy.ndarray (ew_link.wire_dtype)
+    """
+    workers = workers or os.cpu_count() or 1
+    groups = partitions(root, workers) if workers > 1 else []
+    if len(groups) <= 1:
+        records = root.records()
+        return records[np.argsort(records['time'], kind='stable')]
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        runs, keys = zip(*pool.map(_emit, groups))
+        return merge_runs(runs, keys, pool)
@@ -3,7 +3,9 @@ from Entangleware import ew_link as ew
 from functools import partial
 from Base.constants import *
 from Base.timing import Sequence
+from Base.scan import scan_points
 import math
+import numpy as np
 import Base.outputwrappers as out
 import Base.channels as ch
 
@@ -40,12 +42,13 @@ class RampOff(Sequence):
 
 class RFSweep(Sequence):
     def __init__(self, f_start, f_stop, slope):
+        tt, freq_lists = self.sweep_tables([f_start], [f_stop], [slope])
+        self._setup(f_start, float(tt[0]), freq_lists[0].tolist())
+
+    def _setup(self, f_start, tt, freq_list):
         super().__init__()
-        tt = (f_start - f_stop)/slope
-        num_steps = 5
         power = -18*dBm
-        freq_list = [f_start + (f_stop - f_start)*t/num_steps for t in range(num_steps+1)]
-        pow_list = [power for t in range(num_steps)]
+        pow_list = [power for t in range(len(freq_list) - 1)]
         self.dds = brd.AD9854(ch.ad9854_evap["connector"], ch.ad9854_evap["io"], ch.ad9854_evap["clk"],
                               ch.ad9854_evap["reset"], ch.ad9854_evap["update"], ch.ad9854_evap["ref_clk"],
                               ch.ad9854_evap["ramp_rate_clk"], f_initial=f_start)
@@ -53,6 +56,48 @@ class RFSweep(Sequence):
                              power_list=pow_list)
         self.off = RampOff(power)
 
+    @staticmethod
+    def sweep_tables(f_start, f_stop, slope):
+        """Durations and frequency steps of several sweeps at once (one row per sweep)
+
+        :param f_start: start frequencies (Hz)
+        :type f_start: list
+        :param f_stop: stop frequencies (Hz)
+        :type f_stop: list
+        :param slope: sweep rates (Hz/s)
+        :type slope: list
+        :rtype: tuple
+        :return: (durations, frequency steps): numpy arrays of shape (sweeps,) and (sweeps, steps)
+        """
+        num_steps = 5
+        f_start = np.asarray(f_start, dtype=float)[:, None]
+        f_stop = np.asarray(f_stop, dtype=float)[:, None]
+        slope = np.asarray(slope, dtype=float)[:, None]
+        tt = ((f_start - f_stop) / slope)[:, 0]
+        freq_lists = f_start + (f_stop - f_start) * np.arange(num_steps + 1) / num_steps
+        return tt, freq_lists
+
+    @classmethod
+    def scan(cls, **parameters):
+        """One RFSweep per point of a scan (parameters f_start, f_stop, slope; sequences are scanned, see
+        scan.scan_points), with the sweeps of all points computed together:
+
+            sweeps = RFSweep.scan(f_start=70*MHz, f_stop=40*MHz, slope=np.linspace(1, 2, 50)*MHz/sec)
+
+        :rtype: list
+        :return: RFSweep for each point, in order
+        """
+        points = scan_points(**parameters)
+        tt, freq_lists = cls.sweep_tables([point['f_start'] for point in points],
+                                          [point['f_stop'] for point in points],
+                                          [point['slope'] for point in points])
+        sweeps = []
+        for point, duration, freq_list in zip(points, tt, freq_lists):
+            sweep = cls.__new__(cls)
+            sweep._setup(point['f_start'], float(duration), freq_list.tolist())
+            sweeps.append(sweep)
+        return sweeps
+
     @Sequence._update_time
     def linear(self, seq_time):
         self.abs(-10 * ms, self.dds.chirp_initialize)
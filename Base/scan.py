@@ -0,0 +1,134 @@
+from Entangleware import ew_link as ew
+from Base import timing
+import numpy as np
+
+
+def scan_points(**parameters):
+    """Keyword arguments of every point of a scan: parameters given as sequences are scanned together (all of the same
+    length, or length 1), numbers are shared by all points
+
+        scan_points(depth_low=[1.5, 1.7, 1.9], tau=5.0)
+        # [{'depth_low': 1.5, 'tau': 5.0}, {'depth_low': 1.7, 'tau': 5.0}, {'depth_low': 1.9, 'tau': 5.0}]
+
+    :rtype: list
+    :return: dictionary of parameters for each point, in order
+    """
+    names = list(parameters)
+    try:
+        columns = np.broadcast_arrays(*[np.atleast_1d(np.asarray(parameters[name], dtype=float)) for name in names])
+    except ValueError:
+        raise ValueError("scan_points: scanned parameters must have the same length")
+    if columns and columns[0].ndim != 1:
+        raise ValueError("scan_points: parameters must be numbers or 1-D sequences")
+    count = len(columns[0]) if columns else 0
+    return [{name: column[index].item() for name, column in zip(names, columns)} for index in range(count)]
+
+
+class ScanRunner:
+    def __init__(self, prefix=None, relocate=True):
+        """Builds and runs the variants of a parameter scan, compiling the part they have in common only once. Each
+        variant is recorded in a Timeline (steps unchanged since the previous variant are reused, see
+        timing.IncrementalBuilder); the leading transitions it shares with the previous variant form the prefix, kept
+        as one immutable buffer, and only the rest (the suffix) goes into the sequence buffer. Prefix and suffix are
+        uploaded as they are, one after the other, without being joined:
+
+            runner = ScanRunner()
+            for tof in tofs:
+                ew.build_sequence()
+                variant = dip_test.CrossEvaporation(Param.x_large_bec)
+                variant.tof = tof
+                runner.run(variant.seq)
+
+        Without prefix, the shared part is detected: the longest run of leading transitions (in whole steps) that is
+        the same as in the previous variant. With prefix, it is declared: prefix is executed first (as a step of its
+        own) and each variant step after it, at the time prefix ends. The prefix buffer is compiled again only when it
+        changes.
+
+        :param prefix: step shared by all variants, None to detect the shared prefix
+        :type prefix: callable
+        :param relocate: reuse steps that only moved in time (see timing.Timeline)
+        :type relocate: bool
+        """
+        self.prefix = prefix
+        self.relocate = relocate
+        self.timeline = None
+        # immutable leading transitions of the variant built last, and the chunks of the timeline they were joined from
+        self.prefix_buffer = b''
+        self._prefix_chunks = []
+        self._last_chunks = []
+        self.stats = {'variants': 0, 'prefix_compiles': 0, 'prefix_records': 0, 'suffix_records': 0}
+
+    @staticmethod
+    def _shared(reference, chunks):
+        # number of leading chunks that are the same in both lists
+        count = 0
+        for old, new in zip(reference, chunks):
+            if old is not new and old != new:
+                break
+            count += 1
+        return count
+
+    def build(self, step, start_time=0.0):
+        """Builds one variant: the shared prefix is kept in prefix_buffer, the rest is queued into the sequence buffer
+
+        :param step: top level sequence of the variant (method or function)
+        :type step: callable
+        :param start_time: time to execute step (or the declared prefix)
+        :type start_time: float
+        :rtype: float
+        :return: elapsed time of the variant (including the declared prefix)
+        """
+        with timing.Timeline(previous=self.timeline, relocate=self.relocate) as timeline:
+            elapsed = 0.0
+            if self.prefix is not None:
+                elapsed = timeline.call(self.prefix, start_time)
+            elapsed += timeline.call(step, start_time + elapsed)
+        self.timeline = timeline
+
+        chunks = [chunk for chunk in timeline.root.chunks() if chunk]
+        if self.prefix is not None:
+            count = sum(1 for chunk in timeline.root.children[0].chunks() if chunk)
+        else:
+            count = self._shared(self._last_chunks, chunks)
+        if count != len(self._prefix_chunks) or self._shared(self._prefix_chunks, chunks) != count:
+            # first variants, or a parameter (or register state carried over from the previous shot) reached into the
+            # prefix: compile it again
+            self._prefix_chunks = chunks[:count]
+            self.prefix_buffer = b''.join(self._prefix_chunks)
+            self.stats['prefix_compiles'] += 1
+        self._last_chunks = chunks
+
+        suffix = chunks[count:]
+        if suffix:
+            ew.msgseq.addElement(b''.join(suffix))
+        self.stats['variants'] += 1
+        self.stats['prefix_records'] = len(self.prefix_buffer) // ew.msgseq.lengthpayload
+        self.stats['suffix_records'] = int(ew.msgseq.seqendindex)
+        return elapsed
+
+    def parts(self):
+        """Buffers making up the transitions of the variant built last: the prefix and a view of the sequence buffer
+
+        :rtype: list
+        """
+        length = int(ew.msgseq.seqendindex) * ew.msgseq.lengthpayload
+        return [self.prefix_buffer, memoryview(ew.msgseq.seq)[:length]]
+
+    def records(self):
+        """All transitions of the variant built last, prefix first (a copy, for inspection)
+
+        :rtype: numpy.ndarray (ew_link.wire_dtype)
+        """
+        return np.concatenate([np.frombuffer(self.prefix_buffer, dtype=ew.wire_dtype), ew.msgseq.records()])
+
+    def run(self, step, start_time=0.0):
+        """Builds one variant and runs it, uploading prefix and suffix without joining them
+
+        :param step: top level sequence of the variant (method or function)
+        :type step: callable
+        :param start_time: time to execute step (or the declared prefix)
+        :type start_time: float
+        :return: done message of the Entangleware software
+        """
+        self.build(step, start_time)
+        return ew.run_sequence(prefix=self.prefix_buffer)
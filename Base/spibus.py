@@ -0,0 +1,276 @@
+from Entangleware import ew_link as ew
+from Base import timing
+import bisect
+import math
+import warnings
+import numpy as np
+
+
+def _active_buses():
+    # stack of buses collecting frames in the current build context, the innermost one is active
+    return ew.current_context().local('spibus', list)
+
+
+def active_bus():
+    """Bus currently collecting SPI frames, None if frames are written immediately
+
+    :rtype: SpiBus or None
+    """
+    buses = _active_buses()
+    if buses:
+        return buses[-1]
+    return None
+
+
+class _Frame:
+    def __init__(self, chip, connector, pins, masks, states, deadline, min_time, times=None):
+        self.chip = chip
+        self.connector = connector
+        self.pins = pins
+        self.masks = masks
+        self.states = states
+        self.deadline = deadline
+        self.min_time = min_time
+        # fixed frames keep their own times, movable frames get times when placed
+        self.fixed = times is not None
+        self.times = times
+        self.conflict = False
+
+    @property
+    def start(self):
+        return float(self.times[0])
+
+    @property
+    def end(self):
+        return float(self.times[-1]) + self.min_time
+
+
+class SpiBus:
+    def __init__(self, max_advance=1e-3):
+        """Collects the SPI frames of all peripheral boards while active and writes them when the block exits. Each
+        frame is placed, per connector, as late as possible but no later than the time it was written for:
+
+        * frames are aligned to a common grid of their clock period, so frames of different chips that overlap in time
+          share transition times. Transitions at the same time on one connector are merged into a single record.
+        * frames sharing pins with an already placed frame are moved earlier, by at most max_advance and never before
+          the previous update pulse of their chip (which would enact them too early).
+        * frames of a chip keep their order: each one ends before the chip's next frame (by deadline) starts.
+        * frames that cannot be placed are written where they were asked for and reported in conflicts (and warned).
+
+        Use as a context manager around building part or all of a sequence:
+
+            with SpiBus() as bus:
+                seq.seq(0.00)
+            print(bus.stats)
+
+        :param max_advance: maximum time a frame may be moved earlier than requested (seconds)
+        :type max_advance: float
+        """
+        self.max_advance = max_advance
+        self.frames = []
+        self.updates = {}
+        self.conflicts = []
+        self.stats = {}
+
+    def __enter__(self):
+        _active_buses().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_buses().remove(self)
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def submit(self, chip, connector, pins, states, deadline, min_time):
+        """Queues a movable frame: one state every min_time, the last one held until deadline.
+
+        :param chip: identifies the chip (frames of a chip keep the order of their deadlines)
+        :type chip: hashable
+        :param connector: FPGA connector
+        :type connector: int
+        :param pins: mask of the data and clock pins
+        :type pins: int
+        :param states: output states in chronological order
+        :type states: numpy.ndarray
+        :param deadline: time at which the frame has to be finished
+        :type deadline: float
+        :param min_time: time per state
+        :type min_time: float
+        """
+        timing.not_relocatable()
+        masks = np.full(len(states), pins, dtype=np.uint32)
+        self.frames.append(_Frame(chip, connector, pins, masks, np.asarray(states, dtype=np.uint32), deadline,
+                                  min_time))
+
+    def submit_fixed(self, chip, connector, times, masks, states, min_time):
+        """Queues transitions that must not be moved (e.g. frames framed by a sync pin written directly)
+
+        :param chip: identifies the chip
+        :type chip: hashable
+        :param connector: FPGA connector
+        :type connector: int
+        :param times: transition times in chronological order
+        :type times: numpy.ndarray
+        :param masks: channel mask of each transition
+        :type masks: numpy.ndarray or int
+        :param states: output state of each transition
+        :type states: numpy.ndarray
+        :param min_time: time the last transition is held
+        :type min_time: float
+        """
+        timing.not_relocatable()
+        times = np.asarray(times, dtype=float)
+        masks = np.broadcast_to(np.asarray(masks, dtype=np.uint32), times.shape).copy()
+        pins = int(np.bitwise_or.reduce(masks))
+        self.frames.append(_Frame(chip, connector, pins, masks, np.asarray(states, dtype=np.uint32), float(times[-1]),
+                                  min_time, times=times))
+
+    def note_update(self, chip, update_time):
+        """Records an update pulse of chip. Frames are never moved before the previous update of their chip.
+
+        :param chip: identifies the chip
+        :type chip: hashable
+        :param update_time: time of the pulse
+        :type update_time: float
+        """
+        timing.not_relocatable()
+        bisect.insort(self.updates.setdefault(chip, []), update_time)
+
+    def _earliest(self, frame):
+        updates = self.updates.get(frame.chip, [])
+        # updates at the deadline enact this frame, earlier ones must not
+        i = bisect.bisect_left(updates, frame.deadline - frame.min_time / 2) - 1
+        if i < 0:
+            return float('-inf')
+        return updates[i] + 2 * frame.min_time
+
+    @staticmethod
+    def _clash(occupied, frame_pins, start, end):
+        # earliest start of the placed frames on overlapping pins that intersect [start, end), None if free
+        clash = None
+        for pins, (starts, ends) in occupied.items():
+            if not pins & frame_pins:
+                continue
+            i = bisect.bisect_left(starts, end) - 1
+            while i >= 0 and ends[i] > start:
+                clash = starts[i] if clash is None else min(clash, starts[i])
+                i -= 1
+        return clash
+
+    @staticmethod
+    def _occupy(occupied, frame):
+        starts, ends = occupied.setdefault(frame.pins, ([], []))
+        i = bisect.bisect_left(starts, frame.start)
+        starts.insert(i, frame.start)
+        ends.insert(i, frame.end)
+
+    def _report(self, frame, reason):
+        frame.conflict = True
+        message = "SpiBus: frame of {} on connector {} due at {:.9f} s {}".format(frame.chip, frame.connector,
+                                                                                   frame.deadline, reason)
+        self.conflicts.append(message)
+        warnings.warn(message)
+
+    def _place(self, frame, occupied, latest):
+        n_states = len(frame.states)
+        lower = max(self._earliest(frame), frame.deadline - self.max_advance)
+        # snap to the grid of the clock period, never later than asked for nor than the chip's next frame starts
+        end_tick = math.floor(min(frame.deadline, latest) / frame.min_time + 1e-6)
+        while True:
+            start = (end_tick - n_states) * frame.min_time
+            if start < lower - frame.min_time * 1e-6:
+                break
+            clash = self._clash(occupied, frame.pins, start, end_tick * frame.min_time)
+            if clash is None:
+                frame.times = (end_tick - np.arange(n_states, 0, -1)) * frame.min_time
+                return True
+            end_tick = math.floor(clash / frame.min_time + 1e-6)
+
+        # no room: write it where it was asked for
+        frame.times = frame.deadline - frame.min_time * np.arange(n_states, 0, -1)
+        self._report(frame, "does not fit on the bus" if latest >= frame.deadline else
+                     "does not fit on the bus before the next frame of its chip")
+        return False
+
+    @staticmethod
+    def _occupancy(intervals):
+        # total time covered by a list of (start, end)
+        total = 0.0
+        current_start, current_end = None, None
+        for start, end in sorted(intervals):
+            if current_end is None or start > current_end:
+                if current_end is not None:
+                    total += current_end - current_start
+                current_start, current_end = start, end
+            else:
+                current_end = max(current_end, end)
+        if current_end is not None:
+            total += current_end - current_start
+        return total
+
+    def flush(self):
+        """Places all queued frames and writes them, one set_digital_states call per connector. Fills stats."""
+        frames = self.frames
+        self.frames = []
+        requested = {}
+        for frame in frames:
+            if frame.fixed:
+                interval = (frame.start, frame.end)
+            else:
+                interval = (frame.deadline - frame.min_time * len(frame.states), frame.deadline)
+            requested.setdefault(frame.connector, []).append(interval)
+
+        moved = 0
+        by_connector = {}
+        for connector in sorted(set(frame.connector for frame in frames)):
+            occupied = {}
+            connector_frames = [frame for frame in frames if frame.connector == connector]
+            # fixed transitions first, then backwards from the latest deadline
+            for frame in (f for f in connector_frames if f.fixed):
+                if self._clash(occupied, frame.pins, frame.start, frame.end) is not None:
+                    self._report(frame, "overlaps another fixed frame")
+                else:
+                    self._occupy(occupied, frame)
+            # latest deadline first (queued order for equal deadlines), so the chip's later frames are placed already
+            # and chip_start holds the earliest start among them
+            chip_start = {}
+            latest_first = sorted(range(len(connector_frames)), key=lambda i: (connector_frames[i].deadline, i),
+                                  reverse=True)
+            for frame in (connector_frames[i] for i in latest_first):
+                if not frame.fixed and self._place(frame, occupied, chip_start.get(frame.chip, float('inf'))):
+                    self._occupy(occupied, frame)
+                    if frame.end < frame.deadline - frame.min_time * 1e-6:
+                        moved += 1
+                chip_start[frame.chip] = min(chip_start.get(frame.chip, float('inf')), frame.start)
+            by_connector[connector] = connector_frames
+
+        records_in = 0
+        records_out = 0
+        occupancy_before = 0.0
+        occupancy_after = 0.0
+        for connector, connector_frames in by_connector.items():
+            times = np.concatenate([f.times for f in connector_frames])
+            masks = np.concatenate([f.masks for f in connector_frames])
+            states = np.concatenate([f.states for f in connector_frames])
+            records_in += len(times)
+
+            # merge transitions at the same time; pins of placed frames never overlap, conflicts are kept apart
+            merge = np.concatenate([np.full(len(f.times), not f.conflict) for f in connector_frames])
+            order = np.argsort(times[merge], kind='stable')
+            merged_times, first = np.unique(times[merge][order], return_index=True)
+            merged_masks = np.bitwise_or.reduceat(masks[merge][order], first) if len(first) else masks[:0]
+            merged_states = np.bitwise_or.reduceat(states[merge][order], first) if len(first) else states[:0]
+            out_times = np.concatenate((merged_times, times[~merge]))
+            out_masks = np.concatenate((merged_masks, masks[~merge]))
+            out_states = np.concatenate((merged_states, states[~merge]))
+            ew.set_digital_states(out_times, connector, out_masks, out_masks, out_states)
+            records_out += len(out_times)
+
+            occupancy_before += self._occupancy(requested[connector])
+            occupancy_after += self._occupancy([(f.start, f.end) for f in connector_frames])
+
+        self.stats = {'frames': len(frames), 'moved': moved, 'conflicts': len(self.conflicts),
+                      'records_in': records_in, 'records_out': records_out,
+                      'occupancy_before': occupancy_before, 'occupancy_after': occupancy_after}
+        return self.stats
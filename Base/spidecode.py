@@ -0,0 +1,413 @@
+from Entangleware import ew_link as ew
+import struct
+import warnings
+import numpy as np
+from Base import boards as brd
+
+# timeline of a DDS channel: output from time on, frequency ramping at slope (chirp)
+dds_timeline_dtype = np.dtype([('time', 'f8'), ('frequency', 'f8'), ('amplitude', 'f8'), ('slope', 'f8')])
+# timeline of a DAC channel
+dac_timeline_dtype = np.dtype([('time', 'f8'), ('voltage', 'f8')])
+
+
+def records_from_message(message):
+    """Transitions of a compiled run (e.g. the contents of LastCompiledRun.dat)
+
+    :param message: cycle count followed by the transitions, as sent to the Entangleware software
+    :type message: bytes
+    :rtype: numpy.ndarray
+    :return: structured array (ew_link.wire_dtype)
+    """
+    return np.frombuffer(message, dtype=ew.wire_dtype, offset=4)
+
+
+class _ConnectorPins:
+    def __init__(self, records, connector):
+        """Pin histories of one connector, from transitions in any order"""
+        # connectors are stored with an offset of 1 (0 is the analog card)
+        selected = records[records['connector'] == connector + 1]
+        order = np.argsort(selected['time'], kind='stable')
+        self.times = selected['time'][order].astype(float)
+        self.masks = selected['channel_mask'][order].astype(np.uint32)
+        self.states = selected['output_state'][order].astype(np.uint32)
+        self._pins = {}
+
+    def pin(self, pin):
+        """Times and values at which pin is set, last setting wins for equal times
+
+        :rtype: tuple (numpy.ndarray, numpy.ndarray)
+        """
+        if pin not in self._pins:
+            touched = ((self.masks >> np.uint32(pin)) & 1).astype(bool)
+            times = self.times[touched]
+            values = ((self.states[touched] >> np.uint32(pin)) & 1).astype(np.int8)
+            last = np.append(times[1:] != times[:-1], True)[:len(times)]
+            self._pins[pin] = (times[last], values[last])
+        return self._pins[pin]
+
+    def value_at(self, pin, times):
+        """Value of pin at each of times (0 before the first transition)"""
+        pin_times, pin_values = self.pin(pin)
+        i = np.searchsorted(pin_times, times, side='right') - 1
+        return np.where(i >= 0, pin_values[np.maximum(i, 0)], 0)
+
+    def edges(self, pin, rising=True):
+        """Times of the rising (or falling) edges of pin"""
+        pin_times, pin_values = self.pin(pin)
+        previous = np.concatenate(([0], pin_values[:-1]))
+        if rising:
+            return pin_times[(pin_values == 1) & (previous == 0)]
+        return pin_times[(pin_values == 0) & (previous == 1)]
+
+
+def _frames(pins, data_pin, clock_pin, widths, min_time, boundaries=None, valid=None):
+    """Rebuilds the frames clocked out on data_pin/clock_pin. Bits are sampled on rising clock edges, bursts are split
+    at gaps in the clock (and at boundaries), and each burst is read as consecutive frames of a register byte followed
+    by the number of data bytes widths returns for it (None: rest of the burst).
+
+    :rtype: list [(float, int, bytes)]
+    :return: (time of the last bit, register, payload) for each frame
+    """
+    clock_times = pins.edges(clock_pin)
+    if valid is not None:
+        clock_times = clock_times[valid(clock_times)]
+    if len(clock_times) == 0:
+        return []
+    bits = pins.value_at(data_pin, clock_times).astype(np.uint8)
+
+    # new burst after a gap in the clock or at a boundary (chip select, sync)
+    new_burst = np.concatenate(([True], np.diff(clock_times) > 4 * min_time))
+    if boundaries is not None and len(boundaries):
+        burst_of_boundary = np.searchsorted(boundaries, clock_times, side='right')
+        new_burst |= np.concatenate(([True], np.diff(burst_of_boundary) != 0))
+    starts = np.flatnonzero(new_burst)
+    ends = np.append(starts[1:], len(bits))
+
+    frames = []
+    for start, end in zip(starts, ends):
+        position = start
+        while end - position >= 8:
+            register = int(np.packbits(bits[position:position + 8])[0])
+            width = widths(register)
+            if width is None:
+                width = (end - position - 8) // 8
+            if width < 0 or position + 8 + 8 * width > end:
+                warnings.warn("spidecode: incomplete frame for register 0x{:02X} at {:.9f} s"
+                              .format(register, clock_times[position]))
+                break
+            payload = np.packbits(bits[position + 8:position + 8 + 8 * width]).tobytes()
+            position += 8 + 8 * width
+            frames.append((float(clock_times[position - 1]), register, payload))
+        if position != end:
+            warnings.warn("spidecode: {} stray bits at {:.9f} s".format(end - position, clock_times[position]))
+    return frames
+
+
+class _DDSModel:
+    # register widths in bytes
+    widths = {}
+
+    def __init__(self, n_channels):
+        self.timeline = {channel: [] for channel in range(n_channels)}
+
+    def _emit(self, event_time, channel, frequency, amplitude, slope=0.0):
+        entries = self.timeline[channel]
+        entry = (event_time, frequency, amplitude, slope)
+        if entries and entries[-1][1:] == entry[1:]:
+            return
+        if entries and entries[-1][0] == event_time:
+            entries[-1] = entry
+        else:
+            entries.append(entry)
+
+    def result(self):
+        return {channel: np.array(entries, dtype=dds_timeline_dtype) for channel, entries in self.timeline.items()}
+
+
+class AD9959Model(_DDSModel):
+    widths = {0x00: 1, 0x01: 3, 0x02: 2, 0x03: 3, 0x04: 4, 0x05: 2, 0x06: 3, 0x07: 2, 0x08: 4, 0x09: 4}
+    widths.update({register: 4 for register in range(0x0A, 0x19)})
+
+    def __init__(self, sys_clock):
+        """Register model of an AD9959 in single tone mode. Channel registers are written through the channel select
+        register and enacted on update. Modulation and sweeps are not modelled.
+
+        :param sys_clock: system clock (Hz)
+        :type sys_clock: float
+        """
+        super().__init__(4)
+        self.sys_clock = sys_clock
+        self.reset(None)
+
+    def reset(self, event_time):
+        self.selected = [0, 1, 2, 3]
+        self.active = [{0x04: 0, 0x06: 0} for channel in range(4)]
+        self.pending = [{} for channel in range(4)]
+        if event_time is not None:
+            for channel in range(4):
+                self._output(event_time, channel)
+
+    def _output(self, event_time, channel):
+        ftw = self.active[channel][0x04]
+        acr = self.active[channel][0x06]
+        amplitude = (acr & 0x3FF) / 1023 if acr & (1 << 12) else 1.0
+        self._emit(event_time, channel, ftw * self.sys_clock / (1 << 32), amplitude)
+
+    def frame(self, event_time, register, payload):
+        if register == 0x00:
+            # channel select acts immediately
+            self.selected = [channel for channel in range(4) if payload[0] & (1 << (4 + channel))]
+        elif register in (0x04, 0x06):
+            for channel in self.selected:
+                self.pending[channel][register] = int.from_bytes(payload, 'big')
+
+    def update(self, event_time):
+        for channel in range(4):
+            if self.pending[channel]:
+                self.active[channel].update(self.pending[channel])
+                self.pending[channel] = {}
+                self._output(event_time, channel)
+
+
+class AD9854Model(_DDSModel):
+    widths = {0x00: 2, 0x01: 2, 0x02: 6, 0x03: 6, 0x04: 6, 0x05: 4, 0x06: 3, 0x07: 4, 0x08: 2, 0x09: 2,
+              0x0A: 1, 0x0B: 2}
+
+    def __init__(self, sys_clock):
+        """Register model of an AD9854 in single tone or (linear) chirp mode. In chirp mode the frequency restarts from
+        FTW1 when FTW1 is written and ramps by the delta frequency word every ramp rate clock period.
+
+        :param sys_clock: system clock (Hz)
+        :type sys_clock: float
+        """
+        super().__init__(1)
+        self.sys_clock = sys_clock
+        self.reset(None)
+
+    def reset(self, event_time):
+        self.active = {0x02: 0, 0x04: 0, 0x06: 0, 0x07: 0, 0x08: 0}
+        self.pending = {}
+        self.frequency = 0.0
+        self.slope = 0.0
+        self.last_time = event_time
+        if event_time is not None:
+            self._emit(event_time, 0, 0.0, 1.0)
+
+    def frame(self, event_time, register, payload):
+        if register in self.active:
+            self.pending[register] = int.from_bytes(payload, 'big')
+
+    def update(self, event_time):
+        if not self.pending:
+            return
+        if self.last_time is not None:
+            self.frequency += self.slope * (event_time - self.last_time)
+        new_ftw = 0x02 in self.pending
+        self.active.update(self.pending)
+        self.pending = {}
+        self.last_time = event_time
+
+        control = self.active[0x07]
+        chirp = ((control >> 9) & 7) == 3
+        if new_ftw or not chirp:
+            self.frequency = self.active[0x02] * self.sys_clock / (1 << 48)
+        if chirp:
+            delta = self.active[0x04]
+            if delta & (1 << 47):
+                delta -= 1 << 48
+            ramp_period = (self.active[0x06] + 1) / self.sys_clock
+            self.slope = delta * self.sys_clock / (1 << 48) / ramp_period
+        else:
+            self.slope = 0.0
+        # amplitude multiplier enable (OSK EN)
+        amplitude = (self.active[0x08] & 0xFFF) / 4095 if control & (1 << 5) else 1.0
+        self._emit(event_time, 0, self.frequency, amplitude, self.slope)
+
+
+class AD9910Model(_DDSModel):
+    widths = {0x00: 4, 0x01: 4, 0x02: 4, 0x03: 4, 0x04: 4, 0x07: 4, 0x08: 2, 0x09: 4, 0x0A: 4, 0x0B: 8, 0x0C: 8,
+              0x0D: 4, 0x16: None}
+    widths.update({register: 8 for register in range(0x0E, 0x16)})
+
+    def __init__(self, sys_clock):
+        """Register model of an AD9910 in single tone mode, using the profile selected by the profile pins. While RAM
+        playback or the digital ramp generator drive the output, frequency and amplitude are reported as NaN.
+
+        :param sys_clock: system clock (Hz)
+        :type sys_clock: float
+        """
+        super().__init__(1)
+        self.sys_clock = sys_clock
+        self.profile = 0
+        self.reset(None)
+
+    def reset(self, event_time):
+        self.active = {register: 0 for register in list(range(0x0E, 0x16)) + [0x00, 0x01]}
+        self.pending = {}
+        if event_time is not None:
+            self._output(event_time)
+
+    def _output(self, event_time):
+        if self.active[0x00] & (1 << 31) or self.active[0x01] & (1 << 19):
+            self._emit(event_time, 0, float('nan'), float('nan'))
+            return
+        asf, pow_word, ftw = struct.unpack('>HHL', self.active[0x0E + self.profile].to_bytes(8, 'big'))
+        self._emit(event_time, 0, ftw * self.sys_clock / (1 << 32), (asf & 0x3FFF) / 0x3FFF)
+
+    def frame(self, event_time, register, payload):
+        if register in self.active:
+            self.pending[register] = int.from_bytes(payload, 'big')
+
+    def update(self, event_time):
+        if self.pending:
+            self.active.update(self.pending)
+            self.pending = {}
+            self._output(event_time)
+
+    def select(self, event_time, profile):
+        if profile != self.profile:
+            self.profile = profile
+            self._output(event_time)
+
+
+class AD5372Model:
+    def __init__(self, v_offset, v_ref):
+        """Register model of an AD5372. Writes to the X1 register are loaded into the DAC on the falling edge of LDAC,
+        or immediately while LDAC is low.
+
+        :param v_offset: offset voltage of the board
+        :type v_offset: float
+        :param v_ref: reference voltage of the board
+        :type v_ref: float
+        """
+        self.v_offset = v_offset
+        self.v_ref = v_ref
+        self.pending = {}
+        self.timeline = {channel: [] for channel in range(32)}
+
+    def _emit(self, event_time, channel, code):
+        voltage = code * 4 * self.v_ref / 65536 - self.v_offset
+        entries = self.timeline[channel]
+        if not entries or entries[-1][1] != voltage:
+            entries.append((event_time, voltage))
+
+    def frame(self, event_time, register, payload, ldac_low):
+        # 0xC0 selects the X1 register, address 0 is all channels, 0x08 + chan a single channel
+        if register & 0xC0 != 0xC0:
+            return
+        address = register & 0x3F
+        code = int.from_bytes(payload, 'big')
+        channels = range(32) if address == 0 else [address - 0x08] if 0x08 <= address < 0x28 else []
+        for channel in channels:
+            if ldac_low:
+                self._emit(event_time, channel, code)
+            else:
+                self.pending[channel] = code
+
+    def load(self, event_time):
+        for channel, code in self.pending.items():
+            self._emit(event_time, channel, code)
+        self.pending = {}
+
+    def result(self):
+        return {channel: np.array(entries, dtype=dac_timeline_dtype) for channel, entries in self.timeline.items()}
+
+
+def _replay(model, frames, updates, resets=(), selects=()):
+    # frames finish before an update at the same time, resets come first
+    events = [(t, 0, 'reset', None) for t in resets]
+    events += [(t, 1, 'frame', (register, payload)) for t, register, payload in frames]
+    events += [(t, 2, 'select', profile) for t, profile in selects]
+    events += [(t, 3, 'update', None) for t in updates]
+    events.sort(key=lambda event: (event[0], event[1]))
+    for event_time, _, kind, argument in events:
+        if kind == 'reset':
+            model.reset(event_time)
+        elif kind == 'frame':
+            model.frame(event_time, *argument)
+        elif kind == 'select':
+            model.select(event_time, argument)
+        else:
+            model.update(event_time)
+    return model.result()
+
+
+def decode_board(records, board, pins=None):
+    """Decodes what a compiled sequence programs into one board.
+
+    :param records: transitions of the sequence (ew_link.Sequence.records() or records_from_message)
+    :type records: numpy.ndarray
+    :param board: board the transitions are meant for
+    :type board: boards.AD9959, boards.AD9854, boards.AD9910, boards.AD5372 or ew_link.DDS
+    :param pins: pin histories of the board's connector, reused between boards on the same connector
+    :type pins: _ConnectorPins
+    :rtype: dict
+    :return: {channel: timeline}, timelines are structured arrays of dds_timeline_dtype or dac_timeline_dtype
+    :raise: ValueError if the board type is not supported
+    """
+    if pins is None:
+        pins = _ConnectorPins(records, board.connector)
+
+    if isinstance(board, ew.DDS):
+        # legacy AD9959 driver: frames framed by chip select, update at the end of each write
+        model = AD9959Model(board._dds_sysclock)
+        cs_low = pins.edges(board.cspin, rising=False)
+        frames = _frames(pins, board.mosipin, board.sclkpin, model.widths.get, board.spi_min_time, boundaries=cs_low,
+                         valid=lambda t: pins.value_at(board.cspin, t) == 0)
+        return _replay(model, frames, pins.edges(board.ioupdatepin), pins.edges(board.resetpin))
+
+    if isinstance(board, brd.AD5372):
+        model = AD5372Model(board.v_offset, board.v_ref)
+        sync_low = pins.edges(board.sync_pin, rising=False)
+        frames = _frames(pins, board.io_pin, board.serial_clock_pin, lambda register: 2, board.spi_min_time,
+                         boundaries=sync_low)
+        ldac = pins.edges(board.ldac_pin, rising=False)
+        events = [(t, 0, None) for t in ldac] + [(t, 1, frame) for t, *frame in frames]
+        events.sort(key=lambda event: (event[0], event[1]))
+        for event_time, _, frame in events:
+            if frame is None:
+                model.load(event_time)
+            else:
+                ldac_low = pins.value_at(board.ldac_pin, [event_time])[0] == 0
+                model.frame(event_time, frame[0], frame[1], ldac_low)
+        return model.result()
+
+    if isinstance(board, brd.AD9959):
+        model = AD9959Model(board._AD9959_sys_clock)
+    elif isinstance(board, brd.AD9854):
+        model = AD9854Model(board._AD9854_sys_clock)
+    elif isinstance(board, brd.AD9910):
+        model = AD9910Model(board._AD9910_sys_clock)
+    else:
+        raise ValueError("spidecode: unsupported board {}".format(type(board).__name__))
+
+    # registers not in the table are skipped with the rest of their burst
+    frames = _frames(pins, board.io_pin, board.serial_clock_pin, model.widths.get, board.spi_min_time)
+    selects = []
+    if isinstance(board, brd.AD9910) and board.AD9910_profile_pins is not None:
+        profile_pins = _ConnectorPins(records, board.AD9910_connector2)
+        changes = np.unique(np.concatenate([profile_pins.pin(pin)[0] for pin in board.AD9910_profile_pins]))
+        profiles = sum(profile_pins.value_at(pin, changes).astype(int) << bit
+                       for bit, pin in enumerate(board.AD9910_profile_pins))
+        selects = list(zip(changes, profiles))
+    resets = pins.edges(board.reset_pin) if hasattr(board, 'reset_pin') else ()
+    return _replay(model, frames, pins.edges(board.io_update_pin), resets, selects)
+
+
+def decode(records, boards):
+    """Decodes what a compiled sequence programs into each board. Pin histories are rebuilt once per connector.
+
+    :param records: transitions of the sequence (ew_link.Sequence.records() or records_from_message)
+    :type records: numpy.ndarray
+    :param boards: boards to decode, by name
+    :type boards: dict {str: board}
+    :rtype: dict
+    :return: {name: {channel: timeline}}
+    """
+    connectors = {}
+    result = {}
+    for name, board in boards.items():
+        if board.connector not in connectors:
+            connectors[board.connector] = _ConnectorPins(records, board.connector)
+        result[name] = decode_board(records, board, connectors[board.connector])
+    return result
@@ -0,0 +1,103 @@
+from Entangleware import ew_link as ew
+import bisect
+
+
+class StateTracker:
+    def __init__(self, initial):
+        """Setpoints of several outputs (e.g. which coils are on) as a function of sequence time. Each output keeps the
+        times it was set at in order, so its value at any time of the sequence is found by binary search, whatever
+        order the sequence is built in:
+
+            tracker.set('pinch_on', 2.5, True)
+            tracker.value_at('pinch_on', 3.0)    # True
+            tracker.state_at(1.0)                # {'pinch_on': False, ...}
+
+        Values set at the same time are applied in the order they were set. The final values carry over to the next
+        shot as its initial values only if the shot they were set in was the last message run through the connection,
+        otherwise it starts from initial again (see ew_link.foreign_uploads).
+
+        :param initial: output names and their values before anything is set
+        :type initial: dict
+        """
+        self._initial = dict(initial)
+        self._baseline = dict(initial)
+        self._times = {}
+        self._values = {}
+        self._generation = ew.msgseq.generation
+        self._mark = ew.upload_mark()
+
+    def _sync(self):
+        foreign = ew.foreign_uploads(self._mark)
+        generation = ew.msgseq.generation
+        if generation == self._generation and not foreign:
+            return
+        # start a new history when the sequence buffer has been cleared since the last access
+        if generation != self._generation:
+            if self._generation == ew.msgseq.sent_generation and not foreign:
+                self._baseline = {key: self._value_at(key, float('inf')) for key in self._baseline}
+            self._times = {}
+            self._values = {}
+            self._generation = generation
+        self._mark = ew.upload_mark()
+        if foreign:
+            # another message ran since (a replayed shot, another build context's), back to the initial values
+            self._baseline = dict(self._initial)
+
+    def _value_at(self, key, t):
+        if key not in self._baseline:
+            raise ValueError("StateTracker: unknown output {}".format(key))
+        times = self._times.get(key, [])
+        i = bisect.bisect_right(times, t) - 1
+        if i >= 0:
+            return self._values[key][i]
+        return self._baseline[key]
+
+    def set(self, key, t, value):
+        """Records that output key takes value at sequence time t. Outside of building a sequence the value is set
+        immediately and becomes the initial value of the next sequence.
+
+        :param key: output name
+        :type key: str
+        :param t: sequence time the value takes effect
+        :type t: float
+        :param value: new value
+        """
+        self._sync()
+        if key not in self._baseline:
+            raise ValueError("StateTracker: unknown output {}".format(key))
+        if not ew.msgseq.building:
+            self._baseline[key] = value
+            return
+        times = self._times.setdefault(key, [])
+        i = bisect.bisect_right(times, t)
+        times.insert(i, t)
+        self._values.setdefault(key, []).insert(i, value)
+
+    def value_at(self, key, t):
+        """Value of output key at sequence time t
+
+        :param key: output name
+        :type key: str
+        :param t: sequence time
+        :type t: float
+        :return: last value set at or before t, the initial value if none
+        """
+        self._sync()
+        return self._value_at(key, t)
+
+    def state_at(self, t):
+        """Values of all outputs at sequence time t
+
+        :param t: sequence time
+        :type t: float
+        :rtype: dict
+        """
+        self._sync()
+        return {key: self._value_at(key, t) for key in self._baseline}
+
+    def final_state(self):
+        """Values of all outputs after the last value set
+
+        :rtype: dict
+        """
+        return self.state_at(float('inf'))
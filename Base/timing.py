@@ -1,3 +1,11 @@
+from Entangleware import ew_link as ew
+from Entangleware import ew_profile
+from Base import parallelcompile
+from functools import partial
+import types
+import numpy as np
+
+
 def null_func(time):
     """default null sequence, that takes 0 time to execute
     :param time: time to execute
@@ -7,6 +15,435 @@ def null_func(time):
     return 0
 
 
+class TimelineNode(ew.Segment):
+    def __init__(self, step=None, node_time=0.0, parent=None):
+        """One step executed while recording a Timeline: the transitions it queued itself, in order, interleaved with
+        the nodes of the steps it executed in turn.
+
+        :param step: method/function executed, None for the root
+        :type step: callable
+        :param node_time: time the step was executed at
+        :type node_time: float
+        :param parent: node of the step that executed this one
+        :type parent: TimelineNode
+        """
+        super().__init__()
+        self.step = step
+        self.name = getattr(step, '__qualname__', getattr(getattr(step, 'func', None), '__qualname__', repr(step)))
+        self.time = node_time
+        self.offset = node_time - parent.time if parent is not None else node_time
+        self.elapsed = 0.0
+        self.children = []
+        # what the output depends on (None if unknown), side effects, and the matching node of the previous shot
+        self.signature = None
+        self.journal = None
+        self.previous = None
+
+    def walk(self):
+        """This node and all nodes below it, depth first in execution order"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def _step_function(step):
+    # the function behind a step, to match steps of consecutive shots
+    if isinstance(step, partial):
+        return _step_function(step.func)
+    return getattr(step, '__func__', step)
+
+
+def _fields(state):
+    # attributes of an instance (or arguments of a partial) from its state key
+    if isinstance(state, tuple) and state:
+        if state[0] == 'method':
+            return _fields(state[2])
+        if state[0] == 'partial':
+            fields = dict(state[3][1:])
+            fields['args'] = state[2]
+            return fields
+        if isinstance(state[0], type):
+            return dict(state[1:])
+    return {}
+
+
+def _changed(old, new):
+    # names of what differs between two node signatures
+    names = []
+    if old[1] != new[1]:
+        names.append('time')
+    if old[2] != new[2]:
+        names.append('effects')
+    if old[0] != new[0]:
+        fields_old = _fields(old[0])
+        fields_new = _fields(new[0])
+        changed = [name for name in set(fields_old) | set(fields_new)
+                   if name not in fields_old or name not in fields_new or fields_old[name] != fields_new[name]]
+        names += sorted(changed, key=str) or ['step']
+    return names
+
+
+class Timeline:
+    def __init__(self, previous=None, relocate=False):
+        """Records a sequence as a tree of TimelineNodes instead of queuing its transitions as it goes. Steps still
+        execute (their elapsed times decide the timing of what follows), but what they queue is kept in their node
+        until compile writes the whole tree to the sequence buffer in one pass:
+
+            with Timeline() as timeline:
+                seq.seq(0.00)
+            timeline.compile()
+
+        Compiling in execution order gives the same buffer as building without a Timeline.
+
+        Given the timeline of the previous shot, a step is not executed again if the step at the same place in the
+        previous shot had the same signature: same function, equal instance/argument state (see _state_key), same
+        start time and the same side effects (record_effect) applied before it, and the time dependent state it read
+        (timed_lookup) unchanged. Its node is reused as it is and its side effects are applied again. Nodes that wrote
+        through register shadows or the SPI bus are always executed.
+
+        :param previous: timeline of the previous shot
+        :type previous: Timeline
+        :param relocate: also reuse nodes that only moved in time, shifting their transitions (times of the shifted
+            transitions may differ from a new execution in the last bit)
+        :type relocate: bool
+        """
+        self.root = TimelineNode()
+        self._stack = [self.root]
+        self.relocate = relocate
+        self.journal = _Journal()
+        self.root.previous = previous.root if previous is not None else None
+        self.stats = {'executed': 0, 'reused': 0, 'relocated': 0}
+        # (node name, names of what changed) of the steps executed again
+        self.changes = []
+
+    def __enter__(self):
+        stacks = _stacks()
+        stacks.timelines.append(self)
+        stacks.journals.append(self.journal)
+        ew.push_sink(self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ew.pop_sink()
+        stacks = _stacks()
+        stacks.journals.remove(self.journal)
+        stacks.timelines.remove(self)
+        # let go of the previous shot
+        for node in self.root.walk():
+            node.previous = None
+        return False
+
+    def _signature(self, step, step_time):
+        try:
+            state = _state_key(step)
+            hash(state)
+        except TypeError:
+            return None
+        return state, None if self.relocate else step_time, self.journal.context
+
+    def _counterpart(self, parent, step):
+        # node at the same place in the previous shot, if it ran the same function
+        previous = parent.previous
+        if previous is None or len(parent.children) >= len(previous.children):
+            return None
+        candidate = previous.children[len(parent.children)]
+        if _step_function(candidate.step) is not _step_function(step):
+            return None
+        return candidate
+
+    def _reuse(self, candidate, parent, step, step_time):
+        if candidate.time == step_time:
+            node = candidate
+            self.stats['reused'] += 1
+        else:
+            node = TimelineNode(step, step_time, parent)
+            records = candidate.records().copy()
+            records['time'] += step_time - candidate.time
+            node.items.append(records.tobytes())
+            node.signature = candidate.signature
+            node.journal = _Journal()
+            node.journal.effects = _shift_effects(candidate.journal.effects, step_time - candidate.time)
+            node.journal.lookups = _shift_lookups(candidate.journal.lookups, step_time - candidate.time)
+            node.elapsed = candidate.elapsed
+            self.stats['relocated'] += 1
+        node.offset = step_time - parent.time
+        parent.children.append(node)
+        ew._store().items.append(node)
+        for effect, args in node.journal.effects:
+            record_effect(effect, *args)
+        for journal in _stacks().journals:
+            journal.lookups.extend(node.journal.lookups)
+        return node.elapsed
+
+    def call(self, step, step_time):
+        """Executes step at step_time in a new node below the step currently executing (or reuses the node of the
+        previous shot)
+
+        :rtype: float
+        :return: elapsed time of step
+        """
+        parent = self._stack[-1]
+        signature = self._signature(step, step_time)
+        candidate = self._counterpart(parent, step)
+        if candidate is not None and signature is not None:
+            if candidate.signature == signature and candidate.journal.cacheable:
+                if _lookups_hold(candidate.journal.lookups, step_time - candidate.time):
+                    return self._reuse(candidate, parent, step, step_time)
+                self.changes.append((getattr(step, '__qualname__', candidate.name), ['lookups']))
+            elif candidate.signature is not None and candidate.signature != signature:
+                self.changes.append((getattr(step, '__qualname__', candidate.name),
+                                     _changed(candidate.signature, signature)))
+
+        node = TimelineNode(step, step_time, parent)
+        node.signature = signature
+        node.journal = _Journal()
+        node.previous = candidate
+        parent.children.append(node)
+        # normally the parent itself, a relocatable block capturing its output otherwise
+        ew._store().items.append(node)
+        self._stack.append(node)
+        ew.push_sink(node)
+        journals = _stacks().journals
+        journals.append(node.journal)
+        try:
+            node.elapsed = step(step_time)
+        finally:
+            journals.remove(node.journal)
+            ew.pop_sink()
+            self._stack.pop()
+        self.stats['executed'] += 1
+        return node.elapsed
+
+    def records(self, order='execution', workers=1):
+        """All recorded transitions
+
+        :param order: 'execution' (the order they were queued in) or 'time' (stable sort by time)
+        :type order: str
+        :param workers: threads emitting and sorting by time, os.cpu_count() if None: the tree is split into
+            partitions at step boundaries, sorted in parallel and merged (see parallelcompile.time_order), with the same
+            result
+        :type workers: int
+        :rtype: numpy.ndarray (ew_link.wire_dtype)
+        """
+        if order == 'time':
+            if workers != 1:
+                return parallelcompile.time_order(self.root, workers)
+            records = self.root.records()
+            return records[np.argsort(records['time'], kind='stable')]
+        if order != 'execution':
+            raise ValueError("Timeline: order must be 'execution' or 'time'")
+        return self.root.records()
+
+    def compile(self, order='execution', workers=1):
+        """Queues all recorded transitions into the sequence buffer with a single append
+
+        :param order: 'execution' or 'time', see records
+        :type order: str
+        :param workers: threads emitting and sorting by time, see records
+        :type workers: int
+        :rtype: int
+        :return: number of transitions queued
+        """
+        records = self.records(order, workers)
+        ew.msgseq.addElement(records.tobytes())
+        return len(records)
+
+
+class IncrementalBuilder:
+    def __init__(self, relocate=False):
+        """Builds one shot after the other, executing again only the steps whose signature changed since the
+        previous shot (see Timeline). Use in a loop over shots in place of calling the top level sequence:
+
+            builder = IncrementalBuilder()
+            for i in range(shots):
+                ew.build_sequence()
+                builder.build(CrossEvaporation(params, i=i).seq)
+                print(builder.timeline.changes)
+                ew.run_sequence()
+
+        :param relocate: reuse steps that only moved in time (see Timeline)
+        :type relocate: bool
+        """
+        self.relocate = relocate
+        self.timeline = None
+
+    def build(self, step, start_time=0.0):
+        """Builds step at start_time into the sequence buffer
+
+        :param step: top level sequence (method or function)
+        :type step: callable
+        :param start_time: time to execute step
+        :type start_time: float
+        :rtype: float
+        :return: elapsed time of step
+        """
+        with Timeline(previous=self.timeline, relocate=self.relocate) as timeline:
+            elapsed = _execute(step, start_time)
+        timeline.compile()
+        self.timeline = timeline
+        return elapsed
+
+
+class _Stacks:
+    def __init__(self):
+        # timelines recording (the innermost one receives the steps) and journals of the blocks being recorded,
+        # innermost last; one pair per build context (see ew_link.BuildContext)
+        self.timelines = []
+        self.journals = []
+
+
+def _stacks():
+    return ew.current_context().local('timing', _Stacks)
+
+
+def _execute(step, step_time):
+    # run a step, inside a node of the active timeline if recording
+    timelines = _stacks().timelines
+    if timelines:
+        return timelines[-1].call(step, step_time)
+    return step(step_time)
+
+
+class _Journal:
+    def __init__(self):
+        # side effects of a block being recorded, whether it can be cached at all, a hash of the effects so far, and
+        # the time dependent state it read [(lookup, time, args, value)]
+        self.effects = []
+        self.cacheable = True
+        self.context = 0
+        self.lookups = []
+
+    def add(self, effect, args):
+        self.effects.append((effect, args))
+        if isinstance(effect, TimedEffect):
+            # read through timed_lookup, which the blocks reading it check for themselves
+            return
+        try:
+            self.context = hash((self.context, effect, args))
+        except TypeError:
+            self.context = hash((self.context, effect, repr(args)))
+
+
+# relocatable blocks recorded so far: {(method, instance state): (transitions relative to start, elapsed, effects with
+# times relative to start)}
+_relocatable_cache = {}
+# persistent library consulted before recording a relocatable block (see blocklibrary.BlockLibrary), None for none
+block_library = None
+# attributes of a Sequence that change with every call and are not part of its state
+_timing_attributes = ('start_time', 'current_time', 'start_permanent')
+
+
+def record_effect(effect, *args):
+    """Applies a side effect of a step other than queuing transitions (e.g. setting a module flag). Relocatable blocks
+    replayed from their cache apply the effects journaled when they were recorded again (timed ones shifted to the new
+    start time, see TimedEffect).
+
+    :param effect: function applying the effect
+    :type effect: callable
+    :param args: arguments of effect
+    """
+    effect(*args)
+    for journal in _stacks().journals:
+        journal.add(effect, args)
+
+
+class TimedEffect:
+    def __init__(self, func):
+        """Side effect whose first argument is the sequence time it takes effect at (e.g. a coil turning on). Blocks
+        replayed at another start time (relocatable blocks, relocated timeline nodes) apply it shifted by the same
+        amount as their transitions:
+
+            _set_coil = TimedEffect(_assign_coil)
+            record_effect(_set_coil, seq_time, 'pinch_on', True)
+
+        :param func: function applying the effect, func(time, *args)
+        :type func: callable
+        """
+        self.func = func
+
+    def __call__(self, t, *args):
+        return self.func(t, *args)
+
+    def __eq__(self, other):
+        return isinstance(other, TimedEffect) and other.func is self.func
+
+    def __hash__(self):
+        return hash((TimedEffect, self.func))
+
+
+def _shift_effects(effects, dt):
+    # effects [(effect, args)] with the times of the timed ones moved by dt
+    return [(effect, (args[0] + dt,) + args[1:]) if isinstance(effect, TimedEffect) else (effect, args)
+            for effect, args in effects]
+
+
+def _shift_lookups(lookups, dt):
+    return [(lookup, t + dt, args, value) for lookup, t, args, value in lookups]
+
+
+def _lookups_hold(lookups, dt):
+    # whether the reads of a block give the same values again, dt later
+    return all(lookup(t + dt, *args) == value for lookup, t, args, value in lookups)
+
+
+def timed_lookup(lookup, t, *args):
+    """Reads state that depends on sequence time (e.g. which coils are on at time t, set through TimedEffect). The
+    blocks being recorded keep the read and its value: timeline nodes are reused only if their reads give the same
+    values again (at their new time if relocated), and relocatable blocks that read any are not cached.
+
+    :param lookup: function reading the state, lookup(t, *args)
+    :type lookup: callable
+    :param t: sequence time
+    :type t: float
+    :param args: further arguments of lookup
+    :return: value read
+    """
+    value = lookup(t, *args)
+    for journal in _stacks().journals:
+        journal.lookups.append((lookup, t, args, value))
+    return value
+
+
+def not_relocatable():
+    """Keeps the relocatable blocks being recorded out of the cache, for output whose transitions depend on more than
+    the block's own state (e.g. register shadows, SPI bus scheduling)"""
+    for journal in _stacks().journals:
+        journal.cacheable = False
+
+
+def clear_relocatable_cache():
+    _relocatable_cache.clear()
+
+
+def _state_key(value, seen=()):
+    # hashable snapshot of value, TypeError if there is none
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type)):
+        return value
+    if id(value) in seen:
+        return ('cycle', seen.index(id(value)))
+    seen = seen + (id(value),)
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_state_key(item, seen) for item in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple((key, _state_key(item, seen)) for key, item in value.items())
+    if isinstance(value, np.ndarray):
+        return ('array', value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, partial):
+        return ('partial', _state_key(value.func, seen), _state_key(value.args, seen), _state_key(value.keywords, seen))
+    if isinstance(value, types.MethodType):
+        return ('method', value.__func__, _state_key(value.__self__, seen))
+    if hasattr(value, '__dict__'):
+        # classes list attributes that are bookkeeping rather than state in _transient_attributes
+        skip = _timing_attributes + getattr(value, '_transient_attributes', ())
+        return (type(value),) + tuple((key, _state_key(item, seen)) for key, item in vars(value).items()
+                                      if key not in skip)
+    raise TypeError('no state key for {}'.format(type(value)))
+
+
 # Class to handle absolute and relative timing
 class Sequence:
     def __init__(self):
@@ -27,16 +464,93 @@ class Sequence:
         return the elapsed time for methods of daughter classes. Used to pass time from higher to lower level sequences.
         Assumes func takes one time parameter, func(time)"""
         def time_wrapper(self, t):
-            self.start_time = t
-            self.current_time = t
-            self.start_permanent = t
-            func(self, t)
-            time_elapsed = self.current_time - self.start_time
+            profiler = ew_profile.active
+            if profiler is not None:
+                profiler.enter(func.__qualname__)
+            try:
+                self.start_time = t
+                self.current_time = t
+                self.start_permanent = t
+                func(self, t)
+                time_elapsed = self.current_time - self.start_time
+            finally:
+                if profiler is not None:
+                    profiler.exit()
             return time_elapsed
         time_wrapper.__name__ = func.__name__
+        time_wrapper.__qualname__ = func.__qualname__
         time_wrapper.__doc__ = func.__doc__
         return time_wrapper
 
+    def _relocatable(func):
+        """Opt-in alternative to _update_time for methods whose transitions, relative to their start time, depend
+        only on the attributes of the instance (and the side effects of which go through record_effect). The first
+        call for a given instance state is executed and its transitions are recorded relative to its start time;
+        later calls with the same state queue the recorded block shifted to their start time in one append, without
+        executing any steps. Times of replayed transitions may differ from a full call in the last bit.
+
+        Calls outside of building a sequence, and blocks that touch register shadows or the SPI bus or read time dependent
+        state (timed_lookup), always execute.
+        """
+        timed = Sequence._update_time(func)
+
+        def relocatable_wrapper(self, t):
+            store = ew._store()
+            if not (store.building and store.local):
+                return timed(self, t)
+            try:
+                state = _state_key(self)
+                key = (func, state)
+                block = _relocatable_cache.get(key)
+            except TypeError:
+                return timed(self, t)
+            library_key = block_library.key(func, self, state) if block_library is not None else None
+            if library_key is not None:
+                if block is None:
+                    block = block_library.load(library_key)
+                    if block is not None:
+                        _relocatable_cache[key] = block
+
+            if block is not None:
+                records, elapsed, effects = block
+                self.start_time = t
+                self.current_time = t + elapsed
+                self.start_permanent = t
+                shifted = records.copy()
+                shifted['time'] += t
+                store.addElement(shifted.tobytes())
+                for effect, args in _shift_effects(effects, t):
+                    record_effect(effect, *args)
+                return elapsed
+
+            segment = ew.Segment()
+            journal = _Journal()
+            ew.push_sink(segment)
+            journals = _stacks().journals
+            journals.append(journal)
+            try:
+                elapsed = timed(self, t)
+            finally:
+                journals.pop()
+                ew.pop_sink()
+            # pass the output on where it would have gone (nodes included while recording a timeline)
+            if isinstance(store, ew.Segment):
+                store.items.extend(segment.items)
+            else:
+                store.addElement(b''.join(segment.chunks()))
+            if journal.cacheable and not journal.lookups:
+                records = segment.records().copy()
+                records['time'] -= t
+                effects = _shift_effects(journal.effects, -t)
+                _relocatable_cache[key] = (records, elapsed, effects)
+                if library_key is not None:
+                    block_library.store(library_key, records, elapsed, effects, func.__qualname__)
+            return elapsed
+        relocatable_wrapper.__name__ = func.__name__
+        relocatable_wrapper.__qualname__ = func.__qualname__
+        relocatable_wrapper.__doc__ = func.__doc__
+        return relocatable_wrapper
+
     # executes sequence seq at time t_step
     def abs(self, t_step, seq=null_func):
         """Execute seq at time t_step after self.start_time.
@@ -48,7 +562,7 @@ class Sequence:
         :rtype: float
         :return: elapsed time of seq"""
         self.current_time = t_step + self.start_time
-        step_time = seq(self.current_time)
+        step_time = _execute(seq, self.current_time)
         self.current_time += step_time
         return step_time
 
@@ -65,11 +579,11 @@ class Sequence:
         step_time = 0
         if type(seq) is list:
             for step in seq:
-                step_time = step(self.current_time)
+                step_time = _execute(step, self.current_time)
             self.current_time += step_time
             return step_time
         else:
-            step_time = seq(self.current_time)
+            step_time = _execute(seq, self.current_time)
             self.current_time += step_time
             return step_time
 
@@ -86,7 +600,7 @@ class Sequence:
         step_time = 0
         for seq in step_list:
             self.current_time += seq[0]
-            step_time = seq[1](self.current_time)
+            step_time = _execute(seq[1], self.current_time)
         self.current_time += step_time
         return step_time
 
@@ -0,0 +1,208 @@
+from Entangleware import ew_link as ew
+from Entangleware import ew_codec
+import datetime
+import json
+import pathlib
+import struct
+import threading
+import time
+import numpy as np
+
+# columns of a shot on disk, native byte order so they map without conversion
+_columns = {'time': '<f8', 'connector': 'u1', 'channel_mask': '<u4', 'output_enable_state': '<u4',
+            'output_state': '<u4'}
+
+
+def _jsonable(value):
+    # numpy scalars and arrays in seq_info, anything else as text
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _record_chunks(parts):
+    # transitions of the upload message parts, without the 4 byte cycle count at the start of the message
+    chunks = []
+    skip = 4
+    for part in parts:
+        view = memoryview(part).cast('B')
+        if skip:
+            cut = min(skip, len(view))
+            view, skip = view[cut:], skip - cut
+        if len(view):
+            chunks.append(np.frombuffer(view, dtype=ew.wire_dtype))
+    return chunks or [np.empty(0, dtype=ew.wire_dtype)]
+
+
+class ShotArchive:
+    def __init__(self, root='ShotArchive', params=None, storage='columns'):
+        """Append-only archive of compiled shots. Each shot is a directory holding its transitions and the
+        parameters it was run with; index.jsonl holds one line per shot for queries by parameter or date.
+
+        Transitions are stored as
+
+        * 'columns': one .npy file per record column, memory-mapped when read back
+        * 'delta': ew_codec column form (integer time deltas, channel dictionary), about 60 % of the upload message
+        * 'delta+zlib': the same, deflated, about 10 % of the upload message
+
+        Archive every shot run through ew_link by installing it as the hook:
+
+            ew.shot_archive = ShotArchive('D:/shots', params=lambda: Comm.seq_info)
+
+        Shots run from several build contexts (threads) at once are numbered and indexed one after the other.
+
+        :param root: directory of the archive, created if missing
+        :type root: str or pathlib.Path
+        :param params: parameters stored with each shot, a dict (copied when a shot is archived) or a function
+            returning one (called in the build context of the shot, e.g. for Comm.seq_info)
+        :type params: dict or callable
+        :param storage: 'columns', 'delta' or 'delta+zlib'
+        :type storage: str
+        """
+        if storage not in ('columns', 'delta', 'delta+zlib'):
+            raise ValueError("ShotArchive: storage must be 'columns', 'delta' or 'delta+zlib'")
+        self.storage = storage
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / 'index.jsonl'
+        self.params = params
+        self._index = None
+        self._lock = threading.Lock()
+
+    def index(self):
+        """All archived shots, oldest first
+
+        :rtype: list of dict
+        :return: entries with keys shot, date (ISO format), timestamp, records and params
+        """
+        if self._index is None:
+            self._index = []
+            if self.index_path.exists():
+                with open(self.index_path, 'r') as in_file:
+                    self._index = [json.loads(line) for line in in_file if line.strip()]
+        return self._index
+
+    def __len__(self):
+        return len(self.index())
+
+    def _shot_path(self, shot):
+        return self.root / 'shot_{:06d}'.format(shot)
+
+    def shot_params(self):
+        """Parameters of the shot being run: the archive's params, as stored in the index
+
+        :rtype: dict
+        """
+        params = self.params() if callable(self.params) else self.params
+        return json.loads(json.dumps(dict(params or {}), default=_jsonable))
+
+    def append(self, message, params=None):
+        """Archives one shot
+
+        :param message: upload message (4 byte cycle count followed by the transitions), or a list of buffers making
+            it up (e.g. the parts ew_link uploads, which are archived without joining them)
+        :type message: bytes or list
+        :param params: parameters of the shot, the archive's params (shot_params) by default
+        :type params: dict
+        :rtype: int
+        :return: shot number
+        """
+        if params is None:
+            params = self.shot_params()
+        chunks = _record_chunks(message if isinstance(message, (list, tuple)) else [message])
+        with self._lock:
+            index = self.index()
+            shot = index[-1]['shot'] + 1 if index else 0
+            path = self._shot_path(shot)
+            path.mkdir()
+            if self.storage == 'columns':
+                for name, dtype in _columns.items():
+                    column = np.concatenate([chunk[name] for chunk in chunks])
+                    np.save(path / (name + '.npy'), column.astype(dtype, copy=False))
+            else:
+                ew_codec.save(path / 'delta.npz', np.concatenate(chunks), compress=self.storage == 'delta+zlib')
+            now = time.time()
+            entry = {'shot': shot, 'date': datetime.datetime.fromtimestamp(now).isoformat(), 'timestamp': now,
+                     'records': sum(len(chunk) for chunk in chunks), 'storage': self.storage, 'params': dict(params or {})}
+            line = json.dumps(entry, default=_jsonable)
+            with open(path / 'params.json', 'w') as out_file:
+                out_file.write(line)
+            with open(self.index_path, 'a') as out_file:
+                out_file.write(line + '\n')
+            index.append(json.loads(line))
+            return shot
+
+    def find(self, since=None, until=None, **params):
+        """Shots matching all given parameter values and run in [since, until)
+
+        :param since: earliest date
+        :type since: datetime.datetime or str (ISO format)
+        :param until: end date
+        :type until: datetime.datetime or str (ISO format)
+        :param params: parameter values to match, e.g. tof=8
+        :rtype: list of dict
+        :return: index entries
+        """
+        if isinstance(since, str):
+            since = datetime.datetime.fromisoformat(since)
+        if isinstance(until, str):
+            until = datetime.datetime.fromisoformat(until)
+        found = []
+        for entry in self.index():
+            if since is not None and entry['timestamp'] < since.timestamp():
+                continue
+            if until is not None and entry['timestamp'] >= until.timestamp():
+                continue
+            if all(entry['params'].get(key) == value for key, value in params.items()):
+                found.append(entry)
+        return found
+
+    def columns(self, shot):
+        """Record columns of a shot, memory-mapped for shots stored as 'columns'
+
+        :param shot: shot number
+        :type shot: int
+        :rtype: dict {str: numpy.ndarray}
+        """
+        path = self._shot_path(shot)
+        if (path / 'delta.npz').exists():
+            records = ew_codec.load(path / 'delta.npz')
+            return {name: records[name] for name in _columns}
+        return {name: np.load(path / (name + '.npy'), mmap_mode='r') for name in _columns}
+
+    def records(self, shot):
+        """Transitions of a shot in the layout of the upload message
+
+        :param shot: shot number
+        :type shot: int
+        :rtype: numpy.ndarray (ew_link.wire_dtype)
+        """
+        path = self._shot_path(shot)
+        if (path / 'delta.npz').exists():
+            return ew_codec.load(path / 'delta.npz')
+        columns = self.columns(shot)
+        records = np.empty(len(columns['time']), dtype=ew.wire_dtype)
+        for name, column in columns.items():
+            records[name] = column
+        return records
+
+    def message(self, shot):
+        """Upload message of a shot, ready to send without recompiling
+
+        :param shot: shot number
+        :type shot: int
+        :rtype: bytes
+        """
+        number_cycles = 1
+        return struct.pack('>l', number_cycles) + self.records(shot).tobytes()
+
+    def replay(self, shot):
+        """Runs an archived shot again
+
+        :param shot: shot number
+        :type shot: int
+        :return: done message of the Entangleware software
+        """
+        return ew.rerun_sequence(self.message(shot))
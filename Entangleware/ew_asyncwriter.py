@@ -0,0 +1,168 @@
+import atexit
+import os
+import threading
+import time
+import warnings
+import zlib
+
+
+class _Job:
+    # key of a queued call in AsyncWriter._pending, never coalesced with anything else
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return getattr(self.func, '__qualname__', repr(self.func))
+
+
+class AsyncWriter:
+    def __init__(self, max_pending=16, exit_timeout=10.0):
+        """Writes files from a background thread so that building a sequence never waits on a (network) drive.
+
+        * writes to the same path coalesce: only the latest data still waiting is written
+        * files are replaced atomically (written to path.tmp, then renamed), readers never see half a file
+        * at most max_pending paths wait at a time; beyond that the oldest waiting write is dropped (and counted)
+        * pending writes are flushed when Python exits, waiting at most exit_timeout
+        * other slow work (e.g. archiving a shot) can be queued with call, it runs in order with the writes and is never
+          dropped
+
+        :param max_pending: maximum number of paths waiting to be written
+        :type max_pending: int
+        :param exit_timeout: longest wait for pending writes when Python exits (seconds), None to wait as long as it takes
+        :type exit_timeout: float
+        """
+        self.max_pending = max_pending
+        self._pending = {}
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = None
+        self.stats = {'submitted': 0, 'written': 0, 'coalesced': 0, 'dropped': 0, 'failures': 0, 'last_error': None,
+                      'last_latency': 0.0, 'max_latency': 0.0}
+        atexit.register(self._flush_at_exit, exit_timeout)
+
+    def write(self, path, data, on_done=None, compress_level=0):
+        """Queues data to be written to path, returns immediately. Buffers are written as they are when the write
+        happens, the caller must not modify them before (on_done tells when).
+
+        :param path: file to (re)write
+        :type path: str or pathlib.Path
+        :param data: file contents, or a list of buffers written one after the other
+        :type data: bytes, bytearray, memoryview, str or list
+        :param on_done: called (without arguments) once the data is written, dropped or failed
+        :type on_done: callable
+        :param compress_level: zlib level (1-9) to deflate the data with in the background, 0 to write it as is
+        :type compress_level: int
+        """
+        self._queue(os.fspath(path), (data, time.perf_counter(), on_done, compress_level))
+
+    def call(self, func, *args, on_done=None):
+        """Queues func(*args) to run in the background thread, after the writes queued before it. Never coalesced
+        nor dropped: it counts against max_pending, but once only calls are waiting they queue beyond it.
+
+        :param func: function to call
+        :type func: callable
+        :param args: arguments of func, which must not be modified before it runs
+        :param on_done: called (without arguments) once func has returned or failed
+        :type on_done: callable
+        """
+        self._queue(_Job(func, args), (None, time.perf_counter(), on_done, 0))
+
+    def _queue(self, key, entry):
+        with self._condition:
+            self.stats['submitted'] += 1
+            if key in self._pending:
+                self.stats['coalesced'] += 1
+                self._finish(self._pending.pop(key))
+            elif len(self._pending) >= self.max_pending:
+                # only file writes are dropped, a later write of the file is expected; calls are not repeated
+                oldest = next((waiting for waiting in self._pending if not isinstance(waiting, _Job)), None)
+                if oldest is not None:
+                    self.stats['dropped'] += 1
+                    self._finish(self._pending.pop(oldest))
+            self._pending[key] = entry
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='AsyncWriter', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    @staticmethod
+    def _finish(entry):
+        on_done = entry[2]
+        if on_done is None:
+            return
+        try:
+            on_done()
+        except Exception as error:
+            warnings.warn("AsyncWriter: on_done callback failed: {!r}".format(error))
+
+    def pending(self, path):
+        """Data still waiting to be written to path, None if there is none
+
+        :param path: file
+        :type path: str or pathlib.Path
+        """
+        with self._condition:
+            entry = self._pending.get(os.fspath(path))
+        return None if entry is None else entry[0]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                path = next(iter(self._pending))
+                entry = self._pending.pop(path)
+                self._busy = True
+            data, submitted, on_done, compress_level = entry
+            try:
+                if isinstance(path, _Job):
+                    path.func(*path.args)
+                else:
+                    if compress_level:
+                        parts = data if isinstance(data, (list, tuple)) else [data]
+                        data = zlib.compress(b''.join(parts), compress_level)
+                    self._replace(path, data)
+                with self._condition:
+                    self.stats['written'] += 1
+                    latency = time.perf_counter() - submitted
+                    self.stats['last_latency'] = latency
+                    self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+            except Exception as error:
+                with self._condition:
+                    self.stats['failures'] += 1
+                    self.stats['last_error'] = "{}: {!r}".format(path, error)
+                warnings.warn("AsyncWriter: writing {} failed: {!r}".format(path, error))
+            finally:
+                self._finish(entry)
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    @staticmethod
+    def _replace(path, data):
+        temp_path = path + '.tmp'
+        mode = 'w' if isinstance(data, str) else 'wb'
+        with open(temp_path, mode) as out_file:
+            for part in (data if isinstance(data, (list, tuple)) else [data]):
+                out_file.write(part)
+        os.replace(temp_path, path)
+
+    def flush(self, timeout=None):
+        """Waits until every queued write is done
+
+        :param timeout: maximum wait (seconds), None to wait as long as it takes
+        :type timeout: float
+        :rtype: bool
+        :return: True if nothing is left to write
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def _flush_at_exit(self, timeout):
+        if not self.flush(timeout):
+            warnings.warn("AsyncWriter: gave up waiting for {} pending writes at exit".format(len(self._pending)))
+
+
+# shared by everything writing files while sequences are built
+writer = AsyncWriter()
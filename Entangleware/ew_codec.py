@@ -0,0 +1,114 @@
+from Entangleware import ew_link as ew
+import io
+import numpy as np
+
+# shots are stored with this time resolution unless told otherwise (seconds); sequence times are sums of floats and
+# rarely whole nanoseconds, with picosecond ticks the remaining bits fit in a small integer
+default_resolution = 1e-12
+
+
+def _smallest_int(values):
+    # narrowest signed integer type holding all values
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return dtype
+    return np.int64
+
+
+def encode(records, resolution=default_resolution):
+    """Compact column form of a shot's transitions, lossless:
+
+    * times become integer ticks of resolution, stored as differences to the previous transition. The last bits of
+      each float time are kept as its distance (in units in the last place) from ticks * resolution, nearly always a
+      small number.
+    * connector, channel mask and output enable become an index into a dictionary of the combinations in use.
+    * output states are kept as they are.
+
+    :param records: transitions (ew_link.wire_dtype)
+    :type records: numpy.ndarray
+    :param resolution: tick length (seconds)
+    :type resolution: float
+    :rtype: dict {str: numpy.ndarray}
+    """
+    times = records['time'].astype(float)
+    ticks = np.rint(times / resolution).astype(np.int64)
+    # difference of the bit patterns; int64 arithmetic wraps, so decoding is exact for any float
+    ulps = times.view(np.int64) - (ticks.astype(float) * resolution).view(np.int64)
+
+    channels = np.stack((records['connector'], records['channel_mask'], records['output_enable_state']),
+                        axis=1).astype(np.uint32)
+    dictionary, channel_ids = np.unique(channels, axis=0, return_inverse=True)
+    id_dtype = np.uint8 if len(dictionary) <= 2 ** 8 else np.uint16 if len(dictionary) <= 2 ** 16 else np.uint32
+
+    deltas = np.diff(ticks, prepend=0)
+    return {'resolution': np.array(resolution),
+            'time_deltas': deltas.astype(_smallest_int(deltas)),
+            'time_ulps': ulps.astype(_smallest_int(ulps)),
+            'channels': dictionary,
+            'channel_ids': channel_ids.reshape(-1).astype(id_dtype),
+            'output_state': records['output_state'].astype(np.uint32)}
+
+
+def decode(columns):
+    """Transitions of a shot from its column form (inverse of encode)
+
+    :param columns: output of encode, or a loaded .npz
+    :type columns: dict
+    :rtype: numpy.ndarray (ew_link.wire_dtype)
+    """
+    channel_ids = np.asarray(columns['channel_ids'])
+    records = np.empty(len(channel_ids), dtype=ew.wire_dtype)
+    ticks = np.cumsum(columns['time_deltas'])
+    times_bits = (ticks.astype(float) * float(columns['resolution'])).view(np.int64)
+    records['time'] = (times_bits + np.asarray(columns['time_ulps']).astype(np.int64)).view(float)
+    channels = np.asarray(columns['channels'])[channel_ids]
+    records['connector'] = channels[:, 0]
+    records['channel_mask'] = channels[:, 1]
+    records['output_enable_state'] = channels[:, 2]
+    records['output_state'] = columns['output_state']
+    return records
+
+
+def save(path, records, compress=True, resolution=default_resolution):
+    """Writes a shot in column form as .npz
+
+    :param path: file (or file object) to write
+    :param records: transitions (ew_link.wire_dtype)
+    :type records: numpy.ndarray
+    :param compress: deflate (zlib) the columns
+    :type compress: bool
+    :param resolution: tick length (seconds)
+    :type resolution: float
+    """
+    columns = encode(records, resolution)
+    if compress:
+        np.savez_compressed(path, **columns)
+    else:
+        np.savez(path, **columns)
+
+
+def load(path):
+    """Reads a shot written by save
+
+    :param path: file to read
+    :rtype: numpy.ndarray (ew_link.wire_dtype)
+    """
+    with np.load(path) as columns:
+        return decode(columns)
+
+
+def size_ratio(records, compress=True, resolution=default_resolution):
+    """Size of a shot saved in column form relative to its upload message
+
+    :param records: transitions (ew_link.wire_dtype)
+    :type records: numpy.ndarray
+    :param compress: deflate (zlib) the columns
+    :type compress: bool
+    :param resolution: tick length (seconds)
+    :type resolution: float
+    :rtype: float
+    """
+    out_file = io.BytesIO()
+    save(out_file, records, compress, resolution)
+    return len(out_file.getbuffer()) / max(records.nbytes, 1)
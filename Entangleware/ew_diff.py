@@ -0,0 +1,209 @@
+from Entangleware import ew_link as ew
+from Entangleware.ew_runfile import CompiledRun, ANALOG_CONNECTOR
+import numpy as np
+
+# one transition of one channel
+event_dtype = np.dtype([('channel', 'i8'), ('time', 'f8'), ('value', 'f8')])
+shift_dtype = np.dtype([('channel', 'i8'), ('time_a', 'f8'), ('time_b', 'f8'), ('value', 'f8')])
+
+
+def channel_name(channel):
+    """Readable name of a channel id used in diffs
+
+    :param channel: channel id (wire connector * 32 + bit)
+    :type channel: int
+    :rtype: tuple
+    :return: ('digital', connector, pin), ('analog', board, channel) or ('connector', wire connector, bit)
+    """
+    wire_connector, bit = divmod(int(channel), 32)
+    if wire_connector == ANALOG_CONNECTOR:
+        return 'analog', bit // 8, bit % 8
+    if 1 <= wire_connector <= 4:
+        return 'digital', wire_connector - 1, bit
+    return 'connector', wire_connector, bit
+
+
+def _records(source):
+    # transitions of a record array, CompiledRun, upload message or sequence
+    if isinstance(source, CompiledRun):
+        return source.records
+    if isinstance(source, ew.Sequence):
+        return source.records()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return np.frombuffer(source, dtype=ew.wire_dtype, offset=4)
+    return np.asarray(source)
+
+
+def _events(records, resolution):
+    """Splits transitions into one event per channel
+
+    :rtype: tuple
+    :return: channel ids, integer times (ticks of resolution) and integer values (pin level or analog code)
+    """
+    wire_connector = records['connector'].astype(np.int64)
+    masks = records['channel_mask'].astype('<u4')
+    bits = np.unpackbits(masks.view(np.uint8).reshape(-1, 4), axis=1, bitorder='little')
+    record, bit = np.nonzero(bits)
+    states = records['output_state'].astype(np.uint32)[record]
+    analog = wire_connector[record] == ANALOG_CONNECTOR
+    values = np.where(analog, states.view(np.int32).astype(np.int64), (states >> bit.astype(np.uint32)) & 1)
+    channels = wire_connector[record] * 32 + bit
+    ticks = np.rint(records['time'][record] / resolution).astype(np.int64)
+    return channels.astype(np.int64), ticks, values.astype(np.int64)
+
+
+def _match(columns_a, columns_b):
+    """Multiset match of two tables of integer keys: the n-th occurrence of a key in a matches its n-th occurrence
+    in b. One lexsort of both tables, the order of appearance is kept within equal keys.
+
+    :param columns_a: key columns of a
+    :type columns_a: tuple of numpy.ndarray
+    :param columns_b: key columns of b, same number of columns
+    :type columns_b: tuple of numpy.ndarray
+    :rtype: tuple (numpy.ndarray, numpy.ndarray)
+    :return: boolean masks of the matched elements of a and b
+    """
+    n_a = len(columns_a[0])
+    n = n_a + len(columns_b[0])
+    columns = [np.concatenate((column_a, column_b)) for column_a, column_b in zip(columns_a, columns_b)]
+    if n == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    from_b = np.arange(n) >= n_a
+    order = np.lexsort([from_b] + columns[::-1])
+
+    # runs of equal keys, and within them runs of equal source
+    key_change = np.zeros(n, dtype=bool)
+    key_change[0] = True
+    for column in columns:
+        sorted_column = column[order]
+        key_change[1:] |= sorted_column[1:] != sorted_column[:-1]
+    sorted_b = from_b[order]
+    run_change = key_change.copy()
+    run_change[1:] |= sorted_b[1:] != sorted_b[:-1]
+
+    position = np.arange(n)
+    key_start = np.maximum.accumulate(np.where(key_change, position, 0))
+    run_start = np.maximum.accumulate(np.where(run_change, position, 0))
+    key_end = np.append(np.flatnonzero(key_change)[1:], n)[np.cumsum(key_change) - 1]
+    # a sorts before b within a key: a's run is [key_start, first b), b's run is [first b, key_end)
+    next_b = np.minimum.accumulate(np.where(sorted_b & run_change, position, n)[::-1])[::-1]
+    first_b = np.where(sorted_b, run_start, np.minimum(next_b, key_end))
+    count_a = first_b - key_start
+    count_b = key_end - first_b
+    rank = position - run_start
+    matched_sorted = rank < np.where(sorted_b, count_a, count_b)
+
+    matched = np.empty(n, dtype=bool)
+    matched[order] = matched_sorted
+    return matched[:n_a], matched[n_a:]
+
+
+class SequenceDiff:
+    def __init__(self, added, removed, shifted, unchanged, resolution):
+        """Difference between two compiled sequences, per channel
+
+        :param added: transitions only in the second sequence
+        :type added: numpy.ndarray (event_dtype)
+        :param removed: transitions only in the first sequence
+        :type removed: numpy.ndarray (event_dtype)
+        :param shifted: transitions in both, at different times
+        :type shifted: numpy.ndarray (shift_dtype)
+        :param unchanged: number of transitions at the same time in both
+        :type unchanged: int
+        :param resolution: time resolution of the comparison (seconds)
+        :type resolution: float
+        """
+        self.added = added
+        self.removed = removed
+        self.shifted = shifted
+        self.unchanged = unchanged
+        self.resolution = resolution
+
+    def __bool__(self):
+        return bool(len(self.added) or len(self.removed) or len(self.shifted))
+
+    @property
+    def stats(self):
+        """Summary statistics
+
+        :rtype: dict
+        """
+        shifts = self.shifted['time_b'] - self.shifted['time_a']
+        changed = np.concatenate((self.added['channel'], self.removed['channel'], self.shifted['channel']))
+        return {'unchanged': self.unchanged, 'added': len(self.added), 'removed': len(self.removed),
+                'shifted': len(self.shifted), 'channels_changed': len(np.unique(changed)),
+                'max_shift': float(np.max(np.abs(shifts))) if len(shifts) else 0.0}
+
+    def by_channel(self):
+        """Number of added, removed and shifted transitions per channel
+
+        :rtype: dict {tuple: (int, int, int)}
+        """
+        counts = {}
+        for position, events in enumerate((self.added, self.removed, self.shifted)):
+            channels, number = np.unique(events['channel'], return_counts=True)
+            for channel, n in zip(channels, number):
+                entry = counts.setdefault(channel_name(channel), [0, 0, 0])
+                entry[position] = int(n)
+        return {channel: tuple(entry) for channel, entry in sorted(counts.items())}
+
+    def summary(self):
+        """Human readable summary, one line per changed channel
+
+        :rtype: str
+        """
+        stats = self.stats
+        lines = ["{unchanged} unchanged, {added} added, {removed} removed, {shifted} shifted "
+                 "(max shift {max_shift:.9f} s) on {channels_changed} channels".format(**stats)]
+        for channel, (added, removed, shifted) in self.by_channel().items():
+            lines.append("  {}: +{} -{} ~{}".format(channel, added, removed, shifted))
+        return '\n'.join(lines)
+
+
+def diff(sequence_a, sequence_b, resolution=1e-9):
+    """Compares two compiled sequences channel by channel. Transitions with the same channel, time and value are
+    unchanged. Of the rest, the n-th remaining transition to a value on a channel in one sequence is paired with the
+    n-th in the other as a time shift; whatever is left is added or removed.
+
+    :param sequence_a: first (reference) sequence: record array, CompiledRun, upload message or ew_link.Sequence
+    :param sequence_b: second sequence, same types
+    :param resolution: times closer than this are equal (seconds)
+    :type resolution: float
+    :rtype: SequenceDiff
+    """
+    channels_a, ticks_a, values_a = _events(_records(sequence_a), resolution)
+    channels_b, ticks_b, values_b = _events(_records(sequence_b), resolution)
+
+    # exact matches
+    same_a, same_b = _match((channels_a, ticks_a, values_a), (channels_b, ticks_b, values_b))
+    unchanged = int(np.count_nonzero(same_a))
+
+    # leftovers, paired in time order per channel and value
+    left_a = np.flatnonzero(~same_a)
+    left_b = np.flatnonzero(~same_b)
+    left_a = left_a[np.lexsort((ticks_a[left_a], values_a[left_a], channels_a[left_a]))]
+    left_b = left_b[np.lexsort((ticks_b[left_b], values_b[left_b], channels_b[left_b]))]
+    paired_a, paired_b = _match((channels_a[left_a], values_a[left_a]), (channels_b[left_b], values_b[left_b]))
+
+    def as_values(channels, values):
+        # analog codes back to volts
+        return np.where(channels // 32 == ANALOG_CONNECTOR, values / 2 ** 16 * 20, values)
+
+    shifted = np.empty(np.count_nonzero(paired_a), dtype=shift_dtype)
+    from_a = left_a[paired_a]
+    from_b = left_b[paired_b]
+    shifted['channel'] = channels_a[from_a]
+    shifted['time_a'] = ticks_a[from_a] * resolution
+    shifted['time_b'] = ticks_b[from_b] * resolution
+    shifted['value'] = as_values(channels_a[from_a], values_a[from_a])
+
+    def as_events(channels, ticks, values, index):
+        events = np.empty(len(index), dtype=event_dtype)
+        events['channel'] = channels[index]
+        events['time'] = ticks[index] * resolution
+        events['value'] = as_values(channels[index], values[index])
+        return np.sort(events, order=['channel', 'time'])
+
+    removed = as_events(channels_a, ticks_a, values_a, left_a[~paired_a])
+    added = as_events(channels_b, ticks_b, values_b, left_b[~paired_b])
+    return SequenceDiff(added, removed, np.sort(shifted, order=['channel', 'time_a']), unchanged, resolution)
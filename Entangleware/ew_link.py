@@ -2,11 +2,15 @@ from Entangleware.ew_udpmulticast import UdpMulticaster
 from Entangleware.ew_tcpserver import TcpServer
 from Entangleware.ew_tcpendpoint import TcpEndPoint
 from Entangleware.ew_udplocal import UdpLocal
+import contextvars
 import struct
 import time
 import numpy as np
 import pathlib
 import math
+import zlib
+from Entangleware.ew_asyncwriter import writer
+from Entangleware import ew_profile
 
 # debug max and min time global
 # max_time = float('-inf')
@@ -14,6 +18,12 @@ import math
 
 # create global max_time. Add to set_digital_state and set_analog_state something that compares the seqtime and
 # updates max_time as needed. May want minimum time as well.
+
+# numpy layout of one sequence element, same bytes as struct format '>dLLLL' used by set_digital_state
+wire_dtype = np.dtype([('time', '>f8'), ('connector', '>u4'), ('channel_mask', '>u4'),
+                       ('output_enable_state', '>u4'), ('output_state', '>u4')])
+
+
 class ConnectionManager:
     def __init__(self):
         self.isConnected = False
@@ -21,6 +31,8 @@ class ConnectionManager:
         self.udp_local = None
         self.tcp_endpoint = None
         self.localudp = True
+        # messages uploaded through this connection (run or replayed, from any build context), see foreign_uploads
+        self.uploads = 0
 
     def close(self):
         self.isConnected = False
@@ -52,6 +64,7 @@ class DDS:
         self._dds_refclkmultiplier = 20
         self._dds_sysclock = self._dds_refclkmultiplier * self._dds_refclock
 
+    @ew_profile.profiled
     def _spi(self, spitime,  bytes_to_write):
         # IOUpdate Low
         set_digital_state(spitime+self.spi_min_time, self.connector, 1 << self.ioupdatepin, 1 << self.ioupdatepin,
@@ -144,6 +157,11 @@ class Sequence:
         self.seqview = memoryview(self.seq)
         self.seqchainfirstcall = True
         self.seqchainlastruntime = 0
+        # counts cleared buffers, so register shadows can tell which shot their history belongs to
+        self.generation = 0
+        self.sent_generation = -1
+        # buffers sent, so register shadows can tell whether anything else was uploaded since (see foreign_uploads)
+        self.sends = 0
 
     def addElement(self, element):
         # element is a byte array whose length is a multiple of self.lengthpayload
@@ -165,6 +183,9 @@ class Sequence:
         # print(length_element)
         self.seqview[start_index:(start_index + length_element)] = element
         self.seqendindex += length_element / self.lengthpayload
+        profiler = ew_profile.active
+        if profiler is not None:
+            profiler.appended(length_element)
 
 
     # def addElement(self, element):
@@ -178,15 +199,164 @@ class Sequence:
     #         self.seqview = memoryview(self.seq)
     #         print('new seqview')
 
+    def records(self):
+        """Transitions queued so far, in the order they were added
+
+        :rtype: numpy.ndarray
+        :return: structured array (wire_dtype) viewing the sequence buffer
+        """
+        return np.frombuffer(self.seq, dtype=wire_dtype, count=int(self.seqendindex))
+
     def clear(self):
         self.building = False
         self.seqview.release()
         self.seq = bytearray(self.lengthpayload * self.lengthsequence)
         self.seqview = memoryview(self.seq)
         self.seqendindex = 0
+        self.generation += 1
+
+
+class Segment:
+    def __init__(self):
+        """Collects the transitions queued while it is the active sink (see push_sink) instead of the sequence buffer.
+        items holds them in the order they were queued, as bytes or nested segments."""
+        self.items = []
+
+    @property
+    def building(self):
+        return _context.get().sequence.building
+
+    @property
+    def local(self):
+        return _context.get().sequence.local
+
+    def addElement(self, element):
+        if (len(element) % _context.get().sequence.lengthpayload) != 0:
+            raise ValueError('Length of \'element\' is not correct')
+        self.items.append(bytes(element))
+        profiler = ew_profile.active
+        if profiler is not None:
+            profiler.appended(len(element))
+
+    def chunks(self):
+        # queued bytes, nested segments expanded in place
+        for item in self.items:
+            if isinstance(item, Segment):
+                yield from item.chunks()
+            else:
+                yield item
+
+    def records(self):
+        """Transitions queued into this segment and the segments nested in it, in the order they were queued
+
+        :rtype: numpy.ndarray
+        :return: structured array (wire_dtype)
+        """
+        return np.frombuffer(b''.join(self.chunks()), dtype=wire_dtype)
+
+
+class BuildContext:
+    def __init__(self, sequence=None, connection=None):
+        """Everything a shot is built with: the sequence buffer, the connection to the Entangleware software, the stack
+        of sinks (push_sink), the upload message of the last shot run (last_run_parts) and the state other modules keep
+        while building (coil states, register shadows, timelines, seq_info, see local). The active context is held in a
+        context variable, so each thread (or asyncio task) building a shot can use its own; ew_link.msgseq and
+        ew_link.connmgr are the sequence and connection of the active context. Code that never enters a context uses the
+        default one, as before:
+
+            with BuildContext() as context:
+                ew.build_sequence()
+                evap.seq(0.00)
+                records = context.sequence.records()
+
+        :param sequence: transition store, a new Sequence if None
+        :type sequence: Sequence
+        :param connection: connection to upload through, that of the active context if None (uploads through one
+            connection must not overlap)
+        :type connection: ConnectionManager
+        """
+        self.sequence = sequence if sequence is not None else Sequence()
+        self.connection = connection if connection is not None else _context.get().connection
+        self.sinks = []
+        self.state = {}
+        # upload message of the last shot run from this context, kept in memory for rerun_last_sequence
+        self.last_run_parts = None
+        self._tokens = []
+
+    def local(self, key, factory):
+        """State a module keeps per build (e.g. the coil states of magnetics), created by factory on first use
+
+        :param key: name of the state, e.g. the module name
+        :type key: hashable
+        :param factory: called without arguments to create the state
+        :type factory: callable
+        """
+        try:
+            return self.state[key]
+        except KeyError:
+            return self.state.setdefault(key, factory())
+
+    def __enter__(self):
+        self._tokens.append(_context.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _context.reset(self._tokens.pop())
+        return False
+
+
+def current_context():
+    """Build context of the running thread/task
+
+    :rtype: BuildContext
+    """
+    return _context.get()
+
+
+def upload_mark():
+    """Marks the uploads so far through the connection of the active build context, see foreign_uploads
+
+    :rtype: tuple
+    """
+    context = _context.get()
+    return context.connection.uploads, context.sequence.sends
+
+
+def foreign_uploads(mark):
+    """Checks whether anything besides the sequence buffer of the active build context was uploaded through its
+    connection since mark (a replayed message, a shot of another build context sharing the connection). The hardware
+    then no longer holds the values the last run of the buffer left behind.
+
+    :param mark: upload_mark() at the time the values were known
+    :type mark: tuple
+    :rtype: bool
+    """
+    uploads, sends = upload_mark()
+    return uploads - mark[0] != sends - mark[1]
+
+
+def push_sink(sink):
+    """Queues transitions into sink (e.g. a Segment) until pop_sink
+
+    :param sink: object with building, local and addElement like Sequence
+    """
+    _context.get().sinks.append(sink)
+
+
+def pop_sink():
+    return _context.get().sinks.pop()
+
+
+def _store():
+    # where transitions being built go: the innermost sink, the sequence buffer when there is none
+    context = _context.get()
+    if context.sinks:
+        return context.sinks[-1]
+    return context.sequence
 
 
 def connect(timeout_sec=None):
+    connmgr = _context.get().connection
     if(connmgr.localudp):
         connmgr.udp_local = UdpLocal()
     else:
@@ -206,11 +376,14 @@ def connect(timeout_sec=None):
 
 
 def disconnect():
+    connmgr = _context.get().connection
     if connmgr.isConnected:
         connmgr.close()
 
 
 def build_sequence():
+    msgseq = _context.get().sequence
+    connmgr = _context.get().connection
     if msgseq.local:
         msgseq.building = True
     else:
@@ -220,6 +393,8 @@ def build_sequence():
 
 
 def clear_sequence():
+    msgseq = _context.get().sequence
+    connmgr = _context.get().connection
     if msgseq.local:
         msgseq.clear()
     else:
@@ -228,11 +403,24 @@ def clear_sequence():
     return
 
 
-def rerun_last_sequence():
-    pathtoTemp = pathlib.Path().absolute().__str__()+'\\LastCompiledRun.dat'
-    with open(pathtoTemp, "rb") as in_file:
-        tcpmessage = in_file.read()
-    connmgr.tcp_endpoint.sendmsg(tcpmessage, 0, 22)
+def last_run_path(compressed=False):
+    # upload message of the last run, in the working directory
+    if compressed:
+        return pathlib.Path.cwd() / 'LastCompiledRun.dat.zlib'
+    return pathlib.Path.cwd() / 'LastCompiledRun.dat'
+
+
+def rerun_sequence(tcpmessage):
+    """Runs an already compiled upload message (e.g. from LastCompiledRun.dat or a ShotArchive)
+
+    :param tcpmessage: 4 byte cycle count followed by the transitions, or a list of buffers making up the message
+    :type tcpmessage: bytes or list
+    :return: done message of the Entangleware software
+    """
+    connmgr = _context.get().connection
+    parts = tcpmessage if isinstance(tcpmessage, (list, tuple)) else [tcpmessage]
+    connmgr.tcp_endpoint.sendmsg_parts(parts, 0, 22)
+    connmgr.uploads += 1
     runreturn = connmgr.tcp_endpoint.getmsg()
     runtime = struct.unpack('>d', runreturn[0])
     print(runtime[0])
@@ -242,25 +430,68 @@ def rerun_last_sequence():
     return donemsg
 
 
+def rerun_last_sequence():
+    # the last message is still in memory unless this is a new session (or nothing was run from this build context)
+    last_run_parts = _context.get().last_run_parts
+    if last_run_parts is not None:
+        return rerun_sequence(last_run_parts)
+    path = last_run_path()
+    compressed_path = last_run_path(compressed=True)
+    if compressed_path.exists() and (not path.exists() or compressed_path.stat().st_mtime > path.stat().st_mtime):
+        with open(compressed_path, "rb") as in_file:
+            return rerun_sequence(zlib.decompress(in_file.read()))
+    with open(path, "rb") as in_file:
+        tcpmessage = in_file.read()
+    return rerun_sequence(tcpmessage)
+
+
+def _message_parts(tosend, prefix=None):
+    # upload message as the cycle count, the prefix (if any) and a view of the sequence buffer, nothing is copied
+    msgseq = _context.get().sequence
+    length = int(msgseq.seqendindex) * msgseq.lengthpayload
+    if prefix:
+        return [bytes(tosend), prefix, memoryview(msgseq.seq)[:length]]
+    return [bytes(tosend), memoryview(msgseq.seq)[:length]]
+
+
+def _save_run(parts):
+    # the parts keep the sent buffer alive after the sequence is cleared until they are replaced by the next run
+    _context.get().last_run_parts = parts
+    writer.write(last_run_path(compressed=bool(last_run_compression)), parts, compress_level=last_run_compression)
+    if shot_archive is not None and parts:
+        # parameters now, in the context of the shot; the transitions are archived in the background
+        writer.call(shot_archive.append, parts, shot_archive.shot_params())
+
+
 # where it is packing up everything and sending over to entangleware software
-def run_sequence():
+def run_sequence(prefix=None):
+    """Uploads and runs the sequence buffer
+
+    :param prefix: transitions sent ahead of the sequence buffer (immutable, e.g. the shared prefix of a scan, see
+        scan.ScanRunner); only used when building locally
+    :type prefix: bytes
+    :return: done message of the Entangleware software
+    """
+    msgseq = _context.get().sequence
+    connmgr = _context.get().connection
     number_cycles = 1  # Don't Change (feature not yet implemented)
     tosend = bytearray(struct.pack('>l', number_cycles))
-    tcpmessage = b""
+    parts = []
     msgseq.seqendindex = int(msgseq.seqendindex)
     if msgseq.local:
         print(msgseq.seqendindex)
-        tcpmessage = tosend + msgseq.seqview.tobytes()[:msgseq.seqendindex*msgseq.lengthpayload]
-        connmgr.tcp_endpoint.sendmsg(tcpmessage, 0, 22)
+        parts = _message_parts(tosend, prefix)
+        connmgr.tcp_endpoint.sendmsg_parts(parts, 0, 22)
+        msgseq.sent_generation = msgseq.generation
+        msgseq.sends += 1
         msgseq.clear()
     else:
         connmgr.tcp_endpoint.sendmsg(tosend, 0, 18)
+    connmgr.uploads += 1
     runreturn = connmgr.tcp_endpoint.getmsg()
     runtime = struct.unpack('>d', runreturn[0])
     print(runtime[0])
-    pathtoTemp = pathlib.Path().absolute().__str__()+'\\LastCompiledRun.dat'
-    with open(pathtoTemp, "wb") as out_file:
-        out_file.write(tcpmessage)
+    _save_run(parts)
     # 20.5 is a fudge factor to have a longer buffer for a timeout
     connmgr.tcp_endpoint._sock.settimeout(runtime[0]+20.5)
     # when we're waiting for deadtime we're waiting for this donemsg
@@ -274,6 +505,8 @@ def run_sequence():
 
 
 def run_sequence_chain():
+    msgseq = _context.get().sequence
+    connmgr = _context.get().connection
     if not msgseq.seqchainfirstcall:
         connmgr.tcp_endpoint._sock.settimeout(msgseq.seqchainlastruntime + 20.5)
         donemsg = connmgr.tcp_endpoint.getmsg()
@@ -283,25 +516,27 @@ def run_sequence_chain():
 
     number_cycles = 1  # Don't Change (feature not yet implemented)
     tosend = bytearray(struct.pack('>l', number_cycles))
-    tcpmessage = b""
+    parts = []
     if msgseq.local:
         print(msgseq.seqendindex)
-        tcpmessage = tosend + msgseq.seqview.tobytes()[:msgseq.seqendindex*msgseq.lengthpayload]
-        connmgr.tcp_endpoint.sendmsg(tcpmessage, 0, 22)
+        parts = _message_parts(tosend)
+        connmgr.tcp_endpoint.sendmsg_parts(parts, 0, 22)
+        msgseq.sent_generation = msgseq.generation
+        msgseq.sends += 1
         msgseq.clear()
     else:
         connmgr.tcp_endpoint.sendmsg(tosend, 0, 18)
+    connmgr.uploads += 1
     runreturn = connmgr.tcp_endpoint.getmsg()
     runtime = struct.unpack('>d', runreturn[0])
     msgseq.seqchainlastruntime = runtime[0]
-    pathtoTemp = pathlib.Path().absolute().__str__()+'\\LastCompiledRun.dat'
-    with open(pathtoTemp, "wb") as out_file:
-        out_file.write(tcpmessage)
+    _save_run(parts)
     msgseq.seqchainfirstcall = False
     return
 
 
 def stop_sequence():
+    connmgr = _context.get().connection
     number_cycles = 1
     tosend = bytearray(struct.pack('>l', number_cycles))
     connmgr.tcp_endpoint.sendmsg(tosend, 0, 19)
@@ -341,16 +576,71 @@ def set_digital_state(seqtime, connector, channel_mask, output_enable_state, out
     # if seqtime > max_time:
     #     max_time = seqtime
 
-    if msgseq.building and msgseq.local:
+    store = _store()
+    if store.building and store.local:
         if connector < 0 or connector > 3:
             connector = 0
         else:
             connector = connector + 1
         tosend = bytearray(struct.pack('>dLLLL', seqtime, connector, channel_mask, output_enable_state, output_state))
-        msgseq.addElement(tosend)
+        store.addElement(tosend)
+        profiler = ew_profile.active
+        if profiler is not None:
+            profiler.emitted(1)
     else:
         tosend = bytearray(struct.pack('>dLLLL', seqtime, connector, channel_mask, output_enable_state, output_state))
-        connmgr.tcp_endpoint.sendmsg(tosend, 0, 20)
+        _context.get().connection.tcp_endpoint.sendmsg(tosend, 0, 20)
+    return
+
+
+def set_digital_states(seq_times, connector, channel_mask, output_enable_state, output_states):
+    """Sets many digital output states on one connector at once.
+
+    Equivalent to calling 'set_digital_state' for every element of 'seq_times', but while building the elements are
+    packed with numpy and queued into the sequence with a single append. Use for long bursts of transitions
+    (e.g. serial writes) where one call per transition is too slow.
+
+    Parameters:
+
+        :param seq_times: Absolute times, in seconds, when each state will change. (array of double)
+
+        :param connector: Connector of the 7820R (unsigned 32-bit integer)
+
+        :param channel_mask: Mask of the channel(s) to be changed, shared by all elements or one per element
+
+        :param output_enable_state: State of output enable, shared by all elements or one per element
+
+        :param output_states: State of the channel(s) starting at each time (array of unsigned 32-bit integer)
+
+
+    Returns:
+
+        :return:
+    """
+    seq_times = np.asarray(seq_times, dtype=float)
+    store = _store()
+    if store.building and store.local:
+        if connector < 0 or connector > 3:
+            connector = 0
+        else:
+            connector = connector + 1
+        elements = np.empty(len(seq_times), dtype=wire_dtype)
+        elements['time'] = seq_times
+        elements['connector'] = connector
+        elements['channel_mask'] = channel_mask
+        elements['output_enable_state'] = output_enable_state
+        elements['output_state'] = output_states
+        store.addElement(elements.tobytes())
+        profiler = ew_profile.active
+        if profiler is not None:
+            profiler.emitted(len(elements))
+    else:
+        channel_mask = np.broadcast_to(channel_mask, seq_times.shape)
+        output_enable_state = np.broadcast_to(output_enable_state, seq_times.shape)
+        output_states = np.broadcast_to(output_states, seq_times.shape)
+        for indx in range(len(seq_times)):
+            set_digital_state(float(seq_times[indx]), connector, int(channel_mask[indx]),
+                              int(output_enable_state[indx]), int(output_states[indx]))
     return
 
 
@@ -363,10 +653,11 @@ def set_analog_state(seq_time, board, channel, value):
     #     max_time = seq_time
 
     numtype = (int, float)
+    store = _store()
     # print(type(seq_time))
     if isinstance(seq_time, numtype) and isinstance(board, numtype) and isinstance(channel, numtype) and \
             isinstance(value, numtype):
-        if msgseq.building and msgseq.local:
+        if store.building and store.local:
             board_in_range = (board == 0 or board == 1)
             channel_in_range = (0 <= channel <= 7)
             output_enable_state = 0
@@ -384,15 +675,18 @@ def set_analog_state(seq_time, board, channel, value):
                 channel_mask = 1 << shift_amount
                 to_send = bytearray(
                     struct.pack('>dLLLl', seq_time, connector, channel_mask, output_enable_state, output_state))
-                msgseq.addElement(to_send)
+                store.addElement(to_send)
+                profiler = ew_profile.active
+                if profiler is not None:
+                    profiler.emitted(1)
 
         else:
             to_send = bytearray(struct.pack('>dBBd', seq_time, board, channel, value))
-            connmgr.tcp_endpoint.sendmsg(to_send, 0, 21)
+            _context.get().connection.tcp_endpoint.sendmsg(to_send, 0, 21)
     elif isinstance(seq_time, list) and isinstance(board, numtype) and isinstance(channel, numtype) and \
             isinstance(value, list):
         print('in list mode')
-        if msgseq.building and msgseq.local:
+        if store.building and store.local:
             board_in_range = (board == 0 or board == 1)
             channel_in_range = (0 <= channel <= 7)
             output_enable_state = 0
@@ -428,7 +722,10 @@ def set_analog_state(seq_time, board, channel, value):
                 data_to_pack[3::5] = output_enable_state
                 data_to_pack[4::5] = output_state
                 to_send = bytearray(struct.pack(str_fmt, *data_to_pack))
-                msgseq.addElement(to_send)
+                store.addElement(to_send)
+                profiler = ew_profile.active
+                if profiler is not None:
+                    profiler.emitted(length_payload)
         else:
             raise ValueError
     else:
@@ -436,12 +733,76 @@ def set_analog_state(seq_time, board, channel, value):
     return
 
 
-connmgr = ConnectionManager()
+def set_analog_states(seq_times, board, channel, values):
+    """Sets many analog output values on one channel at once.
+
+    Equivalent to calling 'set_analog_state' for every element of 'seq_times', but while building the elements are
+    packed with numpy and queued into the sequence with a single append. Use for ramps, where one call per DAC step is
+    too slow.
+
+    Parameters:
+
+        :param seq_times: Absolute times, in seconds, when each value is output. (array of double)
+
+        :param board: Analog board, 0 or 1 (integer)
+
+        :param channel: Channel of the board, 0 to 7 (integer)
+
+        :param values: Output voltages, -10 to 10 V (array of double)
+
+
+    Returns:
+
+        :return:
+    """
+    seq_times = np.asarray(seq_times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    store = _store()
+    if store.building and store.local:
+        if not ((board == 0 or board == 1) and 0 <= channel <= 7):
+            return
+        elements = np.empty(len(seq_times), dtype=wire_dtype)
+        elements['time'] = seq_times
+        elements['connector'] = 5
+        elements['channel_mask'] = 1 << (board * 8 + channel)
+        elements['output_enable_state'] = 0
+        # same truncation and clipping as set_analog_state
+        elements['output_state'] = np.clip(np.trunc((values / 20) * 2 ** 16), -2 ** 15, 2 ** 15 - 1).astype(np.int64)
+        store.addElement(elements.tobytes())
+        profiler = ew_profile.active
+        if profiler is not None:
+            profiler.emitted(len(elements))
+    else:
+        for indx in range(len(seq_times)):
+            set_analog_state(float(seq_times[indx]), board, channel, float(values[indx]))
+    return
+
+
 dds = DDS()
-msgseq = Sequence()
-msgseq.local = True
+# build context used outside of any "with BuildContext()" (in every thread), owning the process wide buffer and
+# connection
+_default_context = BuildContext(sequence=Sequence(), connection=ConnectionManager())
+_context = contextvars.ContextVar('ew_link_build_context', default=_default_context)
+# ShotArchive (ew_archive) receiving every local shot that is run, from any build context, None to keep only
+# LastCompiledRun.dat
+shot_archive = None
+# zlib level for LastCompiledRun.dat (written as LastCompiledRun.dat.zlib), 0 for no compression
+last_run_compression = 0
+
+
+def __getattr__(name):
+    # msgseq, connmgr and last_run_parts follow the active build context
+    if name == 'msgseq':
+        return _context.get().sequence
+    if name == 'connmgr':
+        return _context.get().connection
+    if name == 'last_run_parts':
+        return _context.get().last_run_parts
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 if __name__ == "__main__":
+    connmgr = _default_context.connection
     for numbers in range(5):
         print(str(numbers)+' connecting...')
         connect()
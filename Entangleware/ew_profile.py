@@ -0,0 +1,243 @@
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+
+# None when no profiler is active anywhere (the hooks in timing, ew_link and boards only check this), otherwise the
+# dispatcher handing their calls to the profiler of the calling context
+active = None
+# profiler of the running thread/task (contextvars context), the process profiler (EW_PROFILE) outside of any
+_current = contextvars.ContextVar('ew_profile_profiler', default=None)
+_process_profiler = None
+_active_count = 0
+_count_lock = threading.Lock()
+
+
+class Profiler:
+    def __init__(self, name='shot'):
+        """Records, for every subsequence executed while it is active, its wall time, the transitions it emitted
+        (set_digital_state(s), set_analog_state(s)) and the bytes it appended to the sequence buffer or a segment, the
+        ones of nested subsequences included. Subsequences are the methods decorated with Sequence._update_time and
+        the SPI writes of the boards. Use as a context manager, or set the environment variable EW_PROFILE to a file
+        name to profile the whole process and save the profile when Python exits:
+
+            with Profiler() as profiler:
+                evap.seq(0.00)
+            print(profiler.report())
+            profiler.save('evap.speedscope.json')     # or 'evap.trace.json' for chrome://tracing / Perfetto
+
+        Costs one check of ew_profile.active per hook when no profiler is active. A profiler records the thread (or
+        asyncio task) it is entered in, so shots built concurrently in other threads are not mixed into it. A block
+        replayed by a relocatable step or passed on from a segment is appended (and counted) once more where it goes.
+
+        :param name: name of the profile in exported files
+        :type name: str
+        """
+        self.name = name
+        # completed frames [(thread id, name path, start, end, transitions, bytes)], in the order they ended
+        self.frames = []
+        # open and close events per thread for speedscope [(thread id, 'O' or 'C', name, time)]
+        self.events = []
+        self._local = threading.local()
+        self._tokens = []
+        self.start_time = time.perf_counter()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def __enter__(self):
+        self._tokens.append(_current.set(self))
+        _activate(1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.reset(self._tokens.pop())
+        _activate(-1)
+        return False
+
+    def enter(self, name):
+        now = time.perf_counter()
+        self._stack().append([name, now, 0, 0])
+        self.events.append((threading.get_ident(), 'O', name, now))
+
+    def exit(self):
+        now = time.perf_counter()
+        stack = self._stack()
+        name, start, transitions, appended = stack.pop()
+        path = tuple(frame[0] for frame in stack) + (name,)
+        if stack:
+            stack[-1][2] += transitions
+            stack[-1][3] += appended
+        tid = threading.get_ident()
+        self.events.append((tid, 'C', name, now))
+        self.frames.append((tid, path, start, now, transitions, appended))
+
+    def emitted(self, count):
+        stack = self._stack()
+        if stack:
+            stack[-1][2] += count
+
+    def appended(self, length):
+        stack = self._stack()
+        if stack:
+            stack[-1][3] += length
+
+    def summary(self):
+        """Totals per nested subsequence
+
+        :rtype: dict
+        :return: {name path: {'calls', 'wall', 'self_wall', 'transitions', 'bytes'}}, path from the outermost
+            subsequence down
+        """
+        totals = {}
+        for tid, path, start, end, transitions, appended in self.frames:
+            entry = totals.setdefault(path, {'calls': 0, 'wall': 0.0, 'self_wall': 0.0, 'transitions': 0, 'bytes': 0})
+            entry['calls'] += 1
+            entry['wall'] += end - start
+            entry['self_wall'] += end - start
+            entry['transitions'] += transitions
+            entry['bytes'] += appended
+        for path, entry in totals.items():
+            if len(path) > 1 and path[:-1] in totals:
+                totals[path[:-1]]['self_wall'] -= entry['wall']
+        return totals
+
+    def report(self, limit=20):
+        """Table of the subsequences taking the most time, by time spent in them (not in nested subsequences)
+
+        :param limit: number of rows
+        :type limit: int
+        :rtype: str
+        """
+        rows = sorted(self.summary().items(), key=lambda item: item[1]['self_wall'], reverse=True)[:limit]
+        lines = ['{:>10} {:>10} {:>7} {:>11} {:>11}  {}'.format('self ms', 'total ms', 'calls', 'transitions',
+                                                                  'bytes', 'subsequence')]
+        for path, entry in rows:
+            lines.append('{:10.3f} {:10.3f} {:7d} {:11d} {:11d}  {}'.format(
+                entry['self_wall'] * 1e3, entry['wall'] * 1e3, entry['calls'], entry['transitions'], entry['bytes'],
+                ' > '.join(path)))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Profile in the Chrome trace event format (chrome://tracing, Perfetto), one complete event per frame
+
+        :rtype: dict
+        """
+        pid = os.getpid()
+        events = [{'name': path[-1], 'ph': 'X', 'ts': (start - self.start_time) * 1e6, 'dur': (end - start) * 1e6,
+                   'pid': pid, 'tid': tid, 'args': {'transitions': transitions, 'bytes': appended}}
+                  for tid, path, start, end, transitions, appended in self.frames]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'name': self.name}}
+
+    def speedscope(self):
+        """Profile in the speedscope file format (www.speedscope.app), one evented profile per thread
+
+        :rtype: dict
+        """
+        frames = []
+        index = {}
+        profiles = {}
+        for tid, kind, name, at in self.events:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({'name': name})
+            profiles.setdefault(tid, []).append({'type': kind, 'frame': index[name], 'at': at - self.start_time})
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json', 'name': self.name,
+                'exporter': 'Entangleware ew_profile', 'shared': {'frames': frames},
+                'profiles': [{'type': 'evented', 'name': '{} (thread {})'.format(self.name, tid), 'unit': 'seconds',
+                              'startValue': events[0]['at'], 'endValue': events[-1]['at'], 'events': events}
+                             for tid, events in profiles.items()]}
+
+    def save(self, path):
+        """Writes the profile to path: speedscope format if path ends with .speedscope.json, Chrome trace otherwise
+
+        :param path: file to write
+        :type path: str or pathlib.Path
+        """
+        path = os.fspath(path)
+        data = self.speedscope() if path.endswith('.speedscope.json') else self.chrome_trace()
+        with open(path, 'w') as out_file:
+            json.dump(data, out_file)
+
+
+class _Dispatch:
+    # ew_profile.active while any profiler is active: hands each hook to the profiler of the calling context, the
+    # one a frame was opened in receives its exit
+    def __init__(self):
+        self._local = threading.local()
+
+    def _opened(self):
+        try:
+            return self._local.opened
+        except AttributeError:
+            self._local.opened = []
+            return self._local.opened
+
+    def enter(self, name):
+        profiler = _current.get() or _process_profiler
+        self._opened().append(profiler)
+        if profiler is not None:
+            profiler.enter(name)
+
+    def exit(self):
+        profiler = self._opened().pop()
+        if profiler is not None:
+            profiler.exit()
+
+    def emitted(self, count):
+        profiler = _current.get() or _process_profiler
+        if profiler is not None:
+            profiler.emitted(count)
+
+    def appended(self, length):
+        profiler = _current.get() or _process_profiler
+        if profiler is not None:
+            profiler.appended(length)
+
+
+_dispatch = _Dispatch()
+
+
+def _activate(change):
+    # counts the active profilers, the hooks are on while there is one
+    global active, _active_count
+    with _count_lock:
+        _active_count += change
+        active = _dispatch if _active_count else None
+
+
+def profiled(func):
+    """Decorator recording each call of func as a frame of the active profiler (e.g. the SPI writes of a board)"""
+    name = func.__qualname__
+
+    def profiled_wrapper(*args, **kwargs):
+        profiler = active
+        if profiler is None:
+            return func(*args, **kwargs)
+        profiler.enter(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.exit()
+    profiled_wrapper.__name__ = func.__name__
+    profiled_wrapper.__qualname__ = func.__qualname__
+    profiled_wrapper.__doc__ = func.__doc__
+    return profiled_wrapper
+
+
+def _profile_process(path):
+    # EW_PROFILE: profile every thread from import on, save when Python exits
+    global _process_profiler
+    _process_profiler = Profiler(name=os.path.basename(path))
+    _activate(1)
+    atexit.register(_process_profiler.save, path)
+
+
+if os.environ.get('EW_PROFILE'):
+    _profile_process(os.environ['EW_PROFILE'])
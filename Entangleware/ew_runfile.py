@@ -0,0 +1,193 @@
+from Entangleware import ew_link as ew
+import mmap
+import zlib
+import numpy as np
+
+# connector number of analog transitions in the upload message
+ANALOG_CONNECTOR = 5
+
+
+class ChannelIndex:
+    def __init__(self, times, values):
+        """Transitions of one digital line or analog channel, sorted by time. For equal times the transition queued
+        last wins, as on the hardware.
+
+        :param times: transition times (seconds), sorted
+        :type times: numpy.ndarray
+        :param values: value set at each time (0/1 for digital lines, volts for analog channels)
+        :type values: numpy.ndarray
+        """
+        self.times = times
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    def value_at(self, t, default=None):
+        """Value of the channel at time(s) t
+
+        :param t: time or array of times (seconds)
+        :type t: float or numpy.ndarray
+        :param default: value before the first transition (the idle state is not part of a compiled run)
+        :rtype: float or numpy.ndarray
+        """
+        i = np.searchsorted(self.times, t, side='right') - 1
+        if np.ndim(t) == 0:
+            return self.values[i] if i >= 0 else default
+        fill = np.nan if default is None else default
+        return np.where(i >= 0, self.values[np.maximum(i, 0)], fill)
+
+    def transitions(self, t_start, t_stop):
+        """Transitions in the window t_start <= t < t_stop
+
+        :param t_start: start of window (seconds)
+        :type t_start: float
+        :param t_stop: end of window (seconds)
+        :type t_stop: float
+        :rtype: tuple (numpy.ndarray, numpy.ndarray)
+        :return: times and values
+        """
+        lo = np.searchsorted(self.times, t_start, side='left')
+        hi = np.searchsorted(self.times, t_stop, side='left')
+        return self.times[lo:hi], self.values[lo:hi]
+
+
+class CompiledRun:
+    def __init__(self, records, source=None):
+        """Read access to the transitions of a compiled run. Channels are indexed on first use, each index is built
+        with one vectorized pass over the transitions and queries are binary searches.
+
+        :param records: transitions (ew_link.wire_dtype)
+        :type records: numpy.ndarray
+        :param source: object holding the memory records views (e.g. an mmap), closed by close()
+        """
+        self.records = records
+        self._source = source
+        self._digital = {}
+        self._analog = {}
+
+    @classmethod
+    def load(cls, path='LastCompiledRun.dat'):
+        """Maps a compiled run from disk (the upload message: 4 byte cycle count followed by the transitions).
+        Files ending in .zlib are decompressed into memory instead.
+
+        :param path: file to load
+        :type path: str or pathlib.Path
+        :rtype: CompiledRun
+        """
+        if str(path).endswith('.zlib'):
+            with open(path, 'rb') as in_file:
+                return cls.from_message(zlib.decompress(in_file.read()))
+        with open(path, 'rb') as in_file:
+            mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = np.frombuffer(mapped, dtype=ew.wire_dtype, offset=4)
+        return cls(records, source=mapped)
+
+    @classmethod
+    def from_message(cls, message):
+        """Compiled run from an upload message held in memory
+
+        :param message: 4 byte cycle count followed by the transitions
+        :type message: bytes
+        :rtype: CompiledRun
+        """
+        return cls(np.frombuffer(message, dtype=ew.wire_dtype, offset=4))
+
+    @classmethod
+    def from_sequence(cls, sequence=None):
+        """Compiled run from the transitions queued in a sequence being built
+
+        :param sequence: sequence buffer, ew_link.msgseq by default
+        :type sequence: ew_link.Sequence
+        :rtype: CompiledRun
+        """
+        if sequence is None:
+            sequence = ew.msgseq
+        return cls(sequence.records())
+
+    def close(self):
+        self.records = None
+        self._digital = {}
+        self._analog = {}
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _index(self, wire_connector, bit):
+        records = self.records
+        touched = (records['connector'] == wire_connector) & (((records['channel_mask'] >> np.uint32(bit)) & 1) == 1)
+        times = records['time'][touched].astype(float)
+        states = records['output_state'][touched]
+        # stable, so transitions at equal times keep the order they were queued in
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        states = states[order]
+        # keep the last transition of equal times
+        last = np.append(times[1:] != times[:-1], True)[:len(times)]
+        return times[last], states[last]
+
+    def digital(self, connector, pin):
+        """Index of a digital line
+
+        :param connector: FPGA connector (0-3)
+        :type connector: int
+        :param pin: digital line (0-31)
+        :type pin: int
+        :rtype: ChannelIndex
+        """
+        key = (connector, pin)
+        if key not in self._digital:
+            times, states = self._index(connector + 1, pin)
+            self._digital[key] = ChannelIndex(times, ((states >> np.uint32(pin)) & 1).astype(np.int8))
+        return self._digital[key]
+
+    def analog(self, board, channel):
+        """Index of an analog output channel
+
+        :param board: analog card (0-1)
+        :type board: int
+        :param channel: channel (0-7)
+        :type channel: int
+        :rtype: ChannelIndex
+        """
+        key = (board, channel)
+        if key not in self._analog:
+            times, states = self._index(ANALOG_CONNECTOR, board * 8 + channel)
+            # states are signed 16 bit codes of +-10 V
+            volts = states.astype(np.uint32).view(np.int32) / 2 ** 16 * 20
+            self._analog[key] = ChannelIndex(times, volts)
+        return self._analog[key]
+
+    def channels(self):
+        """Digital lines and analog channels with at least one transition
+
+        :rtype: dict
+        :return: {'digital': [(connector, pin)], 'analog': [(board, channel)]}
+        """
+        used = {'digital': [], 'analog': []}
+        for wire_connector in np.unique(self.records['connector']):
+            masks = self.records['channel_mask'][self.records['connector'] == wire_connector]
+            union = int(np.bitwise_or.reduce(masks)) if len(masks) else 0
+            bits = [bit for bit in range(32) if union & (1 << bit)]
+            if wire_connector == ANALOG_CONNECTOR:
+                used['analog'] += [(bit // 8, bit % 8) for bit in bits]
+            elif 1 <= wire_connector <= 4:
+                used['digital'] += [(int(wire_connector) - 1, bit) for bit in bits]
+        return used
+
+    def time_span(self):
+        """First and last transition time
+
+        :rtype: tuple (float, float)
+        """
+        if len(self.records) == 0:
+            return None
+        times = self.records['time']
+        return float(times.min()), float(times.max())
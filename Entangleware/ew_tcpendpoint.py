@@ -27,6 +27,24 @@ class TcpEndPoint:
             startaddr += bytessent  # bytessent should equal chunksize but if not, start at proper startaddr
             msglength -= bytessent
 
+    def sendmsg_parts(self, parts, msgid, msgtype):
+        # same message as sendmsg(b''.join(parts), ...) without joining: the parts are sent from their own buffers
+        views = [memoryview(part).cast('B') for part in parts]
+        header = struct.pack(">QLL", msgid, msgtype, sum(len(view) for view in views))
+        views.insert(0, memoryview(header))
+        if hasattr(self._sock, 'sendmsg'):
+            # scatter-gather where the platform has it (not on Windows)
+            while views:
+                bytessent = self._sock.sendmsg(views)
+                while views and bytessent >= len(views[0]):
+                    bytessent -= len(views[0])
+                    views.pop(0)
+                if views:
+                    views[0] = views[0][bytessent:]
+        else:
+            for view in views:
+                self._sock.sendall(view)
+
     def getmsg(self):
         header = bytearray(self._sock.recv(16))
         msgid, msgtype, msglength = struct.unpack(">QLL", header)
@@ -28,13 +28,15 @@ class CrossRelease(Sequence):
         :rtype: float
         :return: 0 elapsed time
         """
+        # coils on at the release, whatever order the sequence is built in
+        coils = mag.coil_state(seq_time)
         self.abs(0.00, self.ag.off)
         self.abs(0.00, self.dipole.off)
-        if mag.pinch_on or mag.bias_on:
+        if coils['pinch_on'] or coils['bias_on']:
             self.abs(0.00, self.pinch.off)
         else:
             self.abs(0.00, self.pinch.clean_up)
-        if mag.img_on:
+        if coils['img_on']:
             self.abs(0.10*ms, self.image_coil.high)
         else:
             self.abs(0.10*ms, self.image_coil.on)
@@ -10,13 +10,13 @@ import Base.inireset as rst
 
 class OpticalPumping(Sequence):
 
-    @Sequence._update_time
+    @Sequence._relocatable
     def on(self, seq_time):
         self.abs(-15 * ms, laser.OPAOM.off)
         self.abs(-7.5 * ms, laser.OPShutter().open)
         self.abs(0, laser.OPAOM.on)
 
-    @Sequence._update_time
+    @Sequence._relocatable
     def off(self, seq_time):
         self.abs(0, laser.OPAOM.off)
         self.abs(7.5 * ms, laser.OPShutter().close)
@@ -22,20 +22,22 @@ class CrossEvaporation(Sequence):
         self.test_on = partial(out.digital_out, connector=3, channel=7, state=1)
         self.test_off = partial(out.digital_out, connector=3, channel=7, state=0)
 
-        Comm.seq_info["tof"] = self.tof
-        Comm.seq_info["dipole_low"] = parameters["low"]
-        Comm.seq_info["dipole_high"] = parameters["high"]
-        Comm.seq_info["hold_time"] = self.hold_time
-        Comm.seq_info["commands"] = ["runfit(PixisRb, 1, 'gauss','fix', {'offset'}, "
-                                     "'ROI', [50 350; 850 800], 'AutoROI', [300,300])",
-                                     "writetoOrigin(PixisRb,{'hold_time', 'repump_time', 'detune_repump', "
-                                     "'dipole_low','dipole_high' ,'tof',""'Ntot', 'result'})",
-                                     "showres(PixisRb)"]
+        self.info = {}
+        self.info["tof"] = self.tof
+        self.info["dipole_low"] = parameters["low"]
+        self.info["dipole_high"] = parameters["high"]
+        self.info["hold_time"] = self.hold_time
+        self.info["commands"] = ["runfit(PixisRb, 1, 'gauss','fix', {'offset'}, "
+                                 "'ROI', [50 350; 850 800], 'AutoROI', [300,300])",
+                                 "writetoOrigin(PixisRb,{'hold_time', 'repump_time', 'detune_repump', "
+                                 "'dipole_low','dipole_high' ,'tof',""'Ntot', 'result'})",
+                                 "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time','probe_power'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time','probe_power'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.evap.seq)
         self.rel(self.hold_time, self.test_on)
         self.rel(0.03*ms, [self.test_off, self.release.weak])
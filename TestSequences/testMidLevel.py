@@ -11,20 +11,22 @@ class TestSciCellLoad(Sequence):
     def __init__(self, save_images=False):
         super().__init__()
         self.tof = 2 * ms
-        Comm.seq_info["tof"] = self.tof
+        self.info = {}
+        self.info["tof"] = self.tof
         self.load = MagTrap.SciCellLoad()
         self.release = MagTrap.CartRelease()
         self.image = img.ImageRepeat(repump_time=100*us, detune_repump=False)
-        Comm.seq_info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {{'offset', 'slopex', 'slopey'}},"
-                                     "'guess',[0.1 800 900 100 225 200 0.001 0.001],"
-                                     "'ROI', [200 300; 1000 950], 'AutoROI', [540,770])",
-                                     "writetoOrigin(PixisRb,{'curTime', 'repump_time', "
-                                     "'detune_repump', 'tof','Ntot','result'})", "showres(PixisRb)"]
+        self.info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {{'offset', 'slopex', 'slopey'}},"
+                                 "'guess',[0.1 800 900 100 225 200 0.001 0.001],"
+                                 "'ROI', [200 300; 1000 950], 'AutoROI', [540,770])",
+                                 "writetoOrigin(PixisRb,{'curTime', 'repump_time', "
+                                 "'detune_repump', 'tof','Ntot','result'})", "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.load.seq)
         self.rel(20*ms, self.release.sci_cell)
         self.rel(self.tof, self.image.norm)
@@ -41,17 +43,19 @@ class TestCartEvap(Sequence):
         self.image = img.ImageRepeat(repump_time=100*us, detune_repump=False)
         self.dig_on = partial(out.digital_out, connector=3, channel=7, state=1)
         self.dig_off = partial(out.digital_out, connector=3, channel=7, state=0)
-        Comm.seq_info["tof"] = self.tof
-        Comm.seq_info["commands"] = ["runfit(PixisRb, 1, 'gauss', 'fix', {{'offset', 'slopex', 'slopey'}}, "
-                                     "'ROI', [200 500; 1000 950], 'AutoROI', [680,710])",
-                                     "writetoOrigin(PixisRb,{'repump_time', 'detune_repump', 'tof',"
-                                     "'Ntot','result'})",
-                                     "showres(PixisRb)"]
+        self.info = {}
+        self.info["tof"] = self.tof
+        self.info["commands"] = ["runfit(PixisRb, 1, 'gauss', 'fix', {{'offset', 'slopex', 'slopey'}}, "
+                                 "'ROI', [200 500; 1000 950], 'AutoROI', [680,710])",
+                                 "writetoOrigin(PixisRb,{'repump_time', 'detune_repump', 'tof',"
+                                 "'Ntot','result'})",
+                                 "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.evap.tight)
         self.rel(10*ms, self.release.evap)
         self.rel(self.tof, self.image.norm)
@@ -68,16 +72,18 @@ class TestPinchTransfer(Sequence):
         self.transfer = MagTrap.PinchTransfer()
         self.release = MagTrap.PinchRelease()
         self.image = img.ImageRepeat(repump_time=300*us, detune_repump=False)
-        Comm.seq_info["tof"] = self.tof
-        Comm.seq_info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {'offset'}, "
-                                     "'ROI', [1 250; 1020 900], 'AutoROI', [500,500])",
-                                     "writetoOrigin(PixisRb,{'repump_time', 'detune_repump', 'tof','Ntot','result'})",
-                                     "showres(PixisRb)"]
+        self.info = {}
+        self.info["tof"] = self.tof
+        self.info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {'offset'}, "
+                                 "'ROI', [1 250; 1020 900], 'AutoROI', [500,500])",
+                                 "writetoOrigin(PixisRb,{'repump_time', 'detune_repump', 'tof','Ntot','result'})",
+                                 "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.evap.tight)
         self.rel(100*ms, self.transfer.seq)
         self.rel(200*ms, out.move_cart_prun)
@@ -93,17 +99,19 @@ class TestPinchLoad(Sequence):
         self.load = MagTrap.PinchLoad(ag_down)
         self.release = MagTrap.PinchRelease()
         self.image = img.ImageRepeat(repump_time=15*us, detune_repump=False)
-        Comm.seq_info["iAG"] = 5
-        Comm.seq_info["tof"] = self.tof/ms
-        Comm.seq_info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {{'offset', 'slopex', 'slopey'}}, "
-                                     "'ROI', [100 350; 950 950])",
-                                     "writetoOrigin(PixisRb,{'curTime', 'iAG', 'repump_time', 'detune_repump', "
-                                     "'tof','Ntot','result'})", "showres(PixisRb)"]
+        self.info = {}
+        self.info["iAG"] = 5
+        self.info["tof"] = self.tof/ms
+        self.info["commands"] = ["runfit(PixisRb,'gauss', 'fix', {{'offset', 'slopex', 'slopey'}}, "
+                                 "'ROI', [100 350; 950 950])",
+                                 "writetoOrigin(PixisRb,{'curTime', 'iAG', 'repump_time', 'detune_repump', "
+                                 "'tof','Ntot','result'})", "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.load.tight)
         self.rel(200*ms, self.release.seq)
         self.rel(self.tof, self.image.norm)
@@ -119,17 +127,19 @@ class TestPinchEvap(Sequence):
         self.release = MagTrap.PinchRelease()
         self.image = img.ImageRepeat(repump_time=300*us, detune_repump=False)
 
-        Comm.seq_info["hold_time"] = self.hold_time
-        Comm.seq_info["tof"] = self.tof
-        Comm.seq_info["commands"] = ["runfit(PixisRb, 1, 'gauss', 'fix', {'offset'},"
-                                     "'ROI', [50  500; 500 850], 'AutoROI', [850,600])",
-                                     "writetoOrigin(PixisRb,{'curTime', 'hold_time','repump_time', 'detune_repump', "
-                                     "'tof','Ntot','result'})", "showres(PixisRb)"]
+        self.info = {}
+        self.info["hold_time"] = self.hold_time
+        self.info["tof"] = self.tof
+        self.info["commands"] = ["runfit(PixisRb, 1, 'gauss', 'fix', {'offset'},"
+                                 "'ROI', [50  500; 500 850], 'AutoROI', [850,600])",
+                                 "writetoOrigin(PixisRb,{'curTime', 'hold_time','repump_time', 'detune_repump', "
+                                 "'tof','Ntot','result'})", "showres(PixisRb)"]
         if save_images:
-            Comm.seq_info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
+            self.info["commands"].append("writetofile(PixisRb,{'tof','repump_time'},'saveRAW',1)")
 
     @Sequence._update_time
     def seq(self, seq_time):
+        Comm.update_info(self.info)
         self.abs(0.00, self.evap.tight)
         self.rel(self.hold_time, self.release.seq)
         self.rel(self.tof, self.image.norm)
@@ -10,6 +10,7 @@ import Base.masterrepump as laser
 import Base.imaging as img
 import Base.rf as rftest
 import Base.boards as brd
+from Base.timing import IncrementalBuilder
 
 from Base.constants import *
 
@@ -42,6 +43,8 @@ out.analog_out(0.00, ch.lattice3_servo["connector"], ch.lattice3_servo["channel"
 ###################################################################################################
 
 reset = rst.Reset()
+# executes again only the steps that changed since the previous iteration
+builder = IncrementalBuilder()
 
 shots = 1
 for iteration in range(shots):
@@ -58,7 +61,7 @@ for iteration in range(shots):
     # pinch_evap.seq(0.00)
 
     dip_evap = dip_test.CrossEvaporation(Param.x_large_bec, i=iteration, save_images=False)
-    dip_evap.seq(0.00)
+    builder.build(dip_evap.seq)
 
     print(ew.run_sequence())
 
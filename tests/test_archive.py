@@ -0,0 +1,38 @@
+import struct
+import numpy as np
+import pytest
+from Entangleware import ew_link as ew
+from Entangleware.ew_archive import ShotArchive
+from Entangleware.ew_asyncwriter import writer
+
+
+def _records(count, start=0.0):
+    records = np.zeros(count, dtype=ew.wire_dtype)
+    records['time'] = start + np.arange(count) * 1e-6
+    records['connector'] = 2
+    records['channel_mask'] = 1 << 3
+    records['output_state'] = np.arange(count) % 2 << 3
+    return records
+
+
+@pytest.mark.parametrize('storage', ['columns', 'delta'])
+def test_append_parts(tmp_path, storage):
+    archive = ShotArchive(tmp_path, storage=storage)
+    prefix, rest = _records(5), _records(7, start=1.0)
+    cycles = struct.pack('>l', 1)
+    joined = archive.append(cycles + prefix.tobytes() + rest.tobytes(), params={'tof': 8})
+    parts = archive.append([cycles, prefix.tobytes(), memoryview(rest.tobytes())], params={'tof': 8})
+    assert archive.records(parts).tobytes() == archive.records(joined).tobytes()
+    assert archive.index()[parts]['records'] == 12
+
+
+def test_save_run_archives_in_background(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    info = {'tof': 8}
+    monkeypatch.setattr(ew, 'shot_archive', ShotArchive(tmp_path / 'shots', params=lambda: info))
+    records = _records(3)
+    ew._save_run([struct.pack('>l', 1), memoryview(records.tobytes())])
+    info['tof'] = 9
+    assert writer.flush(timeout=10)
+    assert ew.shot_archive.find(tof=8)[0]['records'] == 3
+    assert ew.shot_archive.records(0).tobytes() == records.tobytes()
@@ -0,0 +1,36 @@
+import threading
+import pytest
+from Entangleware.ew_asyncwriter import AsyncWriter
+
+
+def test_writer_survives_bad_data_and_callbacks(tmp_path):
+    writer = AsyncWriter()
+    done = []
+
+    def fail():
+        raise RuntimeError('callback')
+    with pytest.warns(UserWarning):
+        # not bytes: the write raises TypeError, the callback RuntimeError
+        writer.write(tmp_path / 'bad', [object()], on_done=fail)
+        assert writer.flush(timeout=5)
+    writer.write(tmp_path / 'good', b'data', on_done=lambda: done.append(True))
+    assert writer.flush(timeout=5)
+    assert (tmp_path / 'good').read_bytes() == b'data'
+    assert done == [True]
+    assert writer.stats['failures'] == 1 and writer.stats['written'] == 1
+
+
+def test_calls_are_never_dropped(tmp_path):
+    writer = AsyncWriter(max_pending=2)
+    release = threading.Event()
+    done = []
+    writer.call(release.wait, 10)
+    for i in range(5):
+        writer.call(done.append, i)
+    writer.write(tmp_path / 'first', b'1')
+    writer.write(tmp_path / 'second', b'2')
+    release.set()
+    assert writer.flush(timeout=10)
+    assert done == [0, 1, 2, 3, 4]
+    assert writer.stats['dropped'] == 1
+    assert (tmp_path / 'second').read_bytes() == b'2' and not (tmp_path / 'first').exists()
@@ -0,0 +1,44 @@
+import numpy as np
+from Entangleware import ew_link as ew
+from Base.blocklibrary import BlockLibrary
+from Base.timing import Sequence, _state_key
+
+
+class _Step(Sequence):
+    pass
+
+
+def _key(library, func, step=None):
+    step = step or _Step()
+    return library.key(func, step, _state_key(step))
+
+
+def test_closures_of_one_scope_have_their_own_keys(tmp_path):
+    library = BlockLibrary(tmp_path)
+
+    def capture(value):
+        return lambda t: value
+    keys = [_key(library, capture(value)) for value in (1, 2, 2.5, 'a')]
+    assert len(set(keys)) == len(keys)
+    assert _key(library, capture(2)) == keys[1]
+    first, second = (lambda t: 1), (lambda t: 2)
+    assert _key(library, first) != _key(library, second)
+
+
+def test_unkeyable_closure_is_not_stored(tmp_path):
+    library = BlockLibrary(tmp_path)
+    handle = object.__new__(type('Handle', (), {'__slots__': ()}))
+    assert _key(library, lambda t: handle) is None
+
+
+def test_store_scans_only_over_the_cap(tmp_path, monkeypatch):
+    library = BlockLibrary(tmp_path, max_bytes=4000)
+    scans = []
+    monkeypatch.setattr(library, 'evict', lambda original=library.evict: scans.append(1) or original())
+    records = np.zeros(10, dtype=ew.wire_dtype)
+    for i in range(5):
+        library.store('block{}'.format(i), records, 0.0, [])
+    assert scans == []
+    for i in range(5, 20):
+        library.store('block{}'.format(i), records, 0.0, [])
+    assert scans and library.size() <= 4000
@@ -0,0 +1,95 @@
+import warnings
+import struct
+import pytest
+from Entangleware import ew_link as ew
+from Base import boards as brd
+from Base.constants import *
+
+
+@pytest.fixture
+def sequence():
+    with ew.BuildContext() as context:
+        ew.build_sequence()
+        yield context.sequence
+
+
+def _dds():
+    return brd.AD9959(connector=1, io_pin=1, serial_clock_pin=3, reset_pin=5, io_update_pin=7, ref_clock=25*MHz,
+                      ref_clk_multiplier=20)
+
+
+def test_amplitude_ramp_sets_ramp_pins_once(sequence):
+    dds = _dds()
+    dds.initialize(0.01)
+    fr1 = bytes([(20 << 2) | (1 << 7), 1 << 2, 0])
+    assert dds.shadow.value_at(0x01, 0.05) != fr1
+    dds.amplitude_ramp(0.1, 0, float('-inf'), -10, 1e-3)
+    assert dds.shadow.value_at(0x01, 0.1) == fr1
+    first = len(sequence.records())
+    dds.amplitude_ramp(0.2, 0, -10, float('-inf'), 1e-3)
+    # second burst: channel select, modulation off, amplitude control and update pulse, no FR1 frame
+    assert len(sequence.records()) - first == 32 + 64 + 64 + 2
+
+
+def test_amplitude_ramp_channels_without_ramp_pin(sequence):
+    with pytest.raises(ValueError):
+        _dds().amplitude_ramp(0.1, 2, float('-inf'), -10, 1e-3)
+
+
+def test_switch_many_elapsed_time_matches_switch(sequence):
+    xp = brd.XPSwitch({'connector': 2, 'serial_strobe': 0, 'clock': 1, 'io': 2, 'crosspoint_strobe': 3})
+    switches = [(0, 3, 4), (1, -1, 5), (2, 6, 7)]
+    elapsed = sum(xp.switch(1.0 + i, *switch) for i, switch in enumerate(switches))
+    assert xp.switch_many(2.0, switches) == pytest.approx(elapsed)
+
+
+@pytest.mark.parametrize('duration, expected, rtol', [(2e-6, 2e-6, 0.05), (500e-6, 500e-6, 0.01),
+                                                      (10e-3, 1023 * 255 * 4 / (500 * MHz), 0.01)])
+def test_amplitude_ramp_programmed_duration(sequence, duration, expected, rtol):
+    dds = _dds()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        elapsed = dds.amplitude_ramp(0.1, 1, float('-inf'), 10, duration)
+    acr = dds.shadow.value_at((0x06, 1), 0.1)
+    ramp_rate, step = acr[0], 1 << (acr[1] >> 6)
+    asf = ((acr[1] & 0x3) << 8) | acr[2]
+    programmed = -(-asf // step) * ramp_rate * 4 / (500 * MHz)
+    assert asf == 1023
+    assert elapsed == pytest.approx(programmed)
+    assert programmed == pytest.approx(expected, rel=rtol)
+
+
+class _Endpoint:
+    # accepts every upload and reports a zero length run
+    def __init__(self):
+        self._sock = self
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendmsg_parts(self, parts, *args):
+        pass
+
+    def getmsg(self):
+        return struct.pack('>d', 0.0), 0, 0
+
+
+def test_replayed_shot_resets_register_shadow(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    connection = ew.ConnectionManager()
+    connection.tcp_endpoint = _Endpoint()
+    with ew.BuildContext(connection=connection) as context:
+        dds = _dds()
+        shots = []
+        for freq in (80*MHz, 90*MHz):
+            ew.build_sequence()
+            dds.arbitrary_output(0.1, 0, [freq], [0], 0)
+            ew.run_sequence()
+            shots.append(context.last_run_parts)
+        ew.writer.flush()
+        ew.rerun_sequence(shots[0])
+        # the chip now holds shot A's 80 MHz, so shot C has to write its 90 MHz again
+        ew.build_sequence()
+        dds.arbitrary_output(0.1, 0, [90*MHz], [0], 0)
+        assert dds.shadow.value_at((0x04, 0), 0.1) == dds._ftw_payload(90*MHz)
+        assert len(context.sequence.records()) > 0
@@ -0,0 +1,34 @@
+import threading
+from Entangleware import ew_link as ew
+from Entangleware import ew_profile
+import Base.MatlabCommunication as Comm
+import Base.outputwrappers as out
+
+
+def test_seq_info_per_context():
+    default_tof = Comm.seq_info['tof']
+    with ew.BuildContext():
+        Comm.set_info('tof', 1.5)
+        assert Comm.seq_info['tof'] == 1.5
+        with ew.BuildContext():
+            assert Comm.seq_info['tof'] == Comm.default_seq_info['tof']
+    assert Comm.seq_info['tof'] == default_tof
+
+
+def test_profiler_records_its_own_thread():
+    def build():
+        with ew.BuildContext():
+            ew.build_sequence()
+            out.digital_out(0.0, connector=3, channel=7, state=1)
+
+    with ew_profile.Profiler() as profiler:
+        with ew.BuildContext():
+            ew.build_sequence()
+            profiler.enter('shot')
+            thread = threading.Thread(target=build)
+            thread.start()
+            thread.join()
+            out.digital_out(0.0, connector=3, channel=7, state=1)
+            profiler.exit()
+    assert ew_profile.active is None
+    assert [(frame[1], frame[4]) for frame in profiler.frames] == [(('shot',), 1)]
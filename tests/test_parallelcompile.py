@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from Entangleware import ew_link as ew
+from Base import parallelcompile
+
+
+def _tree(rng, depth=3):
+    # nested segments queuing transitions with many equal times, some of them one transition per append
+    segment = ew.Segment()
+    for _ in range(rng.integers(2, 5)):
+        if depth and rng.random() < 0.6:
+            segment.items.append(_tree(rng, depth - 1))
+            continue
+        records = np.zeros(rng.integers(1, 40), dtype=ew.wire_dtype)
+        records['time'] = rng.integers(0, 20, len(records)) * 1e-3
+        records['output_state'] = rng.integers(0, 1 << 30, len(records))
+        segment.items.append(records.tobytes())
+    return segment
+
+
+@pytest.mark.parametrize('workers', [2, 3, 8, 1000])
+def test_time_order_matches_stable_sort(workers):
+    rng = np.random.default_rng(workers)
+    root = _tree(rng, depth=5)
+    records = root.records()
+    expected = records[np.argsort(records['time'], kind='stable')]
+    assert len(parallelcompile.partitions(root, workers)) > 1
+    assert parallelcompile.time_order(root, workers).tobytes() == expected.tobytes()
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from Entangleware import ew_link as ew
+import Base.outputwrappers as out
+
+
+@pytest.fixture
+def sequence():
+    with ew.BuildContext() as context:
+        ew.build_sequence()
+        yield context.sequence
+
+
+def _records(sequence, ramp, kind):
+    getattr(ramp, kind)(1.25)
+    records = sequence.records().copy()
+    sequence.clear()
+    ew.build_sequence()
+    return records
+
+
+@pytest.mark.parametrize('kind, parameters', [('linear', {}), ('exponential', {'tau': 2.0}),
+                                              ('exponential_down', {'tau': 5.0}), ('sigmoidal', {'a': 10})])
+@pytest.mark.parametrize('sign', [1, -1])
+def test_batch_matches_ramps(sequence, kind, parameters, sign):
+    def ramps():
+        return [out.AnalogRamp(0, 3, -sign * start, sign * 2.0, 0.5, **parameters) for start in (0.5, 1.0, 3.0)]
+    single = [_records(sequence, ramp, kind) for ramp in ramps()]
+    batched = ramps()
+    out.RampBatch(batched)
+    for expected, ramp in zip(single, batched):
+        records = _records(sequence, ramp, kind)
+        assert len(records) == len(expected)
+        assert (records['output_state'] == expected['output_state']).all()
+        assert np.allclose(records['time'], expected['time'], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('kind, parameters', [('linear', {'val_end': 1.0}), ('linear', {'total_time': 0}),
+                                              ('exponential_down', {'val_end': 1.0, 'tau': 5.0}),
+                                              ('sigmoidal', {'val_end': 1.0, 'a': 10})])
+def test_batch_raises_like_ramps(sequence, kind, parameters):
+    # no voltage change (zero slope) or no time to change in
+    def ramp():
+        arguments = dict({'val_end': 2.0, 'total_time': 0.1}, **parameters)
+        return out.AnalogRamp(0, 1, 1.0, arguments.pop('val_end'), arguments.pop('total_time'), **arguments)
+    with pytest.raises(ZeroDivisionError):
+        getattr(ramp(), kind)(0.0)
+    batched = ramp()
+    out.RampBatch([out.AnalogRamp(0, 1, 0.0, 1.0, 0.1, a=10, tau=5.0), batched])
+    with pytest.raises(ZeroDivisionError):
+        getattr(batched, kind)(0.0)
+    assert len(sequence.records()) == 0
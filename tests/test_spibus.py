@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from Entangleware import ew_link as ew
+from Base import boards as brd
+from Base import spibus
+from Base import spidecode
+from Base.constants import *
+
+
+@pytest.fixture
+def sequence():
+    with ew.BuildContext() as context:
+        ew.build_sequence()
+        yield context.sequence
+
+
+def _fixed_block(bus, start, end, dt):
+    # transitions on pins 1 and 3 of connector 1, every dt from start to end
+    times = np.arange(round((end - start) / dt)) * dt + start
+    bus.submit_fixed('other', 1, times, (1 << 1) | (1 << 3), np.zeros(len(times), dtype=np.uint32), dt)
+
+
+def test_frames_of_a_chip_keep_their_order(sequence):
+    dds = brd.AD9959(connector=1, io_pin=1, serial_clock_pin=3, reset_pin=5, io_update_pin=7, ref_clock=25*MHz,
+                     ref_clk_multiplier=20)
+    dt = dds.spi_min_time
+    t = 1.0
+    with spibus.SpiBus() as bus:
+        _fixed_block(bus, t - 130 * dt, t + 10 * dt, dt)
+        _fixed_block(bus, t - 400 * dt, t - 180 * dt, dt)
+        dds.arbitrary_output(t, channel_mask=2, freq_list=[80*MHz], power_list=[-10], tt=0, force=True)
+
+    # the channel select has to land before the frames it selects the channel for
+    assert bus.conflicts == []
+    timelines = spidecode.decode_board(sequence.records(), dds)
+    assert np.any(abs(timelines[2]['frequency'] - 80*MHz) < 1)
+    for channel in (0, 1, 3):
+        assert not np.any(abs(timelines[channel]['frequency'] - 80*MHz) < 1)